@@ -4,12 +4,20 @@
 from .models import Stage
 from .models import InvalidStateError
 from .models import DOMWrapper
+from .models import ParentContext
 from .models import CelloStopScraping
 from .models import CelloJumpToNextStage
+from .models import CelloPersistenceError
 
 from .helpers import Route
+from .helpers import RouteTable
+from .helpers import Canonicalizer
 from .helpers import InvalidURLMapping
-from .storage import Case
+from .storage import Case, PersistBuffer, PersistWriter, FingerprintStore
+from .extraction import Field
+from .frontier import Frontier, SharedFrontier, BloomFrontier, SQLiteFrontier
+from .cache import ResponseCache, ContentIndex
+from .scheduler import Scheduler, AdaptiveConcurrency
 
 from .multi.processing import MultiProcessStage
 from .multi.thread import MultiThreadStage
@@ -21,10 +29,26 @@ __all__ = [
     'MultiProcessStage',
     'MultiThreadStage',
     'Route',
+    'RouteTable',
+    'Canonicalizer',
     'Case',
+    'PersistBuffer',
+    'PersistWriter',
+    'FingerprintStore',
+    'Field',
+    'Frontier',
+    'SharedFrontier',
+    'BloomFrontier',
+    'SQLiteFrontier',
+    'ResponseCache',
+    'ContentIndex',
+    'Scheduler',
+    'AdaptiveConcurrency',
     'DOMWrapper',
+    'ParentContext',
     'CelloStopScraping',
     'InvalidURLMapping',
     'InvalidStateError',
     'CelloJumpToNextStage',
+    'CelloPersistenceError',
 ]
@@ -0,0 +1,423 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import time
+import zlib
+import errno
+import hashlib
+import tempfile
+import threading
+import multiprocessing
+import cPickle as pickle
+from collections import OrderedDict
+from multiprocessing.sharedctypes import RawArray
+
+from .frontier import LocalConnection, DEFAULT_TIMEOUT
+
+DEFAULT_MAX_BYTES = 1024 ** 3
+VALIDATORS = (('etag', 'If-None-Match'), ('last-modified', 'If-Modified-Since'))
+
+
+def header(headers, name):
+    if not headers:
+        return
+
+    for key, value in headers.items():
+        if key.lower() == name:
+            return value
+
+
+class CachedResponse(object):
+    def __init__(self, url, content, status_code=None, headers=None, stored_at=None):
+        self.url = url
+        self.content = content
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.stored_at = stored_at or time.time()
+
+    def __repr__(self):
+        return '<CachedResponse: {} ({} bytes)>'.format(self.url, len(self.content))
+
+    @property
+    def validators(self):
+        headers = {}
+        for name, request_header in VALIDATORS:
+            value = header(self.headers, name)
+            if value:
+                headers[request_header] = value
+
+        return headers
+
+
+class ResponseCache(object):
+    '''
+    Keeps the responses fetched by stages on disk, keyed by their
+    canonical url, so that crawling a site again doesn't download it
+    again.
+
+    Responses are fresh for `ttl` seconds (forever by default), stale
+    ones with an ETag or a Last-Modified header are revalidated through
+    `Stage.get_conditional_response()`. The least recently used
+    responses are evicted once the cache takes more than `max_bytes`.
+
+    When shared, its counters and the size of the responses on disk
+    live in shared memory so that worker processes forked after its
+    creation report to the same ones and keep the whole cache under
+    `max_bytes`, evicting the responses any of them read least recently.
+    Threads can share it either way.
+
+    Example:
+
+    class Fab(Stage):
+        cache = ResponseCache('/var/cache/fab', ttl=24 * 60 * 60)
+    '''
+    def __init__(self, directory=None, ttl=None, max_bytes=DEFAULT_MAX_BYTES, shared=False):
+        self.directory = directory or tempfile.mkdtemp(prefix='cello-cache-')
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.shared = shared
+        if shared:
+            self.lock = multiprocessing.Lock()
+            self.counters = RawArray('L', 5)
+            self.usage = RawArray('L', 1)
+        else:
+            self.lock = threading.Lock()
+            # [hits, misses, revalidated, stored, evicted]
+            self.counters = [0] * 5
+            # [bytes on disk]
+            self.usage = [0]
+
+        # guards the entries and their total size within this process
+        self.entries_lock = threading.RLock()
+        self.entries = OrderedDict()
+        self.load()
+
+    def __len__(self):
+        if self.shared:
+            # other processes add and evict responses as well
+            return len(self.scan())
+
+        return len(self.entries)
+
+    def __repr__(self):
+        return '<{}: {} responses in {}>'.format(
+            self.__class__.__name__, len(self), self.directory)
+
+    @property
+    def size(self):
+        return self.usage[0]
+
+    def load(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        for mtime, name, size in self.scan():
+            self.entries[name] = size
+            self.usage[0] += size
+
+    def scan(self):
+        # the responses on disk, least recently used first
+        found = []
+        for name in os.listdir(self.directory):
+            if name.startswith('.'):
+                continue
+
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+
+            found.append((stat.st_mtime, name, stat.st_size))
+
+        return sorted(found)
+
+    def stored_size(self, key):
+        try:
+            return os.path.getsize(self.path(key))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return 0
+
+    def key(self, url):
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')
+
+        return hashlib.sha1(url).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def count(self, index):
+        with self.lock:
+            self.counters[index] += 1
+
+    def remember(self, key, size):
+        with self.entries_lock:
+            previous = self.entries.pop(key, 0)
+            # least recently used entries go first when evicting
+            self.entries[key] = size
+            if not self.shared:
+                self.usage[0] += size - previous
+
+    def forget(self, key):
+        with self.entries_lock:
+            forgotten = self.entries.pop(key, 0)
+            if not self.shared:
+                self.usage[0] -= forgotten
+
+    def get(self, url):
+        key = self.key(url)
+        try:
+            with open(self.path(key), 'rb') as stored:
+                data = stored.read()
+            entry = pickle.loads(zlib.decompress(data))
+            os.utime(self.path(key), None)
+        except (IOError, OSError, zlib.error, pickle.UnpicklingError, EOFError):
+            # evicted by another worker in the meantime
+            self.forget(key)
+            return
+
+        self.remember(key, len(data))
+        return CachedResponse(**entry)
+
+    def put(self, url, response):
+        status_code = getattr(response, 'status_code', None)
+        content = getattr(response, 'content', None)
+        if status_code not in (None, 200) or not isinstance(content, basestring):
+            return
+
+        entry = dict(
+            url=url,
+            content=content,
+            status_code=status_code,
+            headers=dict(getattr(response, 'headers', None) or {}),
+            stored_at=time.time(),
+        )
+        data = zlib.compress(pickle.dumps(entry, pickle.HIGHEST_PROTOCOL))
+
+        key = self.key(url)
+        descriptor, temporary = tempfile.mkstemp(dir=self.directory, prefix='.')
+        with os.fdopen(descriptor, 'wb') as stored:
+            stored.write(data)
+
+        # renaming is atomic, other processes never read half a response
+        if self.shared:
+            with self.lock:
+                # the response it replaces may come from another process
+                previous = self.stored_size(key)
+                os.rename(temporary, self.path(key))
+                self.usage[0] = max(0, self.usage[0] + len(data) - previous)
+        else:
+            os.rename(temporary, self.path(key))
+
+        self.remember(key, len(data))
+        self.count(3)
+        self.evict()
+
+    def evict(self):
+        if self.shared:
+            return self.evict_shared()
+
+        while True:
+            with self.entries_lock:
+                if self.size <= self.max_bytes or len(self.entries) <= 1:
+                    return
+
+                key, evicted = self.entries.popitem(last=False)
+                self.usage[0] -= evicted
+
+            try:
+                os.remove(self.path(key))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+            self.count(4)
+
+    def evict_shared(self):
+        if self.size <= self.max_bytes:
+            return
+
+        with self.lock:
+            # the entries of a single process don't tell what the others
+            # stored, the directory does, and the time get() last touched
+            # each response tells which ones were read least recently
+            found = self.scan()
+            size = sum(stored for mtime, name, stored in found)
+            evicted = 0
+            while size > self.max_bytes and len(found) > 1:
+                mtime, key, stored = found.pop(0)
+                try:
+                    os.remove(self.path(key))
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+
+                self.forget(key)
+                size -= stored
+                evicted += 1
+
+            self.usage[0] = size
+            self.counters[4] += evicted
+
+    def is_fresh(self, cached):
+        return self.ttl is None or time.time() - cached.stored_at < self.ttl
+
+    def fetch(self, url, get_response, get_conditional_response):
+        cached = self.get(url)
+        if cached is not None and self.is_fresh(cached):
+            self.count(0)
+            return cached
+
+        if cached is not None and cached.validators:
+            response = get_conditional_response(url, cached.validators)
+            if getattr(response, 'status_code', None) == 304:
+                self.count(2)
+                self.put(url, cached)
+                return cached
+        else:
+            response = get_response(url)
+
+        self.count(1)
+        self.put(url, response)
+        return response
+
+    def report(self):
+        hits, misses, revalidated, stored, evicted = self.counters[:]
+        lookups = hits + misses + revalidated
+        return {
+            'cache.hits': hits,
+            'cache.misses': misses,
+            'cache.revalidated': revalidated,
+            'cache.stored': stored,
+            'cache.evicted': evicted,
+            'cache.hit_ratio': lookups and float(hits + revalidated) / lookups or 0.0,
+        }
+
+
+class ContentIndex(object):
+    '''
+    Remembers, for every page fetched by the stages that use it, a
+    digest of its body along with its ETag and Last-Modified headers, so
+    that the next crawl of the same site can tell which pages changed.
+
+    Pages whose body has the same digest as in the previous crawl are
+    neither tuned nor persisted again. A page is only remembered once it
+    was persisted, so that a page whose item failed to be saved is saved
+    by the next crawl. Pages with validators are
+    requested through `Stage.get_conditional_response()`, and those
+    that are not modified aren't played, tuned nor persisted either.
+    Give it to the stages whose pages lead nowhere new, like product
+    pages.
+
+    When shared, its counters live in shared memory so that worker
+    processes forked after its creation report to the same ones. Every
+    thread and process opens its own connection to the database.
+
+    Example:
+
+    class EachFabProduct(Stage):
+        index = ContentIndex('/var/lib/fab/index.db')
+    '''
+    def __init__(self, path, timeout=DEFAULT_TIMEOUT, shared=False):
+        self.path = path
+        if shared:
+            self.lock = multiprocessing.Lock()
+            self.counters = RawArray('L', 4)
+        else:
+            self.lock = threading.Lock()
+            # [not modified, unchanged, changed, new]
+            self.counters = [0] * 4
+
+        self.connection = LocalConnection(path, timeout)
+        self.database.execute(
+            'CREATE TABLE IF NOT EXISTS pages ('
+            'url TEXT PRIMARY KEY, digest TEXT, etag TEXT, last_modified TEXT, checked_at REAL)')
+
+    def __len__(self):
+        return self.database.execute('SELECT COUNT(*) FROM pages').fetchone()[0]
+
+    def __repr__(self):
+        return '<{}: {} pages in {}>'.format(self.__class__.__name__, len(self), self.path)
+
+    @property
+    def database(self):
+        return self.connection()
+
+    def count(self, position):
+        with self.lock:
+            self.counters[position] += 1
+
+    def digest(self, response):
+        status_code = getattr(response, 'status_code', None)
+        content = getattr(response, 'content', None)
+        if status_code not in (None, 200) or not isinstance(content, basestring):
+            return
+
+        if isinstance(content, unicode):
+            content = content.encode('utf-8')
+
+        return hashlib.sha1(content).hexdigest()
+
+    def get(self, url):
+        row = self.database.execute(
+            'SELECT digest, etag, last_modified FROM pages WHERE url = ?', (url, )).fetchone()
+        if row is None:
+            return
+
+        digest, etag, last_modified = row
+        validators = {}
+        for (name, request_header), value in zip(VALIDATORS, (etag, last_modified)):
+            if value:
+                validators[request_header] = value
+
+        return digest, validators
+
+    def remember(self, url, entry):
+        digest, etag, last_modified = entry
+        self.database.execute(
+            'INSERT OR REPLACE INTO pages (url, digest, etag, last_modified, checked_at) '
+            'VALUES (?, ?, ?, ?, ?)',
+            (url, digest, etag, last_modified, time.time()))
+
+    def fetch(self, url, get_response, get_conditional_response):
+        # returns the response, None when it wasn't modified, whether the
+        # page is the same as in the previous crawl, and the entry to
+        # remember once the page of a changed one was persisted
+        entry = self.get(url)
+        if entry is not None and entry[1]:
+            response = get_conditional_response(url, entry[1])
+            if getattr(response, 'status_code', None) == 304:
+                self.count(0)
+                self.database.execute('UPDATE pages SET checked_at = ? WHERE url = ?', (time.time(), url))
+                return None, True, None
+        else:
+            response = get_response(url)
+
+        digest = self.digest(response)
+        if digest is None:
+            return response, False, None
+
+        headers = getattr(response, 'headers', None)
+        fetched = (digest, header(headers, 'etag'), header(headers, 'last-modified'))
+        unchanged = entry is not None and entry[0] == digest
+        self.count(entry is None and 3 or unchanged and 1 or 2)
+        if unchanged:
+            # its item was persisted by a previous crawl, only the validators may be new
+            self.remember(url, fetched)
+            return response, True, None
+
+        return response, False, fetched
+
+    def report(self):
+        not_modified, unchanged, changed, new = self.counters[:]
+        return {
+            'incremental.not_modified': not_modified,
+            'incremental.unchanged': unchanged,
+            'incremental.changed': changed,
+            'incremental.new': new,
+            'incremental.skipped': not_modified + unchanged,
+        }
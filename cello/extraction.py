@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from collections import defaultdict
+
+from lxml import etree
+from lxml import html as lhtml
+from cssselect import parse
+
+from .selectors import cache as selector_cache, HTMLTranslator, EXTENSIONS
+
+
+class InvalidField(Exception):
+    pass
+
+
+class PredicateTranslator(HTMLTranslator):
+    '''
+    Translates css into an xpath predicate that tests a single element
+    (walking up its ancestors and siblings) instead of a path that
+    walks down the whole tree, so that many selectors can be matched
+    during one traversal of the document.
+    '''
+    def xpath_descendant_combinator(self, left, right):
+        return right.add_condition('ancestor::%s' % left)
+
+    def xpath_child_combinator(self, left, right):
+        return right.add_condition('parent::%s' % left)
+
+    def xpath_direct_adjacent_combinator(self, left, right):
+        return right.add_condition('preceding-sibling::*[1]/self::%s' % left)
+
+    def xpath_indirect_adjacent_combinator(self, left, right):
+        return right.add_condition('preceding-sibling::%s' % left)
+
+
+translator = PredicateTranslator()
+
+
+class Field(object):
+    '''
+    Declares how a single value is extracted from the DOM
+
+    Example:
+
+    class EachFabProduct(Stage):
+        fields = {
+            'name': '.prodInfoBlock h1',
+            'sale_price': Field('.fabPrice'),
+            'image': Field('img[src*=png][data-zoom]', attr='src'),
+            'labels': Field('ul.tblList .half label', many=True),
+        }
+    '''
+    readers = ('text', 'html', 'attr')
+
+    def __init__(self, selector, read=None, attr=None, many=False):
+        read = read or (attr and 'attr' or 'text')
+        if read not in self.readers:
+            raise InvalidField(
+                'cannot read {} from {}, choose one of: {}'.format(
+                    repr(read), repr(selector), ', '.join(self.readers)))
+
+        if read == 'attr' and not attr:
+            raise InvalidField(
+                'the field {} reads an attribute '
+                'but has no attr name'.format(repr(selector)))
+
+        self.selector = unicode(selector)
+        self.read = read
+        self.attr = attr
+        self.many = many
+
+    def __repr__(self):
+        return '<Field: "{}" ({}{})>'.format(
+            self.selector,
+            self.attr and 'attr ' + self.attr or self.read,
+            self.many and ', many' or '')
+
+    @classmethod
+    def coerce(cls, spec):
+        if isinstance(spec, Field):
+            return spec
+
+        return cls(spec)
+
+    def value_of(self, element):
+        if self.read == 'text':
+            return element.text and element.text.strip() or ''
+
+        if self.read == 'html':
+            return lhtml.tostring(element)
+
+        return element.get(self.attr, '')
+
+    def values_of(self, elements):
+        values = map(self.value_of, elements)
+        if self.many:
+            return values
+
+        return values and values[0] or ''
+
+
+class Extractor(object):
+    '''
+    A set of fields compiled into per-element predicates.
+
+    `extract(dom)` walks the document once, only visiting the tags
+    that some field can match, and collects the elements of every
+    field at the same time. Selectors that can't be expressed as
+    a predicate (positional pseudo-classes like :nth-child) are
+    evaluated separately with their compiled css selector.
+    '''
+    def __init__(self, fields):
+        self.fields = dict((name, Field.coerce(spec)) for name, spec in (fields or {}).items())
+        self.matchers = defaultdict(list)
+        self.standalone = []
+
+        for name, field in sorted(self.fields.items()):
+            predicates = self.compile(field.selector)
+            if predicates is None:
+                self.standalone.append(name)
+                continue
+
+            for tag, predicate in predicates:
+                self.matchers[tag].append((name, predicate))
+
+        self.tags = self.matchers.keys()
+
+    def __nonzero__(self):
+        return bool(self.fields)
+
+    @staticmethod
+    def compile(selector):
+        predicates = []
+        for parsed in parse(selector):
+            if parsed.pseudo_element:
+                return
+
+            xpath = translator.xpath(parsed.parsed_tree)
+            expression = unicode(xpath)
+            if xpath.path or 'position()' in expression or 'last()' in expression:
+                return
+
+            predicates.append((xpath.element, etree.XPath('boolean(self::%s)' % expression, extensions=EXTENSIONS)))
+
+        return predicates
+
+    def walk(self, dom):
+        if '*' in self.matchers:
+            return dom.iter(tag=etree.Element)
+
+        return dom.iter(*self.tags)
+
+    def extract(self, dom):
+        found = defaultdict(list)
+        singles = set(name for name in self.fields if not self.fields[name].many)
+        done = set(self.standalone)
+        everything = set(self.fields)
+
+        if self.matchers:
+            generic = self.matchers.get('*', [])
+            for element in self.walk(dom):
+                matched = set()
+                for name, matches in self.matchers.get(element.tag, []) + generic:
+                    if name in done or name in matched or not matches(element):
+                        continue
+
+                    matched.add(name)
+                    found[name].append(element)
+                    if name in singles:
+                        done.add(name)
+
+                if done == everything:
+                    break
+
+        for name in self.standalone:
+            found[name] = selector_cache.css(self.fields[name].selector)(dom)
+
+        return dict(
+            (name, field.values_of(found[name]))
+            for name, field in self.fields.items())
@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import math
+import uuid
+import struct
+import sqlite3
+import hashlib
+import importlib
+import threading
+import multiprocessing
+import cPickle as pickle
+from multiprocessing.sharedctypes import RawArray
+
+DEFAULT_ERROR_RATE = 0.001
+DEFAULT_TIMEOUT = 30.0
+
+# the states of a link in a durable frontier
+PENDING = 'pending'
+FETCHED = 'fetched'
+TUNED = 'tuned'
+PERSISTED = 'persisted'
+
+
+class LocalConnection(object):
+    '''
+    Opens a connection to a SQLite database in WAL mode for each
+    thread and process that calls it, and hands it back afterwards.
+
+    Example:
+
+    self.connection = LocalConnection('/var/lib/fab/crawl.db')
+    self.connection().execute('SELECT url FROM links')
+    '''
+    def __init__(self, path, timeout=DEFAULT_TIMEOUT):
+        self.path = path
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('local', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.local = threading.local()
+
+    def __call__(self):
+        local = self.local
+        if getattr(local, 'pid', None) != os.getpid():
+            # connections can't be shared with forked processes
+            local.database = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            local.database.execute('PRAGMA journal_mode=WAL')
+            local.database.execute('PRAGMA synchronous=NORMAL')
+            local.pid = os.getpid()
+
+        return local.database
+
+
+class Frontier(object):
+    '''
+    Crawl-scoped record of the urls that were already handed to
+    a stage, so that a page reachable from many places is fetched
+    only once per crawl.
+
+    Example:
+
+    Fab.visit(browser, frontier=BloomFrontier(capacity=10 ** 7))
+    '''
+    # durable frontiers outlive the crawl and keep track of the links
+    # it found, so that another one can resume it
+    durable = False
+
+    def __init__(self, seen=None, lock=None, counters=None):
+        self.seen = set() if seen is None else seen
+        self.lock = lock or threading.Lock()
+        # [unique urls, duplicated urls, urls rewritten by a canonicalizer]
+        self.counters = [0, 0, 0] if counters is None else counters
+
+    def __contains__(self, url):
+        return url in self.seen
+
+    def __len__(self):
+        return self.counters[0]
+
+    def __repr__(self):
+        return '<{}: {} urls, {} duplicates>'.format(
+            self.__class__.__name__, len(self), self.duplicates)
+
+    @property
+    def duplicates(self):
+        return self.counters[1]
+
+    @property
+    def collapsed(self):
+        return self.counters[2]
+
+    def collapse(self, count=1):
+        with self.lock:
+            self.counters[2] += count
+
+    def add(self, url, collapsed=False):
+        with self.lock:
+            if collapsed:
+                self.counters[2] += 1
+
+            if url in self.seen:
+                self.counters[1] += 1
+                return False
+
+            self.remember(url)
+            self.counters[0] += 1
+            return True
+
+    def remember(self, url):
+        self.seen.add(url)
+
+    def discover(self, url, Stage, parent):
+        pass
+
+    def mark(self, stage, state):
+        pass
+
+    def unfinished(self):
+        return []
+
+    def report(self):
+        return {
+            'frontier.urls': len(self),
+            'frontier.duplicates': self.duplicates,
+            'frontier.collapsed': self.collapsed,
+        }
+
+
+class SharedFrontier(Frontier):
+    '''
+    A Frontier whose seen urls live in a manager process, so that
+    every worker process of a crawl consults the same set.
+    '''
+    def __init__(self, manager=None):
+        if manager is None:
+            manager = multiprocessing.Manager()
+
+        self._manager = manager
+        super(SharedFrontier, self).__init__(
+            seen=manager.dict(),
+            lock=multiprocessing.Lock(),
+            counters=RawArray('L', 3),
+        )
+
+    def __getstate__(self):
+        # the manager itself can't cross process boundaries,
+        # its proxies can
+        state = self.__dict__.copy()
+        state.pop('_manager', None)
+        return state
+
+    def remember(self, url):
+        self.seen[url] = True
+
+
+class BloomFilter(object):
+    '''
+    A compact probabilistic set: it never forgets an added key
+    but might claim to contain a key that was never added, with
+    the given probability once `capacity` keys were added.
+    '''
+    def __init__(self, capacity, error_rate=DEFAULT_ERROR_RATE, make_bits=bytearray):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.size / float(capacity) * math.log(2))))
+        self.bits = make_bits((self.size + 7) // 8)
+
+    def offsets(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+
+        # double hashing: k offsets out of two 64 bits halves of one digest
+        first, second = struct.unpack('<QQ', hashlib.md5(key).digest())
+        return [(first + i * second) % self.size for i in xrange(self.hashes)]
+
+    def __contains__(self, key):
+        bits = self.bits
+        return all(bits[offset >> 3] & (1 << (offset & 7)) for offset in self.offsets(key))
+
+    def add(self, key):
+        bits = self.bits
+        for offset in self.offsets(key):
+            bits[offset >> 3] |= 1 << (offset & 7)
+
+
+class BloomFrontier(Frontier):
+    '''
+    A Frontier backed by a BloomFilter, it takes about 1.8 bytes per
+    url at 0.1% error rate, regardless of the size of the urls.
+
+    When shared, the bits are kept in shared memory so that worker
+    processes forked after its creation consult the same filter.
+    '''
+    def __init__(self, capacity, error_rate=DEFAULT_ERROR_RATE, shared=False):
+        if shared:
+            seen = BloomFilter(capacity, error_rate, make_bits=lambda size: RawArray('B', size))
+            lock = multiprocessing.Lock()
+            counters = RawArray('L', 3)
+        else:
+            seen = BloomFilter(capacity, error_rate)
+            lock = counters = None
+
+        super(BloomFrontier, self).__init__(seen=seen, lock=lock, counters=counters)
+
+
+class SQLiteFrontier(Frontier):
+    '''
+    A durable Frontier kept in a SQLite database in WAL mode. It records
+    every link found by the crawl along with the stage that handles it
+    and how far it went: pending, fetched, tuned or persisted.
+
+    A crawl that dies can be visited again with `resume=True` and the
+    same database. Persisted pages are not fetched again, and the links
+    that were left pending are handed to their stages.
+
+    When shared, its counters live in shared memory so that worker
+    processes forked after its creation report to the same ones. Every
+    thread and process opens its own connection to the database.
+
+    Example:
+
+    Fab.visit(browser, frontier=SQLiteFrontier('/var/lib/fab/crawl.db'), resume=True)
+    '''
+    durable = True
+
+    def __init__(self, path, timeout=DEFAULT_TIMEOUT, shared=False):
+        if shared:
+            lock = multiprocessing.Lock()
+            counters = RawArray('L', 3)
+        else:
+            lock = counters = None
+
+        super(SQLiteFrontier, self).__init__(seen=(), lock=lock, counters=counters)
+        self.path = path
+        # tells the links claimed by this crawl from the ones of a dead one
+        self.run = uuid.uuid4().hex
+        self.connection = LocalConnection(path, timeout)
+        self.database.execute(
+            'CREATE TABLE IF NOT EXISTS links ('
+            'url TEXT PRIMARY KEY, state TEXT NOT NULL, run TEXT, '
+            'stage_module TEXT, stage_name TEXT, parent BLOB)')
+
+    def __contains__(self, url):
+        row = self.database.execute('SELECT run, state FROM links WHERE url = ?', (url, )).fetchone()
+        return row is not None and (row[0] == self.run or row[1] == PERSISTED)
+
+    @property
+    def database(self):
+        return self.connection()
+
+    def add(self, url, collapsed=False):
+        database = self.database
+        added = database.execute(
+            'INSERT OR IGNORE INTO links (url, state, run) VALUES (?, ?, ?)',
+            (url, PENDING, self.run)).rowcount
+
+        if not added:
+            # links that a dead crawl didn't persist are visited again
+            added = database.execute(
+                'UPDATE links SET run = ? WHERE url = ? AND state != ? AND (run IS NULL OR run != ?)',
+                (self.run, url, PERSISTED, self.run)).rowcount
+
+        with self.lock:
+            if collapsed:
+                self.counters[2] += 1
+
+            if not added:
+                self.counters[1] += 1
+                return False
+
+            self.counters[0] += 1
+            return True
+
+    def discover(self, url, Stage, parent):
+        self.database.execute(
+            'INSERT OR IGNORE INTO links (url, state, stage_module, stage_name, parent) '
+            'VALUES (?, ?, ?, ?, ?)',
+            (url, PENDING, Stage.__module__, Stage.__name__,
+             sqlite3.Binary(pickle.dumps(parent, pickle.HIGHEST_PROTOCOL))))
+
+    def mark(self, stage, state):
+        self.database.execute('UPDATE links SET state = ? WHERE url = ?', (state, stage.canonical_url))
+
+    def unfinished(self):
+        rows = self.database.execute(
+            'SELECT url, stage_module, stage_name, parent FROM links '
+            'WHERE state != ? AND stage_name IS NOT NULL', (PERSISTED, )).fetchall()
+
+        for url, module_name, name, parent in rows:
+            Stage = getattr(importlib.import_module(module_name), name)
+            yield url, Stage, pickle.loads(str(parent))
+
+    def states(self):
+        return dict(self.database.execute('SELECT state, COUNT(*) FROM links GROUP BY state').fetchall())
@@ -1,6 +1,12 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import re
+import threading
+from fnmatch import fnmatchcase
+from collections import OrderedDict
+from urlparse import urlsplit, urlunsplit
+
+DEFAULT_MEMO_SIZE = 1024
 
 
 class InvalidURLMapping(Exception):
@@ -23,3 +29,214 @@ class Route(object):
                     url, self.url_regex.pattern))
 
         return self.url_mapping.format(**found.groupdict())
+
+
+class RouteTable(object):
+    '''
+    Many routes at once: the patterns of the routes are compiled into
+    a single alternation, each one tagged with a group of its own, so
+    that a url is dispatched to the mapping of the first route that
+    matches it in one search instead of one per route. A route can
+    also name the stage that handles its urls. The latest `memo_size`
+    urls are remembered along with where they were dispatched.
+
+    The flags of compiled patterns apply to the whole table, and
+    patterns can only refer back to their groups by name.
+
+    Example:
+
+    class Fab(Stage):
+        route = RouteTable([
+            ('product', r'/product/(?P<id>\d+)', 'http://fab.com/product/{id}', EachFabProduct),
+            ('sale', r'/sale/(?P<name>[\w-]+)', 'http://fab.com/sale/{name}', EachFabBrand),
+        ])
+    '''
+    re = re
+    # python 2 regexes can't have more groups than this
+    max_groups = 100
+    named_group = re.compile(r'(?<!\\)\(\?P([<=])(\w+)')
+
+    def __init__(self, routes=(), memo_size=DEFAULT_MEMO_SIZE):
+        self.routes = OrderedDict()
+        self.memo_size = memo_size
+        self.memo = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.compiled = None
+        for route in routes:
+            self.add(*route)
+
+    def __len__(self):
+        return len(self.routes)
+
+    def __repr__(self):
+        return '<{}: {}>'.format(self.__class__.__name__, ', '.join(self.routes))
+
+    def add(self, name, pattern, mapping=None, Stage=None):
+        if isinstance(pattern, basestring):
+            pattern = self.re.compile(pattern)
+
+        with self.lock:
+            self.routes[name] = (pattern, mapping, Stage)
+            self.compiled = None
+            self.memo.clear()
+
+    def compile(self):
+        # [(regex, {tag: (name, [(group, name of the group in the route)])})]
+        compiled = []
+        alternatives, tags, groups, flags = [], {}, 0, 0
+        for index, (name, (pattern, mapping, Stage)) in enumerate(self.routes.items()):
+            if alternatives and groups + pattern.groups + 1 > self.max_groups:
+                compiled.append((self.re.compile('|'.join(alternatives), flags), tags))
+                alternatives, tags, groups, flags = [], {}, 0, 0
+
+            tag = 'route{}'.format(index)
+            source = self.named_group.sub(r'(?P\1{}_\2'.format(tag), pattern.pattern)
+            # searching from the start of the url for each route in turn
+            # gives the routes precedence in the order they were added
+            alternatives.append('.*?(?P<{}>{})'.format(tag, source))
+            tags[tag] = (name, [('{}_{}'.format(tag, group), group) for group in pattern.groupindex])
+            groups += pattern.groups + 1
+            flags |= pattern.flags
+
+        if alternatives:
+            compiled.append((self.re.compile('|'.join(alternatives), flags), tags))
+
+        return compiled
+
+    def match(self, url):
+        compiled = self.compiled
+        if compiled is None:
+            compiled = self.compiled = self.compile()
+
+        for regex, tags in compiled:
+            found = regex.match(url)
+            if found:
+                # the group of the route closes last
+                name, groups = tags[found.lastgroup]
+                return name, dict((short, found.group(group)) for group, short in groups)
+
+    def lookup(self, url):
+        with self.lock:
+            if url in self.memo:
+                self.hits += 1
+                dispatched = self.memo[url] = self.memo.pop(url)
+                return dispatched
+
+            self.misses += 1
+
+        dispatched = None
+        found = self.match(url)
+        if found is not None:
+            name, groups = found
+            pattern, mapping, Stage = self.routes[name]
+            dispatched = (mapping is None and url or mapping.format(**groups), Stage)
+
+        with self.lock:
+            self.memo[url] = dispatched
+            while len(self.memo) > self.memo_size:
+                self.memo.popitem(last=False)
+
+        return dispatched
+
+    def dispatch(self, url):
+        dispatched = self.lookup(url)
+        if dispatched is None:
+            raise InvalidURLMapping(
+                'url {} does not match any of the routes {}'.format(url, ', '.join(self.routes)))
+
+        return dispatched
+
+    def translate(self, url):
+        return self.dispatch(url)[0]
+
+    def stage(self, url):
+        dispatched = self.lookup(url)
+        return dispatched and dispatched[1]
+
+    def report(self):
+        return {
+            'routes.memo_hits': self.hits,
+            'routes.memo_misses': self.misses,
+        }
+
+
+class Canonicalizer(object):
+    '''
+    Rewrites urls that point to the same page into the same string:
+    lower-cased scheme and host, no default port, no fragment, query
+    parameters sorted by name and without the ignored parameters
+    (shell-style patterns, compared case-insensitively).
+
+    Example:
+
+    class ShopStage(Stage):
+        canonicalizer = Canonicalizer(ignored_params=['utm_*', 'sessionid'])
+    '''
+    ignored_params = (
+        'utm_*',
+        'gclid',
+        'fbclid',
+        'mc_cid',
+        'mc_eid',
+    )
+    default_ports = {
+        'http': ':80',
+        'https': ':443',
+    }
+
+    def __init__(self, ignored_params=None):
+        if ignored_params is not None:
+            self.ignored_params = tuple(ignored_params)
+
+    def __call__(self, url):
+        return self.canonicalize(url)
+
+    def is_ignored(self, name):
+        name = name.lower()
+        return any(fnmatchcase(name, pattern) for pattern in self.ignored_params)
+
+    def canonicalize(self, url):
+        if not url:
+            return url
+
+        scheme, netloc, path, query, fragment = urlsplit(url)
+        scheme = scheme.lower()
+
+        userinfo, at, host = netloc.rpartition('@')
+        host = host.lower()
+        port = self.default_ports.get(scheme)
+        if port and host.endswith(port):
+            host = host[:-len(port)]
+
+        params = [param for param in query.split('&')
+                  if param and not self.is_ignored(param.split('=', 1)[0])]
+        # stable sort, repeated parameters keep their relative order
+        params.sort(key=lambda param: param.split('=', 1)[0])
+
+        return urlunsplit((scheme, userinfo + at + host, path, '&'.join(params), ''))
+
+
+class FrozenDict(dict):
+    '''
+    A dict that can't be changed once built, for data that is handed
+    around to many stages (and threads) at once.
+
+    Example:
+
+    data = FrozenDict({'brand': 'Fab'})
+    data['brand'] = 'Other'  # raises TypeError
+    '''
+    def _immutable(self, *args, **kwargs):
+        raise TypeError('{} is immutable'.format(self.__class__.__name__))
+
+    __setitem__ = __delitem__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+    def __reduce__(self):
+        # the default reduce would set the items one by one
+        return (self.__class__, (dict(self),))
+
+    def copy(self):
+        return dict(self)
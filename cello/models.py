@@ -1,12 +1,19 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import re
 import logging
+from functools import partial
 from datetime import datetime
-from urlparse import urlsplit
+from collections import Counter, namedtuple
+from urlparse import urlsplit, urljoin, urldefrag
 from lxml import html as lhtml
 
-from .helpers import Route, InvalidURLMapping
-from .storage import DummyCase
+from .helpers import Route, Canonicalizer, FrozenDict, InvalidURLMapping
+from .storage import DummyCase, is_unchanged, mark_persisted
+from .selectors import cache as selector_cache
+from .extraction import Extractor
+from .frontier import Frontier, FETCHED, TUNED, PERSISTED
+from .scheduler import Scheduler
 
 logger = logging.getLogger('cello')
 logger.setLevel(logging.INFO)
@@ -28,6 +35,10 @@ class BadTuneReturnValue(Exception):
            'an empty value: {value}')
 
 
+class CelloPersistenceError(Exception):
+    pass
+
+
 class CelloStopScraping(StopIteration):
     pass
 
@@ -36,28 +47,51 @@ class CelloJumpToNextStage(Exception):
     pass
 
 
-class Query(str):
-    def __init__(self, dom):
-        self._dom = dom
-        self._elements = []
-        self._values = []
-        self._last_query = "[Nothing queried so far]"
+class Query(object):
+    '''
+    An immutable set of elements matched by a css selector.
+
+    Every call that narrows or transforms the result (`query`,
+    `attr`) returns a new Query that shares the matched elements
+    with its origin, so results can be kept around, nested and
+    interleaved without clobbering each other.
+
+    A Query is as long as the elements it matched, so an empty one
+    is falsy, and the attributes those elements lack read as ''.
+    '''
+    __slots__ = ('_dom', '_last_query', '_elements', '_values')
+
+    def __init__(self, dom, selector="[Nothing queried so far]", elements=(), values=()):
+        set_slot = super(Query, self).__setattr__
+        set_slot('_dom', dom)
+        set_slot('_last_query', selector)
+        set_slot('_elements', elements)
+        set_slot('_values', values)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Query results are immutable, cannot set {}'.format(name))
 
     def __repr__(self):
         total = len(self._elements)
         word = total == 1 and "element" or "elements"
         return u'<Query: "{}" with {} {}>'.format(self._last_query, total, word)
 
+    def __len__(self):
+        return len(self._elements)
+
+    def __iter__(self):
+        return iter(self._elements)
+
     def query(self, selector):
         selector = unicode(selector)
-        self._last_query = selector
-        self._elements = self._dom.cssselect(selector)
-        return self
+        elements = tuple(selector_cache.css(selector)(self._dom))
+        return Query(self._dom, selector, elements)
 
     def attr(self, name=None):
-        func = lambda i: name and i.attrib.get(name, self) or dict(i.attrib)
-        self._values = map(func, self._elements)
-        return self
+        # and/or would read empty attributes as every attribute
+        func = lambda i: i.attrib.get(name, '') if name else dict(i.attrib)
+        values = tuple(map(func, self._elements))
+        return Query(self._dom, self._last_query, self._elements, values)
 
     def text(self):
         return self._one_or_many(map(lambda i: i.text and i.text.strip() or '',
@@ -88,25 +122,113 @@ class Query(str):
         return self.one(-1)
 
     def _one_or_many(self, ret):
+        if isinstance(ret, tuple):
+            # the matched elements are shared between results,
+            # callers get their own list
+            ret = list(ret)
+
         return len(ret) is 1 and ret[-1] or ret
 
 
 class DOMWrapper(object):
-    def __init__(self, dom):
+    link_schemes = ('', 'http', 'https')
+
+    def __init__(self, dom, base_url=None, canonicalize=None, collapse=None):
         self.dom = dom
+        self.base_url = base_url
+        self.canonicalize = canonicalize
+        # called with the number of links the canonicalizer rewrote
+        self.collapse = collapse
         self._query = Query(dom)
 
     def query(self, selector):
         return self._query.query(selector)
 
+    def links(self, pattern=None, selector=None):
+        if isinstance(pattern, basestring):
+            pattern = re.compile(pattern)
+
+        if selector:
+            elements = selector_cache.css(selector)(self.dom)
+        else:
+            elements = self.dom.iter('a', 'area')
+
+        seen = set()
+        links = []
+        collapsed = 0
+        for element in elements:
+            href = (element.get('href') or '').strip()
+            if not href or href.startswith('#'):
+                continue
+
+            if self.base_url:
+                href = urljoin(self.base_url, href)
+
+            link = urldefrag(href)[0]
+            if self.canonicalize:
+                link = self.canonicalize(link)
+
+            if link in seen or urlsplit(link).scheme not in self.link_schemes:
+                continue
+
+            seen.add(link)
+            if pattern is None or pattern.search(link):
+                links.append(link)
+                collapsed += self.canonicalize is not None and link != href
+
+        if collapsed and self.collapse is not None:
+            self.collapse(collapsed)
+
+        return links
+
     @classmethod
-    def from_response(cls, response):
-        return cls(lhtml.fromstring(response))
+    def from_response(cls, response, base_url=None, canonicalize=None, collapse=None):
+        return cls(lhtml.fromstring(response), base_url=base_url, canonicalize=canonicalize, collapse=collapse)
+
+
+class ParentContext(namedtuple('ParentContext', 'url base_url name data')):
+    '''
+    What a child stage needs to know about the stage that found its
+    link, small enough to travel to a worker along with every link
+    instead of the whole parent stage and its response.
+
+    `data` holds whatever the parent returns from `context_data()`,
+    frozen since every child of the parent shares it. Stages have the
+    same `data`, so children read it in the same way on every engine.
+
+    Example:
+
+    class EachFabBrand(Stage):
+        def context_data(self):
+            return {'brand': self.dom.query('h1').text()}
+
+    class EachFabProduct(Stage):
+        def tune(self):
+            return {'brand': self.parent.data['brand']}
+    '''
+    __slots__ = ()
+
+    def __new__(cls, url, base_url, name, data):
+        return super(ParentContext, cls).__new__(cls, url, base_url, name, FrozenDict(data or {}))
+
+    @classmethod
+    def from_stage(cls, stage):
+        if stage is None or isinstance(stage, cls):
+            return stage
+
+        url = stage.url
+        base_url = None
+        if url:
+            result = stage.url_parts
+            base_url = '{}://{}'.format(result.scheme, result.netloc)
+
+        return cls(url, base_url, stage.name, stage.context_data())
 
 
 class StagePrecedenceRegistry(type):
     def __init__(cls, name, bases, attrs):
         super(StagePrecedenceRegistry, cls).__init__(name, bases, attrs)
+        cls._extractor = Extractor(getattr(cls, 'fields', None))
 
         if 'cello.' in cls.__module__:
             return
@@ -118,18 +240,48 @@ class StagePrecedenceRegistry(type):
 
 class Stage(object):
     route = Route
+    canonicalizer = Canonicalizer()
     case = DummyCase
     next_stage = None
+    fields = None
+    cache = None
+    index = None
+    fingerprints = None
     __metaclass__ = StagePrecedenceRegistry
 
-    def __init__(self, browser, url=None, response=None, parent=None):
+    def __init__(self, browser, url=None, response=None, parent=None, frontier=None, buffer=None,
+                 scheduler=None):
         self.browser = browser
+        self.frontier = frontier if frontier is not None else Frontier()
+        self.scheduler = scheduler if scheduler is not None else Scheduler()
+        self.buffer = buffer
+        self.stats = Counter()
         self._url = url
+        self._resolved = None
         self.response = response
+        self.unchanged = False
+        # what the content index remembers of the page once it is persisted
+        self.indexed = None
         self.parent = parent
         self.name = '.'.join([self.__class__.__module__, self.__class__.__name__])
         self.debug = DEBUG
 
+    @property
+    def response(self):
+        return self._response
+
+    @response.setter
+    def response(self, response):
+        # a new response means a new page, the parsed DOM of the
+        # previous one must not leak into it
+        self._response = response
+        self._dom = None
+
+    @property
+    def not_modified(self):
+        # unchanged pages that weren't even downloaded
+        return self.unchanged and self.response is None
+
     @property
     def dom(self):
         if self.response is None:
@@ -138,10 +290,43 @@ class Stage(object):
                 "and so its DOM can't be queryed" % self.name
             )
 
-        return DOMWrapper.from_response(self.response.content)
+        if self._dom is None:
+            self._dom = DOMWrapper.from_response(
+                self.response.content,
+                base_url=self.url,
+                canonicalize=self.canonicalizer,
+                # the links come out canonical, so the frontier
+                # can't tell which ones were rewritten
+                collapse=self.frontier.collapse,
+            )
+            self.stats['dom.parsed'] += 1
+
+        return self._dom
 
     @property
     def url(self):
+        # resolved once, until the url or the parent of the stage change
+        resolved = self._resolved
+        if resolved is not None and resolved[0] is self._url and resolved[1] is self.parent:
+            self.stats['url.cached'] += 1
+            return resolved[2]
+
+        url = self.resolve_url()
+        self.stats['url.resolved'] += 1
+        self._resolved = (self._url, self.parent, url, url and urlsplit(url))
+        return url
+
+    @property
+    def url_parts(self):
+        url = self.url
+        resolved = self._resolved
+        if resolved is not None and resolved[2] is url:
+            return resolved[3]
+
+        # stages with a fixed url don't resolve it
+        return urlsplit(url)
+
+    def resolve_url(self):
         if not self._url:
             return self._url
 
@@ -164,34 +349,77 @@ class Stage(object):
             else:
                 return url
 
+    @property
+    def canonical_url(self):
+        return self.canonicalizer(self.url)
+
     def absolute_url(self, path):
-        result = urlsplit(self.url)
+        result = self.url_parts
         return '{}://{}{}'.format(result.scheme, result.netloc, path)
 
+    def context_data(self):
+        return {}
+
+    @property
+    def data(self):
+        return FrozenDict(self.context_data() or {})
+
     def get_fallback_url(self):
         if not self.parent:
             raise InvalidURLMapping(
                 ('The stage %s has no parent to grab a base '
                 'url from to add to %s') % (self.name, self._url))
 
-        result = urlsplit(self.parent.url)
+        parent = self.parent
+        if isinstance(parent, ParentContext):
+            return parent.base_url + self._url
+
+        result = parent.url_parts
         return '{}://{}{}'.format(result.scheme, result.netloc, self._url)
 
     def fetch(self):
         if not self.url:
             raise ValueError('Try to call {}.fetch with no url'.format(self.name))
 
-        self.response = self.get_response(self.url)
+        url = self.canonical_url
+        if self.index is None:
+            self.response = self.download(url)
+        else:
+            self.response, self.unchanged, self.indexed = self.index.fetch(
+                url, self.download, partial(self.scheduler.request, self.get_conditional_response))
 
+        self.frontier.mark(self, FETCHED)
         return self
 
+    def download(self, url):
+        if self.cache is None:
+            return self.scheduler.request(self.get_response, url)
+
+        # cache hits don't wait for the scheduler, only actual requests do
+        return self.cache.fetch(
+            url,
+            partial(self.scheduler.request, self.get_response),
+            partial(self.scheduler.request, self.get_conditional_response))
+
+    def get_conditional_response(self, url, headers):
+        # fetchers that can send request headers should override this
+        # to revalidate stale cached responses with them
+        return self.get_response(url)
+
     def get_response(self, url):
         return self.browser.get(
-            self.url,
+            url,
             config=dict(screenshot=self.debug),
         )
 
-    def get_next_stage(self):
+    def get_next_stage(self, link=None):
+        # routes of a RouteTable can name the stage of their links
+        routed = getattr(self.route, 'stage', None)
+        if link is not None and routed is not None:
+            Stage = routed(link)
+            if Stage is not None:
+                return Stage
+
         if self.next_stage:
             Stage = self.next_stage
         else:
@@ -200,11 +428,19 @@ class Stage(object):
         return Stage
 
     def proceed_to_next(self, link, using_response=None):
-        NextStage = self.get_next_stage()
+        NextStage = self.get_next_stage(link)
 
         if self.next_stage:
-            stage = NextStage(self.browser, url=link, parent=self, response=using_response)
+            stage = NextStage(self.browser, url=link, parent=self, response=using_response,
+                              frontier=self.frontier, buffer=self.buffer, scheduler=self.scheduler)
+            self.discover(stage)
+            if stage.already_visited():
+                return
+
             stage.fetch()
+            if stage.not_modified:
+                return stage
+
             try:
                 stage.play()
             except CelloJumpToNextStage:
@@ -212,17 +448,42 @@ class Stage(object):
                 return stage
 
         else:
-            stage = NextStage(self.browser, url=link, parent=self.parent, response=using_response)
+            stage = NextStage(self.browser, url=link, parent=self.parent, response=using_response,
+                              frontier=self.frontier, buffer=self.buffer, scheduler=self.scheduler)
+            self.discover(stage)
+            if stage.already_visited():
+                return
+
             stage.fetch()
 
         return stage
 
+    def discover(self, stage):
+        # durable frontiers remember every link, so that a crawl can be resumed
+        if self.frontier.durable:
+            self.frontier.discover(stage.canonical_url, stage.__class__, ParentContext.from_stage(stage.parent))
+
+    def already_visited(self):
+        url = self.canonical_url
+        if self.frontier.add(url, collapsed=url != self.url):
+            return False
+
+        logger.info("Skipping %s, it was already visited during this crawl", self.url)
+        return True
+
     def scrape(self, links, using_response=None):
         if isinstance(links, basestring):
             links = [links]
 
         for link in links:
             stage = self.proceed_to_next(link, using_response=using_response)
+            if stage is None:
+                continue
+
+            if stage.unchanged:
+                # same page as in the previous crawl, and so same data
+                self.frontier.mark(stage, PERSISTED)
+                continue
 
             try:
                 data = stage.tune()
@@ -239,13 +500,21 @@ class Stage(object):
                     )
                 )
 
+            self.frontier.mark(stage, TUNED)
             stage.persist(data)
 
+    def extract(self):
+        return self._extractor.extract(self.dom.dom)
+
     def tune(self):
-        return {
+        data = {
             'datetime': datetime.now().isoformat(),
             'stage': self.name,
         }
+        if self._extractor:
+            data.update(self.extract())
+
+        return data
 
     def persist(self, data):
         final = {
@@ -254,8 +523,17 @@ class Stage(object):
         payload = data or {}
         final.update(payload)
 
+        if is_unchanged(self, final):
+            mark_persisted(self)
+            return
+
+        if self.buffer is not None:
+            return self.buffer.add(self.case, self, final)
+
         storage = self.case(self)
-        return storage.save(final)
+        saved = storage.save(final)
+        mark_persisted(self)
+        return saved
 
     def play(self):
         self.proceed_to_next(self.url)
@@ -263,14 +541,83 @@ class Stage(object):
         return self.persist(data)
 
     @classmethod
-    def visit(Stage, browser, *args, **kw):
-        name = Stage.__name__
+    def reachable(Stage, name):
+        # the `name` attributes of this stage and of the ones that follow it,
+        # like their content indexes
+        seen, found = set(), []
+        while Stage is not None and Stage not in seen:
+            seen.add(Stage)
+            value = getattr(Stage, name, None)
+            if value is not None and value not in found:
+                found.append(value)
+            Stage = Stage.next_stage
+
+        return found
+
+    @classmethod
+    def check_url(Stage):
         if not isinstance(Stage.url, basestring):
             raise InvalidStateError(
-                'Trying to download content for %s but it has no URL' % name)
+                'Trying to download content for %s but it has no URL' % Stage.__name__)
+
+    @classmethod
+    def check_resume(Stage, resume, frontier):
+        if resume and not (frontier is not None and frontier.durable):
+            raise InvalidStateError(
+                'Cannot resume a crawl of %s without a durable frontier, '
+                'try frontier=SQLiteFrontier(path)' % Stage.__name__)
+
+    def report(self):
+        '''
+        The counters of the crawl started by this stage: its own stats
+        along with the reports of its frontier, scheduler and buffer and
+        of the caches, content indexes, fingerprint stores and route
+        tables of the stages that follow it.
+
+        Example:
+
+        stats = Fab.visit(Browser())
+        stats['cache.hit_ratio'], stats['incremental.skipped']
+        '''
+        stats = Counter(self.stats)
+        reporters = [self.frontier, self.scheduler, self.buffer]
+        for name in ('cache', 'index', 'fingerprints', 'route'):
+            reporters.extend(self.reachable(name))
+
+        for reporter in reporters:
+            report = getattr(reporter, 'report', None)
+            # a plain Route class has nothing to report
+            if report is not None and not isinstance(reporter, type):
+                stats.update(report())
+
+        return stats
+
+    def conclude(self, stopped=None):
+        # what visit() returns: the counters of the crawl, or the
+        # CelloStopScraping that ended it along with them
+        stats = self.report()
+        if stopped is None:
+            return stats
+
+        stopped.stats = stats
+        return stopped
 
+    @classmethod
+    def visit(Stage, browser, *args, **kw):
+        Stage.check_url()
+
+        # walking from the root page again finds every unfinished link,
+        # the pages that were persisted are skipped
+        Stage.check_resume(kw.pop('resume', False), kw.get('frontier'))
+
+        stage = Stage(browser, *args, **kw)
+        stopped = None
         try:
-            stage = Stage(browser, *args, **kw)
             stage.play()
         except CelloStopScraping as e:
-            return e
+            stopped = e
+        finally:
+            if kw.get('buffer') is not None:
+                kw['buffer'].flush()
+
+        return stage.conclude(stopped)
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import gevent
+from gevent.pool import Group
+from gevent.lock import BoundedSemaphore
+
+from cello.scheduler import Scheduler
+from cello.frontier import TUNED, PERSISTED
+from cello.models import (
+    Stage,
+    logger,
+    BadTuneReturnValue,
+    CelloStopScraping,
+    CelloJumpToNextStage,
+)
+
+DEFAULT_CONCURRENCY = 100
+
+
+class AsyncCrawl(object):
+    '''
+    Keeps track of the greenlets of a crawl and of how many
+    requests are in flight at any given time.
+
+    A failure in any greenlet stops the whole crawl and is
+    raised again by `wait()`, as is the reason given to `stop()`.
+    '''
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY):
+        self.concurrency = concurrency
+        self.slots = BoundedSemaphore(concurrency)
+        self.group = Group()
+        self.error = None
+
+    @property
+    def in_flight(self):
+        return self.concurrency - self.slots.counter
+
+    def spawn(self, function, *args, **kw):
+        return self.group.spawn(self.run, function, *args, **kw)
+
+    def run(self, function, *args, **kw):
+        try:
+            return function(*args, **kw)
+        except Exception as e:
+            # reported by wait(), gevent would print a traceback
+            # for every greenlet that failed
+            self.stop(e)
+
+    def stop(self, reason):
+        if self.error is None:
+            self.error = reason
+
+        self.group.kill(block=False)
+
+    def wait(self):
+        self.group.join()
+        if self.error is not None:
+            raise self.error
+
+
+class AsyncStage(Stage):
+    '''
+    A Stage that fetches its links concurrently from a single process,
+    running each link in a greenlet.
+
+    `browser_factory()` must return a fetcher whose `get(url)`
+    cooperates with gevent while waiting for the network, for example
+    `requests` after `gevent.monkey.patch_all()`. No more than
+    `concurrency` fetches are in flight at once across the crawl.
+    A scheduler given to `visit()` should wait with `gevent.sleep`.
+    '''
+    def __init__(self, browser_factory, url=None, response=None,
+                 parent=None, frontier=None, crawl=None, buffer=None, scheduler=None):
+        self.browser_factory = browser_factory
+        self.crawl = crawl or AsyncCrawl()
+        super(AsyncStage, self).__init__(
+            None, url=url, response=response, parent=parent, frontier=frontier, buffer=buffer,
+            scheduler=scheduler)
+
+    def get_response(self, url):
+        with self.crawl.slots:
+            return self.browser_factory().get(url)
+
+    def proceed_to_next(self, link, using_response=None):
+        NextStage = self.get_next_stage(link)
+        if self.next_stage:
+            parent = self
+        else:
+            parent = self.parent
+
+        stage = NextStage(self.browser_factory,
+                          url=link,
+                          parent=parent,
+                          response=using_response,
+                          frontier=self.frontier,
+                          buffer=self.buffer,
+                          scheduler=self.scheduler,
+                          crawl=self.crawl)
+        self.discover(stage)
+
+        return self.crawl.spawn(self.advance, stage, bool(self.next_stage))
+
+    def advance(self, stage, play=True):
+        if stage.already_visited():
+            return
+
+        stage.fetch()
+        if play and not stage.not_modified:
+            try:
+                stage.play()
+            except CelloJumpToNextStage:
+                logger.warning("Jumping to next stage %s when calling .play() for url %s", repr(stage), stage.url)
+
+        if stage.unchanged:
+            # same page as in the previous crawl, and so same data
+            self.frontier.mark(stage, PERSISTED)
+            return
+
+        try:
+            data = stage.tune()
+        except CelloJumpToNextStage:
+            logger.warning("Jumping to next stage %s when calling .tune() for url %s", stage.name, stage.url)
+            return
+
+        if not data:
+            raise BadTuneReturnValue(
+                BadTuneReturnValue.msg.format(
+                    name=self.name,
+                    url=stage.url,
+                    value=repr(data),
+                )
+            )
+
+        self.frontier.mark(stage, TUNED)
+        stage.persist(data)
+
+    def resume(self):
+        for url, NextStage, parent in self.frontier.unfinished():
+            stage = NextStage(self.browser_factory,
+                              url=url,
+                              parent=parent,
+                              frontier=self.frontier,
+                              buffer=self.buffer,
+                              scheduler=self.scheduler,
+                              crawl=self.crawl)
+            # links to a stage of another class came from a next_stage
+            self.crawl.spawn(self.advance, stage, parent is None or parent.name != stage.name)
+
+    def scrape(self, links, using_response=None):
+        if isinstance(links, basestring):
+            links = [links]
+
+        for link in links:
+            self.proceed_to_next(link, using_response=using_response)
+
+    @classmethod
+    def visit(Stage, browser_factory, concurrency=DEFAULT_CONCURRENCY, resume=False, *args, **kw):
+        Stage.check_url()
+        Stage.check_resume(resume, kw.get('frontier'))
+        crawl = kw['crawl'] = AsyncCrawl(concurrency)
+        if kw.get('scheduler') is None:
+            # throttled greenlets must let the others run while they wait
+            kw['scheduler'] = Scheduler(sleep=gevent.sleep)
+
+        stage = Stage(browser_factory, *args, **kw)
+        crawl.spawn(stage.play)
+        if resume:
+            # the links that a dead crawl found but didn't persist
+            stage.resume()
+
+        stopped = None
+        try:
+            crawl.wait()
+        except CelloStopScraping as e:
+            stopped = e
+        finally:
+            # links keep being persisted after the root stage returns
+            if kw.get('buffer') is not None:
+                kw['buffer'].flush()
+
+        # the counters are complete once every greenlet is done
+        return stage.conclude(stopped)
@@ -1,19 +1,25 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-import os
 import sys
-import json
+import time
 import couleur
-import importlib
+import itertools
 
+from Queue import Empty, Full
+from collections import deque
 from datetime import datetime
 from cello import models
-from cello.models import Stage
-from cello.multi.workers import persist_async, fetch_async
+from cello.models import Stage, ParentContext, CelloStopScraping
+from cello.frontier import Frontier
+from cello.scheduler import Scheduler
+from cello.storage import DEFAULT_BATCH_SIZE, DEFAULT_WRITER_QUEUE_SIZE
+from cello.multi.workers import work, persist_batches, fetch_async
+from cello.multi.browsers import BrowserPool
 from multiprocessing import cpu_count
 
 
 DEFAULT_MAX_WORKERS = cpu_count()
+DEFAULT_MAX_TASKS_PER_CHILD = 100
 
 
 class WorkerLogger(object):
@@ -23,17 +29,17 @@ class WorkerLogger(object):
     def log_prefix(self):
         self.sh.bold_white("[{0}] <~ ".format(datetime.now()))
 
-    def process_await(self, function_name, pid):
+    def worker_started(self, worker_name, pid):
         self.log_prefix()
-        self.sh.magenta(
-            "Worker {0} (PID {1}) is waiting "
-            "for a slot in the queue\n".format(function_name, pid))
+        self.sh.bold_yellow(
+            "Worker {0} (PID {1}) is ready to run tasks\n"
+            .format(worker_name, pid))
 
-    def permission_to_run(self, function_name, pid):
+    def worker_died(self, worker_name, pid, exitcode):
         self.log_prefix()
-        self.sh.bold_yellow(
-            "Worker {0} (PID {1}) has permission to run now \n"
-            .format(function_name, pid))
+        self.sh.bold_red(
+            "Worker {0} (PID {1}) died with exit code {2}\n"
+            .format(worker_name, pid, exitcode))
 
     def process_done(self, function_name, pid):
         self.log_prefix()
@@ -42,152 +48,472 @@ class WorkerLogger(object):
             "process id {1} will exit now\n".format(function_name, pid))
 
 
-class BaseWorkerQueue(object):
-    def __init__(self, max_workers, output):
-        self.q = self.make_queue(int(max_workers))
-        self.max_workers = max_workers
+class BaseWorkerPool(object):
+    '''
+    A fixed number of long-lived workers consuming (function, kwargs)
+    tasks from a shared queue and sending their outcome back through
+    a results queue.
+
+    Workers are recycled after `max_tasks_per_child` tasks, to bound
+    the memory that lxml and browsers accumulate, and replaced if
+    they die.
+
+    No more than `max_queued` tasks wait for a worker at any given
+    time, `submit()` blocks until there is room for another one.
+
+    Messages cross the queues as they are unless the pool has a
+    `serializer`, an object with `dumps()` and `loads()`.
+    '''
+    Process = None
+    serializer = None
+    poll_interval = 0.1
+    # workers that don't share the memory of the pool count browsers
+    # in shared memory
+    shared = False
+
+    def __init__(self, max_workers, max_tasks_per_child=None, output=None, context=None,
+                 max_queued=None, serializer=None):
+        self.max_workers = int(max_workers)
+        self.max_tasks_per_child = max_tasks_per_child
+        self.max_queued = max_queued or self.max_workers * 2
+        self.serializer = serializer or self.serializer
+        self.context = dict(context or {})
+        # every worker reuses its own browser across the pages it fetches
+        browser_factory = self.context.get('browser_factory')
+        if browser_factory is not None and not isinstance(browser_factory, BrowserPool):
+            self.context['browser_factory'] = BrowserPool(browser_factory, shared=self.shared)
         self.log = WorkerLogger(output)
+        self.tasks = self.make_queue(self.max_queued)
+        self.results = self.make_queue()
+        # results read while waiting for room in the tasks queue
+        self.received = deque()
+        self.current = self.make_slots(self.max_workers)
+        self.workers = [None] * self.max_workers
+        self.pending = set()
+        self.task_ids = itertools.count(1)
+        self.dropped = 0
+
+    def make_queue(self, maxsize=0):
+        raise NotImplementedError
 
-    def make_queue(self, max_workers):
+    def make_slots(self, size):
         raise NotImplementedError
 
-    def close(self):
-        self.q.close()
-        self.q.join_thread()
+    def encode(self, message):
+        if self.serializer is None:
+            return message
+
+        return self.serializer.dumps(message)
+
+    def decode(self, message):
+        if self.serializer is None:
+            return message
+
+        return self.serializer.loads(message)
+
+    def start(self):
+        for index in range(self.max_workers):
+            self.start_worker(index)
+
+    def start_worker(self, index):
+        worker = self.Process(
+            target=work,
+            name='cello-worker-{0}'.format(index),
+            args=(self.tasks, self.results, self.current, index),
+            kwargs=dict(
+                context=self.context,
+                max_tasks=self.max_tasks_per_child,
+                serializer=self.serializer,
+            ))
+        worker.daemon = True
+        worker.start()
+        self.workers[index] = worker
+        self.log.worker_started(worker.name, getattr(worker, 'pid', None))
+        return worker
+
+    def supervise(self):
+        for index, worker in enumerate(self.workers):
+            if worker is None or worker.is_alive():
+                continue
+
+            pid = getattr(worker, 'pid', None)
+            exitcode = getattr(worker, 'exitcode', 0)
+            if exitcode:
+                self.log.worker_died(worker.name, pid, exitcode)
+                # the task it was running will never report back
+                self.pending.discard(self.current[index])
+                self.current[index] = 0
+            else:
+                self.log.process_done(worker.name, pid)
+
+            self.workers[index] = None
+            if self.pending:
+                self.start_worker(index)
+
+    def submit(self, function, **kwargs):
+        task_id = next(self.task_ids)
+        message = self.encode((task_id, function, kwargs))
+        while True:
+            try:
+                self.tasks.put(message, timeout=self.poll_interval)
+                break
+            except Full:
+                # keep replacing retired workers while waiting for room, and
+                # keep reading results: a retiring worker can't exit until
+                # the results it sent are out of the pipe
+                self.supervise()
+                self.receive()
+
+        self.pending.add(task_id)
+        return task_id
+
+    def receive(self):
+        while True:
+            try:
+                self.received.append(self.results.get_nowait())
+            except Empty:
+                return
+
+    def next_result(self, timeout=None):
+        self.supervise()
+        if self.received:
+            message = self.received.popleft()
+        else:
+            try:
+                message = self.results.get(timeout=min(timeout or self.poll_interval, self.poll_interval))
+            except Empty:
+                return
+
+        task_id, result, tasks = self.decode(message)
+        self.pending.discard(task_id)
+        if tasks is None:
+            self.dropped += 1
+            tasks = []
+
+        return task_id, result, tasks
+
+    def report(self):
+        return {
+            'results.dropped': self.dropped,
+        }
+
+    def discard_queued(self):
+        while True:
+            try:
+                self.tasks.get_nowait()
+            except Empty:
+                return
+
+    def stop(self):
+        # the tasks no worker took are dropped to make room for the
+        # sentinels, retired workers that were not replaced need none
+        self.discard_queued()
+        for worker in self.workers:
+            if worker is None or not worker.is_alive():
+                continue
+
+            try:
+                self.tasks.put_nowait(None)
+            except Full:
+                # the ones left are terminated or, being daemons, left behind
+                break
+
+        for worker in self.workers:
+            if worker is None:
+                continue
+
+            worker.join(self.poll_interval)
+            terminate = getattr(worker, 'terminate', None)
+            if worker.is_alive() and terminate:
+                terminate()
+
+
+class BasePersistencePool(object):
+    '''
+    Long-lived workers that save the tuned items of a crawl in batches,
+    apart from the workers that fetch pages. Items are sharded by Case
+    class, so that each Case is always saved by the same worker.
+    '''
+    Process = None
+    poll_interval = 0.1
 
-    def work_done(self):
-        data = self.q.get(block=True, timeout=None)
+    def __init__(self, workers=1, batch_size=DEFAULT_BATCH_SIZE,
+                 maxsize=DEFAULT_WRITER_QUEUE_SIZE, context=None):
+        self.batch_size = batch_size
+        self.context = context or {}
+        self.queues = [self.make_queue(maxsize) for index in range(int(workers))]
+        self.errors = self.make_queue()
+        self.workers = []
 
-        self.log.process_done(
-            function_name=data['function'],
-            pid=data['pid'],
-        )
+    def make_queue(self, maxsize=0):
+        raise NotImplementedError
+
+    def start(self):
+        for index, items in enumerate(self.queues):
+            worker = self.Process(
+                target=persist_batches,
+                name='cello-persistence-{0}'.format(index),
+                args=(items, self.errors),
+                kwargs=dict(batch_size=self.batch_size, context=self.context))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def put(self, stage_module, stage_name, case_module_name, case_name, url, data, indexed=None):
+        shard = hash((case_module_name, case_name)) % len(self.queues)
+        self.queues[shard].put((stage_module, stage_name, case_module_name, case_name, url, data, indexed))
+
+    def drain(self, timeout=None):
+        errors = []
+        try:
+            errors.append(self.errors.get(timeout=timeout) if timeout else self.errors.get_nowait())
+            while True:
+                errors.append(self.errors.get_nowait())
+        except Empty:
+            return errors
 
-    def wait_for_slot(self, function_name, module_name):
-        PID = os.getpid()
+    def close(self):
+        # the workers save what they still hold before exiting, their
+        # errors keep being collected meanwhile so that none of them
+        # blocks on a full pipe
+        for items in self.queues:
+            items.put(None)
 
-        self.log.process_await(function_name, PID)
+        errors = []
+        while any(worker.is_alive() for worker in self.workers):
+            errors.extend(self.drain(self.poll_interval))
 
-        self.q.put({
-            'function': function_name,
-            'module_name': module_name,
-            'pid': PID}, block=True, timeout=None)
+        self.workers = []
+        return errors + self.drain()
 
-        self.log.permission_to_run(function_name, PID)
+    def stop(self):
+        for worker in self.workers:
+            terminate = getattr(worker, 'terminate', None)
+            if worker.is_alive() and terminate:
+                terminate()
 
 
 class BaseMultiProcessStage(Stage):
     case = None
+    # recycling workers only pays off when they are processes
+    max_tasks_per_child = None
 
-    WorkerQueue = None
-    Queue = None
-    Process = None
+    WorkerPool = None
+    PersistencePool = None
+    Frontier = Frontier
 
-    def __init__(self, browser_factory, worker_queue,
-                 url=None, parent_response=None, queue=None, *args, **kw):
+    def __init__(self, browser_factory, url=None, parent_response=None,
+                 tasks=None, pool=None, persistence=None, *args, **kw):
 
         self.browser_factory = browser_factory
         self.parent_response = parent_response
-        self.worker_queue = worker_queue
-        self.queue = queue or worker_queue.make_queue(DEFAULT_MAX_WORKERS)
+        self.tasks = tasks if tasks is not None else []
+        self.pool = pool
+        self.persistence = persistence
+        self._context = None
 
         super(BaseMultiProcessStage, self).__init__(None, url=url, *args, **kw)
 
+    def __getstate__(self):
+        # parsed lxml trees can't be pickled and the browser factory,
+        # frontier and pending tasks belong to the process that owns them
+        state = self.__dict__.copy()
+        state.update(_dom=None, browser_factory=None, frontier=None, tasks=[], pool=None,
+                     persistence=None, scheduler=None)
+        return state
+
+    @property
+    def context(self):
+        # built once per page and shared by the tasks of all its links
+        if self._context is None:
+            self._context = ParentContext.from_stage(self)
+
+        return self._context
+
     def get_response(self, url):
         http = self.browser_factory()
-        return http.get(url)
+        try:
+            return http.get(url)
+        except Exception:
+            discard = getattr(self.browser_factory, 'discard', None)
+            if discard is not None:
+                discard(http)
+            raise
 
     def proceed_to_next(self, link, using_response=None):
-        Stage = self.get_next_stage()
+        Stage = self.get_next_stage(link)
         if Stage == self.__class__:
-            parent = self.parent
+            parent = ParentContext.from_stage(self.parent)
         else:
-            parent = self
-
-        return self.Process(target=fetch_async,
-                            name=link,
-                            args=(Stage, self.browser_factory),
-                            kwargs=dict(
-                                url=link,
-                                parent=parent,
-                                parent_response=using_response,
-                                queue=self.queue,
-                                worker_queue=self.worker_queue))
+            parent = self.context
+
+        if self.frontier is not None and self.frontier.durable:
+            self.discover(Stage(None, url=link, parent=parent, frontier=self.frontier, scheduler=self.scheduler))
+
+        return fetch_async, dict(
+            Stage=Stage,
+            url=link,
+            parent=parent,
+            parent_response=using_response,
+        )
 
     def scrape(self, links, using_response=None):
         if isinstance(links, basestring):
             links = [links]
 
         for link in links:
-            worker = self.proceed_to_next(link, using_response)
-            self.worker_queue.wait_for_slot('fetch_async("{0}")'.format(worker.name), self.__class__.__module__)
-            worker.start()
-
-        self.consume_queue()
+            self.tasks.append(self.proceed_to_next(link, using_response))
 
-    def make_children_stage(self, StageClass):
-        return StageClass(
-            self.browser_factory,
-            self.worker_queue,
-            parent=self,
-            parent_response=self.parent_response,
-            queue=self.queue,
-        )
+    def resume(self):
+        for url, Stage, parent in self.frontier.unfinished():
+            self.tasks.append((fetch_async, dict(Stage=Stage, url=url, parent=parent, parent_response=None)))
 
-    @classmethod
-    def import_stage(cls, module_name, stage_name):
-        stage_module = importlib.import_module(module_name)
-        return getattr(stage_module, stage_name)
+    def raise_reported(self, error):
+        name, args = error
+        ExceptionClass = getattr(models, name)
+        raise ExceptionClass(*args)
 
-    def persist_next_queued_item(self):
-        raw = self.queue.get()
-        data = json.loads(raw)
+    def persist_next_queued_item(self, data):
+        if not data:
+            return
 
-        is_error = isinstance(data, list)
+        is_error = isinstance(data, (list, tuple))
         if is_error:
-            name, args = data
-            ExceptionClass = getattr(models, name)
-            raise ExceptionClass(*args)
+            self.raise_reported(data)
 
         if 'case.module' in data and 'case.name' in data:
-            stage_module_name = data.pop('stage.module')
-            stage_name = data.pop('stage.name')
-
-            Stage = self.import_stage(stage_module_name, stage_name)
-            stage = self.make_children_stage(Stage)
-
-            p = self.Process(
-                target=persist_async,
-                kwargs={
-                    "stage": stage,
-                    "worker_queue": self.worker_queue,
-                    "results_queue": self.queue,
-                    "case_module_name": data.pop('case.module'),
-                    "case_name": data.pop('case.name'),
-                    "data": data})
-            self.worker_queue.wait_for_slot('persist_async', self.__class__.__module__)
-            p.start()
+            self.persistence.put(
+                stage_module=data.pop('stage.module'),
+                stage_name=data.pop('stage.name'),
+                case_module_name=data.pop('case.module'),
+                case_name=data.pop('case.name'),
+                url=data.pop('stage.url', None),
+                indexed=data.pop('stage.indexed', None),
+                data=data,
+            )
+
+    def schedule(self, function, kwargs):
+        parent = kwargs.get('parent')
+        host = self.scheduler.host(kwargs['url'], parent and parent.base_url)
+        self.scheduler.push(host, (function, kwargs))
+
+    def feed_back(self, host, latency, data):
+        # only fetches tell anything about the host, a failed one has no result
+        if data is None:
+            self.scheduler.record(host, latency, failed=True)
+        elif isinstance(data, dict) and 'fetch.status' in data:
+            status = data.pop('fetch.status')
+            self.scheduler.record(host, latency, failed=isinstance(status, int) and status >= 500)
 
     def consume_queue(self):
-        while not self.queue.empty():
-            self.persist_next_queued_item()
+        # the host and start of every task in flight, until its result comes back
+        running = {}
+        while True:
+            tasks, self.tasks = self.tasks, []
+            for function, kwargs in tasks:
+                self.schedule(function, kwargs)
+
+            while True:
+                ready = self.scheduler.pop()
+                if ready is None:
+                    break
+
+                host, (function, kwargs) = ready
+                running[self.pool.submit(function, **kwargs)] = host, time.time()
+
+            if not self.pool.pending:
+                if not len(self.scheduler):
+                    break
+
+                # every queued host is throttled and there is nothing to wait for
+                self.scheduler.wait(self.scheduler.next_ready())
+                continue
+
+            # wake up in time for the next throttled host
+            result = self.pool.next_result(timeout=self.scheduler.next_ready())
+            task_id, data, tasks = result or (None, None, [])
+            for finished in [finished for finished in running if finished not in self.pool.pending]:
+                host, started = running.pop(finished)
+                # the tasks of workers that died never report back
+                self.feed_back(host, time.time() - started, data if finished == task_id else None)
+                self.scheduler.release(host)
+
+            if result is None:
+                continue
+
+            self.tasks.extend(tasks)
+            self.persist_next_queued_item(data)
+            for error in self.persistence.drain():
+                self.raise_reported(error)
+
+        # every item is saved once the persistence workers are closed
+        for error in self.persistence.close():
+            self.raise_reported(error)
+
+    def report(self):
+        stats = super(BaseMultiProcessStage, self).report()
+        if self.pool is not None:
+            stats.update(self.pool.report())
+            browsers = self.pool.context.get('browser_factory')
+            if isinstance(browsers, BrowserPool):
+                stats.update(browsers.report())
+
+        return stats
 
     @classmethod
     def visit(Stage, browser_factory,
-              max_workers=DEFAULT_MAX_WORKERS, output=None, *args, **kw):
+              max_workers=DEFAULT_MAX_WORKERS,
+              max_tasks_per_child=None,
+              max_queued=None, serializer=None, output=None,
+              persist_workers=1, persist_batch_size=DEFAULT_BATCH_SIZE, resume=False, *args, **kw):
+
+        Stage.check_url()
+        Stage.check_resume(resume, kw.get('frontier'))
+
+        if max_tasks_per_child is None:
+            max_tasks_per_child = Stage.max_tasks_per_child
+
+        if kw.get('frontier') is None:
+            kw['frontier'] = Stage.Frontier()
+
+        if kw.get('scheduler') is None:
+            kw['scheduler'] = Scheduler()
+
+        pool = Stage.WorkerPool(
+            max_workers,
+            max_tasks_per_child=max_tasks_per_child,
+            max_queued=max_queued,
+            serializer=serializer,
+            output=output or sys.stdout,
+            context=dict(browser_factory=browser_factory, frontier=kw['frontier']),
+        )
+        kw['pool'] = pool
 
-        worker_queue = Stage.WorkerQueue(max_workers, output=output or sys.stdout)
-        waits = [worker_queue.wait_for_slot('preparing worker {0} for {1}'.format(x, Stage.__name__), Stage.__module__) for x in range(1, max_workers)]
+        persistence = kw['persistence'] = Stage.PersistencePool(
+            persist_workers,
+            batch_size=persist_batch_size,
+            context=dict(browser_factory=browser_factory, frontier=kw['frontier']),
+        )
 
-        kw['worker_queue'] = worker_queue
         try:
-            super(BaseMultiProcessStage, Stage).visit(
-                browser_factory, *args, **kw)
+            persistence.start()
+            pool.start()
+            stage = Stage(browser_factory, *args, **kw)
+            if resume:
+                # the links that a dead crawl found but didn't persist
+                stage.resume()
 
-            while waits:
-                worker_queue.work_done()
-                waits.pop()
+            stage.play()
+            stage.consume_queue()
+            return stage.conclude()
+
+        except CelloStopScraping as e:
+            return stage.conclude(e)
 
         except KeyboardInterrupt:
             sh = couleur.Shell()
             sh.bold_red("User pressed CONTROL-C\n")
+
+        finally:
+            pool.stop()
+            persistence.stop()
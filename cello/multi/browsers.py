@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import threading
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+
+from cello.models import logger
+
+COUNTERS = ('browsers.created', 'browsers.recycled', 'browsers.unhealthy', 'browsers.discarded')
+
+
+class BrowserPool(object):
+    '''
+    Wraps a browser factory so that each worker thread or process builds
+    its browser once and reuses it for the pages it fetches. Browsers
+    like `requests.Session` then keep their connections open between
+    requests, without being shared across threads.
+
+    A browser is replaced by a new one after `max_pages` pages, when
+    `check(browser)` returns False, or when it fails to fetch a page.
+
+    When shared, its counters live in shared memory so that worker
+    processes forked after its creation report to the same ones.
+
+    Example:
+
+    Fab.visit(BrowserPool(Browser, max_pages=200, check=lambda browser: browser.is_alive()))
+    '''
+    def __init__(self, factory, max_pages=None, check=None, shared=False):
+        self.factory = factory
+        self.max_pages = max_pages
+        self.check = check
+        self.local = threading.local()
+        if shared:
+            self.lock = multiprocessing.Lock()
+            self.counters = RawArray('L', len(COUNTERS))
+        else:
+            self.lock = threading.Lock()
+            self.counters = [0] * len(COUNTERS)
+
+    def count(self, name):
+        with self.lock:
+            self.counters[COUNTERS.index(name)] += 1
+
+    def __call__(self):
+        browser = self.current()
+        if browser is not None and self.max_pages and self.local.pages >= self.max_pages:
+            self.count('browsers.recycled')
+            self.close(browser)
+            browser = None
+
+        if browser is not None and self.check is not None and not self.check(browser):
+            self.count('browsers.unhealthy')
+            self.close(browser)
+            browser = None
+
+        if browser is None:
+            browser = self.factory()
+            self.count('browsers.created')
+            self.local.browser = browser
+            self.local.pid = os.getpid()
+            self.local.pages = 0
+
+        self.local.pages += 1
+        return browser
+
+    def current(self):
+        # a forked worker inherits the browser of the thread that forked
+        # it, along with its sockets, it must build its own instead
+        if getattr(self.local, 'pid', None) != os.getpid():
+            return
+
+        return self.local.browser
+
+    def discard(self, browser):
+        if self.current() is browser:
+            self.count('browsers.discarded')
+            self.close(browser)
+
+    def release(self):
+        # the worker thread or process is done with its browser
+        browser = self.current()
+        if browser is not None:
+            self.close(browser)
+
+    def close(self, browser):
+        self.local.browser = None
+        for name in ('close', 'quit'):
+            method = getattr(browser, name, None)
+            if callable(method):
+                try:
+                    method()
+                except Exception:
+                    logger.exception("Could not %s the browser %r", name, browser)
+                return
+
+    def report(self):
+        return dict((name, count) for name, count in zip(COUNTERS, self.counters[:]) if count)
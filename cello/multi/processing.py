@@ -1,15 +1,36 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 from multiprocessing import Process, Queue
-from cello.multi.base import BaseWorkerQueue, BaseMultiProcessStage
+from multiprocessing.sharedctypes import RawArray
+from cello.frontier import SharedFrontier
+from cello.multi.base import BaseWorkerPool, BasePersistencePool, BaseMultiProcessStage
+from cello.multi.base import DEFAULT_MAX_TASKS_PER_CHILD
+from cello.multi.serializers import PickleSerializer
 
 
-class WorkerQueue(BaseWorkerQueue):
-    def make_queue(self, max_workers):
-        return Queue(max_workers)
+class WorkerPool(BaseWorkerPool):
+    Process = Process
+    # serializing before putting so that unpicklable tasks fail
+    # loudly in the caller instead of in the queue's feeder thread
+    serializer = PickleSerializer()
+    shared = True
 
+    def make_queue(self, maxsize=0):
+        return Queue(maxsize)
 
-class MultiProcessStage(BaseMultiProcessStage):
-    Queue = Queue
+    def make_slots(self, size):
+        return RawArray('L', size)
+
+
+class PersistencePool(BasePersistencePool):
     Process = Process
-    WorkerQueue = WorkerQueue
+
+    def make_queue(self, maxsize=0):
+        return Queue(maxsize)
+
+
+class MultiProcessStage(BaseMultiProcessStage):
+    WorkerPool = WorkerPool
+    PersistencePool = PersistencePool
+    Frontier = SharedFrontier
+    max_tasks_per_child = DEFAULT_MAX_TASKS_PER_CHILD
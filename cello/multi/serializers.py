@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import cPickle as pickle
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class PickleSerializer(object):
+    '''
+    Turns the messages exchanged with worker processes into bytes
+    with the newest pickle protocol, which keeps byte strings as
+    they are instead of going through a text encoding.
+    '''
+    name = 'pickle'
+
+    def __init__(self, protocol=pickle.HIGHEST_PROTOCOL):
+        self.protocol = protocol
+
+    def dumps(self, message):
+        return pickle.dumps(message, self.protocol)
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+
+class MsgpackSerializer(object):
+    '''
+    Packs messages with msgpack, objects that msgpack doesn't know
+    about (like the stage classes and functions of a task) travel
+    pickled inside an extension type.
+
+    Only plain lists and dicts are packed as msgpack arrays and maps,
+    tuples travel in their own extension type and subclasses of the
+    builtin types (a namedtuple like ParentContext, an OrderedDict)
+    are pickled, so that they all come back with the type they left.
+
+    Example:
+
+    Fab.visit(browser, serializer=MsgpackSerializer())
+    '''
+    name = 'msgpack'
+    pickled = 42
+    tupled = 43
+
+    def __init__(self):
+        if msgpack is None:
+            raise RuntimeError('MsgpackSerializer requires msgpack, try `pip install msgpack-python`')
+
+    def pack_object(self, obj):
+        if type(obj) is tuple:
+            return msgpack.ExtType(self.tupled, self.dumps(list(obj)))
+
+        return msgpack.ExtType(self.pickled, pickle.dumps(obj, pickle.HIGHEST_PROTOCOL))
+
+    def unpack_object(self, code, data):
+        if code == self.pickled:
+            return pickle.loads(data)
+
+        if code == self.tupled:
+            return tuple(self.loads(data))
+
+        return msgpack.ExtType(code, data)
+
+    def dumps(self, message):
+        return msgpack.packb(message, default=self.pack_object, use_bin_type=True, strict_types=True)
+
+    def loads(self, data):
+        return msgpack.unpackb(data, ext_hook=self.unpack_object, raw=False)
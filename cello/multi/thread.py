@@ -2,15 +2,26 @@
 # -*- coding: utf-8 -*-
 import threading
 from Queue import Queue
-from cello.multi.base import BaseWorkerQueue, BaseMultiProcessStage
+from cello.multi.base import BaseWorkerPool, BasePersistencePool, BaseMultiProcessStage
 
 
-class WorkerQueue(BaseWorkerQueue):
-    def make_queue(self, max_workers):
-        return Queue(max_workers)
+class WorkerPool(BaseWorkerPool):
+    Process = threading.Thread
 
+    def make_queue(self, maxsize=0):
+        return Queue(maxsize)
 
-class MultiThreadStage(BaseMultiProcessStage):
-    Queue = Queue
+    def make_slots(self, size):
+        return [0] * size
+
+
+class PersistencePool(BasePersistencePool):
     Process = threading.Thread
-    WorkerQueue = WorkerQueue
+
+    def make_queue(self, maxsize=0):
+        return Queue(maxsize)
+
+
+class MultiThreadStage(BaseMultiProcessStage):
+    WorkerPool = WorkerPool
+    PersistencePool = PersistencePool
@@ -1,16 +1,19 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-import json
 import importlib
 
+from Queue import Empty
 from cello import models
+from cello.storage import PersistBuffer, DEFAULT_BATCH_SIZE, DEFAULT_FLUSH_INTERVAL, is_unchanged, mark_persisted
+from cello.frontier import TUNED
 
 
 def handle_exception(exc):
     name = exc.__class__.__name__
     data = (name, exc.args)
     if isinstance(exc, models.CelloJumpToNextStage):
-        pass  # FIXME, add logging
+        models.logger.warning("Jumping to next stage: %s", exc)
+        return {}
 
     elif not hasattr(models, name):
         raise
@@ -18,65 +21,163 @@ def handle_exception(exc):
     return data
 
 
-def persist_async(stage, case_module_name, case_name, data, worker_queue, results_queue):
-    Stage = stage.__class__
-    if not data:
-        worker_queue.work_done()
-        raise models.BadTuneReturnValue(
-            models.BadTuneReturnValue.msg.format(
-                name=Stage.__name__,
-                url=Stage.url,
-                value=repr(data),
+def import_member(module_name, name):
+    # long-lived workers import each module once,
+    # importlib returns it from sys.modules afterwards
+    module = importlib.import_module(module_name)
+    return getattr(module, name)
+
+
+def work(tasks, results, current, index, context=None, max_tasks=None, serializer=None):
+    '''
+    The loop of a long-lived worker: runs (function, kwargs) tasks
+    taken from the tasks queue until it gets a `None` or until it
+    has run `max_tasks` tasks, then closes its browser and exits
+    so that the pool can replace it with a fresh worker.
+
+    `current[index]` holds the id of the task being run, so that
+    the pool can account for it if the worker dies abruptly.
+
+    A result that can't be serialized is reported with `None` in
+    place of its child tasks, so that the pool can count it as dropped.
+    '''
+    context = context or {}
+    encode = serializer and serializer.dumps or (lambda message: message)
+    decode = serializer and serializer.loads or (lambda message: message)
+
+    done = 0
+    while max_tasks is None or done < max_tasks:
+        task = tasks.get()
+        if task is None:
+            break
+
+        task_id, function, kwargs = decode(task)
+        current[index] = task_id
+        try:
+            raw, children = function(**dict(context, **kwargs))
+        except Exception:
+            models.logger.exception("%s failed with %r", function.__name__, kwargs)
+            raw, children = None, []
+
+        try:
+            message = encode((task_id, raw, children))
+        except Exception:
+            models.logger.exception("Could not send the result of %s back", function.__name__)
+            message = encode((task_id, None, None))
+
+        results.put(message)
+        current[index] = 0
+        done += 1
+
+    release = getattr(context.get('browser_factory'), 'release', None)
+    if release is not None:
+        release()
+
+
+def describe_persistence_error(exc):
+    name = exc.__class__.__name__
+    if hasattr(models, name):
+        return name, exc.args
+
+    return 'CelloPersistenceError', ('{0}: {1}'.format(name, exc), )
+
+
+def persist_batches(items, errors, batch_size=DEFAULT_BATCH_SIZE, interval=DEFAULT_FLUSH_INTERVAL,
+                    context=None):
+    '''
+    The loop of a long-lived persistence worker: buffers the tuned items
+    taken from the items queue and saves them in batches per Case class,
+    until it gets a `None`. Failures are put in the errors queue for
+    the coordinating stage to raise.
+    '''
+    context = context or {}
+    buffer = PersistBuffer(size=batch_size, interval=interval)
+
+    def attempt(function, *args):
+        try:
+            function(*args)
+        except models.CelloJumpToNextStage as e:
+            models.logger.warning("Jumping to next stage: %s", e)
+        except Exception as e:
+            models.logger.exception("Could not persist %r", args)
+            errors.put(describe_persistence_error(e))
+
+    def add(stage_module, stage_name, case_module_name, case_name, url, data, indexed=None):
+        Stage = import_member(stage_module, stage_name)
+        if not data:
+            raise models.BadTuneReturnValue(
+                models.BadTuneReturnValue.msg.format(
+                    name=Stage.__name__,
+                    url=url,
+                    value=repr(data),
+                )
             )
-        )
 
-    module = importlib.import_module(case_module_name)
-    Case = getattr(module, case_name)
-    exception_data = {}
-    try:
-        Case(stage).save(data)
-    except Exception as e:
-        exception_data = handle_exception(e)
-    finally:
-        worker_queue.work_done()
-        if exception_data:
-            worker_queue.close()
-            # doing this after releasing the queue (calling work_done)
-            # so that it has available resources
-            results_queue.put(json.dumps(exception_data))
-
-
-def fetch_async(Stage, browser_factory, queue, worker_queue, url=None, parent=None, parent_response=None):
-    work_done = False
+        Case = import_member(case_module_name, case_name)
+        stage = Stage(context.get('browser_factory'), url=url, frontier=context.get('frontier'))
+        stage.indexed = indexed
+        if is_unchanged(stage, data):
+            mark_persisted(stage)
+            return
+
+        buffer.add(Case, stage, data)
+
+    while True:
+        try:
+            item = items.get(timeout=interval)
+        except Empty:
+            # idle for a while, save what's been waiting
+            attempt(buffer.flush)
+            continue
+
+        if item is None:
+            break
+
+        attempt(add, *item)
+
+    attempt(buffer.flush)
+
+
+def fetch_async(Stage, browser_factory, url=None, parent=None, parent_response=None, frontier=None):
+    tasks = []
     try:
         stage = Stage(browser_factory,
-                      worker_queue=worker_queue,
                       url=url,
                       parent=parent,
-                      parent_response=parent_response)
+                      parent_response=parent_response,
+                      frontier=frontier,
+                      tasks=tasks)
+        if frontier is not None and stage.already_visited():
+            return {}, tasks
+
         stage.fetch()
-        worker_queue.work_done()
-        work_done = True
-        stage.play()
-        if stage.case:
+        status = getattr(stage.response, 'status_code', None)
+        if not stage.not_modified:
+            stage.play()
+
+        if stage.unchanged:
+            # same page as in the previous crawl, and so same data
+            mark_persisted(stage)
+            data = {}
+        elif stage.case:
             data = stage.tune() or {}
+            if frontier is not None and data:
+                frontier.mark(stage, TUNED)
             data['case.module'] = stage.case.__module__
             data['case.name'] = stage.case.__name__
             data['stage.module'] = Stage.__module__
             data['stage.name'] = Stage.__name__
+            data['stage.url'] = stage.url
+            data['stage.indexed'] = stage.indexed
         else:
+            # nothing else to do with the page once its links were found
+            mark_persisted(stage)
             data = {}
 
+        # tells the scheduler of the crawl how the host responded
+        data['fetch.status'] = status
+
     except Exception as e:
-        if not work_done:
-            worker_queue.work_done()
         data = handle_exception(e)
-        if data:
-            worker_queue.close()
-
-    try:
-        serialized = json.dumps(data)
-    except UnicodeDecodeError as e:
-        return
 
-    queue.put(serialized)
+    return data, tasks
@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import time
+import threading
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+from urlparse import urlsplit, urljoin
+
+
+def is_server_error(response):
+    status_code = getattr(response, 'status_code', None)
+    return isinstance(status_code, int) and status_code >= 500
+
+
+class TokenBucket(object):
+    '''
+    Allows `rate` requests per second on average, and up to `burst`
+    requests at once after a quiet period.
+    '''
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = time.time()
+
+    def refill(self):
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self):
+        self.refill()
+        if self.tokens >= 1:
+            return 0
+
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        if self.delay():
+            return False
+
+        self.tokens -= 1
+        return True
+
+
+class AdaptiveConcurrency(object):
+    '''
+    Finds how many fetches can be in flight at once, for each host and
+    for the whole crawl, by additive increase and multiplicative
+    decrease (AIMD).
+
+    While a limit is in use and its smoothed latency stays within
+    `tolerance` times the lowest one seen (or within `slack` seconds of
+    it, so that the jitter of fast hosts goes unnoticed), the limit
+    grows by `increase` about every round trip. A failure (a timeout, a 5xx
+    response, a crashed fetch) or a latency above that cuts it by
+    `decrease`, at most once per round trip.
+
+    Example:
+
+    Fab.visit(Browser, max_workers=64, scheduler=Scheduler(adaptive=AdaptiveConcurrency()))
+    '''
+    smoothing = 0.2
+
+    def __init__(self, initial=4, minimum=1, maximum=None, increase=1.0, decrease=0.5, tolerance=2.0,
+                 slack=0.05):
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.tolerance = tolerance
+        self.slack = slack
+        # key -> [limit, smoothed latency, lowest smoothed latency, last decrease]
+        self.state = {}
+        self.increases = 0
+        self.decreases = 0
+
+    def get(self, key):
+        if key not in self.state:
+            self.state[key] = [float(self.initial), None, None, 0]
+
+        return self.state[key]
+
+    def limit(self, key):
+        return int(self.get(key)[0])
+
+    def record(self, key, latency, failed=False, in_flight=None):
+        state = self.get(key)
+        limit, smoothed, lowest, last_decrease = state
+        if latency is not None:
+            smoothed = latency if smoothed is None else smoothed + self.smoothing * (latency - smoothed)
+            lowest = smoothed if lowest is None else min(lowest, smoothed)
+
+        now = time.time()
+        slow = smoothed is not None and smoothed > max(self.tolerance * lowest, lowest + self.slack)
+        if failed or slow:
+            # the responses of one round trip all tell the same story
+            if now - last_decrease >= (smoothed or 0):
+                limit = max(self.minimum, limit * self.decrease)
+                last_decrease = now
+                self.decreases += 1
+
+        elif in_flight is None or in_flight >= int(limit):
+            # limits that aren't reached say nothing about the next step
+            limit += self.increase / limit
+            if self.maximum:
+                limit = min(self.maximum, limit)
+            self.increases += 1
+
+        state[:] = [limit, smoothed, lowest, last_decrease]
+        return int(limit)
+
+    def report(self):
+        return {
+            'concurrency.limit': self.limit(None),
+            'concurrency.increases': self.increases,
+            'concurrency.decreases': self.decreases,
+        }
+
+
+class Scheduler(object):
+    '''
+    Crawl-scoped politeness rules: every fetch of a host takes a token
+    from its bucket, refilled at `rate` requests per second, and no
+    more than `concurrency` fetches of a host are in flight at once.
+    Without limits every fetch goes through right away.
+
+    `hosts` overrides the limits of some hosts, each with a dict of
+    `rate`, `burst` and `concurrency`.
+
+    With an `adaptive` controller, the fetches in flight per host and
+    across the crawl are also kept within the limits it adapts to the
+    latency and failures reported through `record()`.
+
+    Stages wait in `slot()` for their host to be ready. Multi stages
+    queue their links with `push()` instead, and `pop()` hands out the
+    links of whichever host is ready, so that workers fetch other hosts
+    while one is throttled.
+
+    Example:
+
+    Fab.visit(browser, scheduler=Scheduler(rate=2, burst=5, concurrency=4,
+                                           hosts={'static.fab.com': {'rate': 20}}))
+    '''
+    poll_interval = 0.05
+
+    def __init__(self, rate=None, burst=1, concurrency=None, hosts=None, sleep=None, adaptive=None):
+        self.defaults = dict(rate=rate, burst=burst, concurrency=concurrency)
+        self.hosts = dict((host.lower(), limits) for host, limits in (hosts or {}).items())
+        self.sleep = sleep
+        self.adaptive = adaptive
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.running = Counter()
+        self.in_flight = 0
+        self.queues = OrderedDict()
+        self.waiting = set()
+        self.throttled = 0
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def __repr__(self):
+        return '<{}: {} queued links of {} hosts>'.format(
+            self.__class__.__name__, len(self), len(self.queues))
+
+    def host(self, url, base_url=None):
+        if base_url:
+            url = urljoin(base_url, url)
+
+        return urlsplit(url).netloc.lower()
+
+    def limit(self, host, name):
+        limits = self.hosts.get(host, {})
+        return limits.get(name, self.defaults[name])
+
+    def bucket(self, host):
+        if host not in self.buckets:
+            rate = self.limit(host, 'rate')
+            self.buckets[host] = rate and TokenBucket(rate, self.limit(host, 'burst')) or None
+
+        return self.buckets[host]
+
+    def delay(self, host):
+        with self.lock:
+            bucket = self.bucket(host)
+            if bucket is None:
+                return 0
+
+            return bucket.delay()
+
+    def concurrency(self, host):
+        concurrency = self.limit(host, 'concurrency')
+        if self.adaptive is not None:
+            concurrency = min(concurrency or self.adaptive.limit(host), self.adaptive.limit(host))
+
+        return concurrency
+
+    def acquire(self, host):
+        with self.lock:
+            concurrency = self.concurrency(host)
+            if concurrency and self.running[host] >= concurrency:
+                return False
+
+            if self.adaptive is not None and self.in_flight >= self.adaptive.limit(None):
+                return False
+
+            bucket = self.bucket(host)
+            if bucket is not None and not bucket.take():
+                return False
+
+            self.running[host] += 1
+            self.in_flight += 1
+            return True
+
+    def release(self, host):
+        with self.lock:
+            self.running[host] -= 1
+            self.in_flight -= 1
+            if self.running[host] <= 0:
+                del self.running[host]
+
+    def record(self, host, latency, failed=False):
+        # called for a fetch that still holds its slot
+        if self.adaptive is None:
+            return
+
+        with self.lock:
+            self.adaptive.record(host, latency, failed, in_flight=self.running[host])
+            self.adaptive.record(None, latency, failed, in_flight=self.in_flight)
+
+    def request(self, get_response, url, *args):
+        with self.slot(url) as host:
+            started = time.time()
+            try:
+                response = get_response(url, *args)
+            except Exception:
+                self.record(host, time.time() - started, failed=True)
+                raise
+
+            self.record(host, time.time() - started, failed=is_server_error(response))
+            return response
+
+    def throttle(self):
+        with self.lock:
+            self.throttled += 1
+
+    def wait(self, seconds):
+        # hosts at their concurrency cap have no known delay, poll them
+        (self.sleep or time.sleep)(seconds or self.poll_interval)
+
+    @contextmanager
+    def slot(self, url):
+        host = self.host(url)
+        if not self.acquire(host):
+            self.throttle()
+            while not self.acquire(host):
+                self.wait(self.delay(host))
+
+        try:
+            yield host
+        finally:
+            self.release(host)
+
+    def push(self, host, task):
+        if host not in self.queues:
+            self.queues[host] = deque()
+
+        self.queues[host].append(task)
+
+    def pop(self):
+        for host in list(self.queues):
+            if not self.acquire(host):
+                # counted once per link that has to wait
+                if host not in self.waiting:
+                    self.waiting.add(host)
+                    self.throttle()
+                continue
+
+            self.waiting.discard(host)
+            queue = self.queues.pop(host)
+            task = queue.popleft()
+            # the host goes to the back of the line
+            if queue:
+                self.queues[host] = queue
+
+            return host, task
+
+    def next_ready(self):
+        return min([self.delay(host) for host in self.queues] or [0])
+
+    def report(self):
+        report = {
+            'scheduler.hosts': len(self.buckets),
+            'scheduler.throttled': self.throttled,
+        }
+        if self.adaptive is not None:
+            report.update(self.adaptive.report())
+
+        return report
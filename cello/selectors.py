@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import threading
+from collections import OrderedDict
+
+from lxml import etree
+from lxml.cssselect import LxmlHTMLTranslator
+from cssselect import ExpressionError
+
+DEFAULT_MAX_SELECTORS = 512
+
+
+def lower_case(context, value):
+    return value.lower()
+
+
+# lxml resolves the prefix of its own css functions only for the first
+# document a compiled xpath sees, so they are passed unprefixed instead
+EXTENSIONS = {(None, 'lower-case'): lower_case}
+
+
+class HTMLTranslator(LxmlHTMLTranslator):
+    '''
+    Translates css to xpath like lxml does, except that :contains
+    calls the lower-case function of EXTENSIONS, which every xpath
+    compiled out of a css selector is given.
+    '''
+    def xpath_contains_function(self, xpath, function):
+        if function.argument_types() not in (['STRING'], ['IDENT']):
+            raise ExpressionError(
+                'Expected a single string or ident for :contains(), got %r' % function.arguments)
+
+        value = function.arguments[0].value
+        return xpath.add_condition('contains(lower-case(string(.)), %s)' % self.xpath_literal(value.lower()))
+
+
+translator = HTMLTranslator()
+
+
+class SelectorCache(object):
+    '''
+    Process-wide LRU of compiled selectors.
+
+    Translating css to xpath and compiling the xpath is far more
+    expensive than evaluating it, so every selector string is compiled
+    only once and reused across pages until it gets evicted.
+
+    Example:
+
+    cache = SelectorCache(maxsize=128)
+    links = cache.css('a[href]')(dom)
+    '''
+    def __init__(self, maxsize=DEFAULT_MAX_SELECTORS):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._compiled = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._compiled)
+
+    def __repr__(self):
+        return '<SelectorCache: {hits} hits, {misses} misses, {size}/{maxsize} selectors>'.format(**self.info())
+
+    def css(self, selector):
+        return self.get(('css', selector), lambda: etree.XPath(translator.css_to_xpath(selector), extensions=EXTENSIONS))
+
+    def xpath(self, expression):
+        return self.get(('xpath', expression), lambda: etree.XPath(expression))
+
+    def get(self, key, compile):
+        with self._lock:
+            compiled = self._compiled.pop(key, None)
+            if compiled is not None:
+                self.hits += 1
+                self._compiled[key] = compiled
+                return compiled
+
+            self.misses += 1
+
+        # compiling outside of the lock, a selector compiled twice by
+        # racing threads is cheaper than serializing every compilation
+        compiled = compile()
+
+        with self._lock:
+            self._compiled[key] = compiled
+            while len(self._compiled) > self.maxsize:
+                self._compiled.popitem(last=False)
+
+        return compiled
+
+    def info(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._compiled),
+            'maxsize': self.maxsize,
+        }
+
+    def clear(self):
+        with self._lock:
+            self._compiled.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+cache = SelectorCache()
@@ -1,5 +1,21 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import time
+import json
+import hashlib
+import logging
+import threading
+import multiprocessing
+from Queue import Queue, Full
+from collections import OrderedDict
+from multiprocessing.sharedctypes import RawArray
+from .frontier import LocalConnection, PERSISTED, DEFAULT_TIMEOUT
+
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_FLUSH_INTERVAL = 5.0
+DEFAULT_WRITER_QUEUE_SIZE = 1000
+
+logger = logging.getLogger('cello')
 
 
 class Case(object):
@@ -13,6 +29,13 @@ class Case(object):
     class MemoryCase(Case):
         def save(self, data):
             MEMORY[self.stage.url].append(data)
+
+    Cases can also save many items at once when persisting through
+    a PersistBuffer, `self.stage` is then the last stage of the batch:
+
+    class ProductCase(Case):
+        def save_many(self, items):
+            Product.objects.bulk_create([Product(**data) for data in items])
     '''
     def __init__(self, stage):
         self.stage = stage
@@ -22,7 +45,273 @@ class Case(object):
             'you have to inherit cello.storage.Case '
             'and override the save method')
 
+    def save_many(self, items):
+        for data in items:
+            self.save(data)
+
+    @classmethod
+    def saves_in_batches(cls):
+        return cls.save_many.im_func is not Case.save_many.im_func
+
+
+def is_unchanged(stage, data):
+    # items identical to the ones that a previous crawl saved aren't saved again
+    fingerprints = getattr(stage, 'fingerprints', None)
+    if fingerprints is None:
+        return False
+
+    stage.fingerprint = fingerprints.changed(stage.canonical_url, data)
+    return stage.fingerprint is None
+
+
+def mark_persisted(stage):
+    frontier = getattr(stage, 'frontier', None)
+    if frontier is not None:
+        frontier.mark(stage, PERSISTED)
+
+    # remembered once saved, an item that failed to save is saved next time
+    fingerprint = getattr(stage, 'fingerprint', None)
+    if fingerprint is not None:
+        stage.fingerprints.remember(stage.canonical_url, fingerprint)
+
+    indexed = getattr(stage, 'indexed', None)
+    if indexed is not None:
+        stage.index.remember(stage.canonical_url, indexed)
+
+
+class FingerprintStore(object):
+    '''
+    Remembers a fingerprint of the last item saved for every page of
+    the stages that use it, so that the items that are the same as the
+    ones saved by a previous crawl aren't saved again. The `volatile`
+    keys, like the datetime added by `Stage.tune()`, are left out of
+    the fingerprints.
+
+    When shared, its counters live in shared memory so that persistence
+    workers forked after its creation report to the same ones.
+
+    Example:
+
+    class EachFabProduct(Stage):
+        fingerprints = FingerprintStore('/var/lib/fab/items.db', volatile=('datetime', 'views'))
+    '''
+    volatile = ('datetime', )
+
+    def __init__(self, path, volatile=None, timeout=DEFAULT_TIMEOUT, shared=False):
+        self.path = path
+        if volatile is not None:
+            self.volatile = tuple(volatile)
+
+        if shared:
+            self.lock = multiprocessing.Lock()
+            self.counters = RawArray('L', 2)
+        else:
+            self.lock = threading.Lock()
+            # [changed, unchanged]
+            self.counters = [0, 0]
+
+        self.connection = LocalConnection(path, timeout)
+        self.database.execute(
+            'CREATE TABLE IF NOT EXISTS items (url TEXT PRIMARY KEY, fingerprint TEXT, saved_at REAL)')
+
+    def __len__(self):
+        return self.database.execute('SELECT COUNT(*) FROM items').fetchone()[0]
+
+    def __repr__(self):
+        return '<{}: {} items in {}>'.format(self.__class__.__name__, len(self), self.path)
+
+    @property
+    def database(self):
+        return self.connection()
+
+    def fingerprint(self, data):
+        normalized = dict((key, value) for key, value in data.items() if key not in self.volatile)
+        # sorted keys and no whitespace, equal dicts always dump the same
+        try:
+            dumped = json.dumps(normalized, sort_keys=True, separators=(',', ':'), default=repr)
+        except UnicodeDecodeError:
+            # byte strings that aren't utf-8 are read as latin-1, which
+            # maps every byte to its own character
+            dumped = json.dumps(normalized, sort_keys=True, separators=(',', ':'), default=repr,
+                                encoding='latin-1')
+
+        return hashlib.sha1(dumped).hexdigest()
+
+    def changed(self, url, data):
+        # the fingerprint of an item that changed, None for an unchanged one
+        fingerprint = self.fingerprint(data)
+        row = self.database.execute('SELECT fingerprint FROM items WHERE url = ?', (url, )).fetchone()
+        unchanged = row is not None and row[0] == fingerprint
+        with self.lock:
+            self.counters[unchanged and 1 or 0] += 1
+
+        if not unchanged:
+            return fingerprint
+
+    def remember(self, url, fingerprint):
+        self.database.execute(
+            'INSERT OR REPLACE INTO items (url, fingerprint, saved_at) VALUES (?, ?, ?)',
+            (url, fingerprint, time.time()))
+
+    def report(self):
+        changed, unchanged = self.counters[:]
+        return {
+            'items.changed': changed,
+            'items.unchanged': unchanged,
+        }
+
 
 class DummyCase(Case):
     def save(self, data):
         pass
+
+
+class PersistBuffer(object):
+    '''
+    Holds persisted items grouped by Case class and saves each group
+    at once when it has `size` items or when `interval` seconds went
+    by since it was last saved. Cases without a `save_many` get their
+    items saved one by one, each along with its own stage.
+
+    Example:
+
+    Fab.visit(browser, buffer=PersistBuffer(size=500))
+    '''
+    def __init__(self, size=DEFAULT_BATCH_SIZE, interval=DEFAULT_FLUSH_INTERVAL):
+        self.size = size
+        self.interval = interval
+        self.groups = OrderedDict()
+        self.flushed_at = {}
+        self.lock = threading.RLock()
+        self.batches = 0
+        self.saved = 0
+
+    def __len__(self):
+        return sum(map(len, self.groups.values()))
+
+    def add(self, Case, stage, data):
+        with self.lock:
+            group = self.groups.setdefault(Case, [])
+            group.append((stage, data))
+            since = time.time() - self.flushed_at.setdefault(Case, time.time())
+            if len(group) >= self.size or since >= self.interval:
+                self.flush_group(Case)
+
+    def flush_group(self, Case):
+        with self.lock:
+            group = self.groups.pop(Case, [])
+            self.flushed_at[Case] = time.time()
+
+        if not group:
+            return
+
+        if Case.saves_in_batches():
+            Case(group[-1][0]).save_many([data for stage, data in group])
+        else:
+            for stage, data in group:
+                Case(stage).save(data)
+
+        for stage, data in group:
+            mark_persisted(stage)
+
+        with self.lock:
+            self.batches += 1
+            self.saved += len(group)
+
+    def flush(self):
+        for Case in list(self.groups):
+            self.flush_group(Case)
+
+    def report(self):
+        return {
+            'persist.buffered': len(self),
+            'persist.batches': self.batches,
+            'persist.items': self.saved,
+        }
+
+
+class PersistWriter(object):
+    '''
+    Saves persisted items from a background thread so that a slow
+    `Case.save` doesn't stall fetching. The crawl blocks once `maxsize`
+    items are waiting to be saved, until the writer catches up.
+
+    Items are saved one by one unless the writer is given a
+    PersistBuffer to save them in batches. `flush()` returns once every
+    item handed so far was saved, and raises the first error that the
+    writer ran into.
+
+    Example:
+
+    Fab.visit(browser, buffer=PersistWriter(buffer=PersistBuffer(size=500)))
+    '''
+    flushing = object()
+
+    def __init__(self, buffer=None, maxsize=DEFAULT_WRITER_QUEUE_SIZE):
+        self.buffer = buffer
+        self.queue = Queue(maxsize)
+        self.error = None
+        self.saved = 0
+        self.waits = 0
+        self.peak = 0
+        self.thread = threading.Thread(target=self.write, name='cello-writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def depth(self):
+        return self.queue.qsize()
+
+    def add(self, Case, stage, data):
+        self.raise_error()
+        try:
+            self.queue.put_nowait((Case, stage, data))
+        except Full:
+            self.waits += 1
+            self.queue.put((Case, stage, data))
+
+        self.peak = max(self.peak, self.depth)
+
+    def write(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if self.error is None:
+                    self.save(item)
+            except Exception as e:
+                logger.exception("The persistence writer failed, it won't save anything else")
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def save(self, item):
+        if item is self.flushing:
+            if self.buffer is not None:
+                self.buffer.flush()
+            return
+
+        Case, stage, data = item
+        if self.buffer is not None:
+            self.buffer.add(Case, stage, data)
+        else:
+            Case(stage).save(data)
+            mark_persisted(stage)
+
+        self.saved += 1
+
+    def raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def flush(self):
+        self.queue.put(self.flushing)
+        self.queue.join()
+        self.raise_error()
+
+    def report(self):
+        return {
+            'writer.queued': self.depth,
+            'writer.peak': self.peak,
+            'writer.waits': self.waits,
+            'writer.saved': self.saved,
+        }
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from cello.helpers import Canonicalizer
+from sure import expect
+
+
+def test_canonicalize_scheme_host_and_port():
+    "Canonicalizer lower-cases scheme and host and drops default ports"
+
+    canonicalize = Canonicalizer()
+
+    expect(canonicalize('HTTP://Fab.COM:80/Sale/Lamps')).to.equal(
+        'http://fab.com/Sale/Lamps')
+    expect(canonicalize('https://User@Fab.com:443/')).to.equal(
+        'https://User@fab.com/')
+    expect(canonicalize('http://fab.com:8080/')).to.equal(
+        'http://fab.com:8080/')
+
+
+def test_canonicalize_drops_fragments():
+    "Canonicalizer drops fragments"
+
+    expect(Canonicalizer()('http://fab.com/product/1#reviews')).to.equal(
+        'http://fab.com/product/1')
+
+
+def test_canonicalize_sorts_query_parameters():
+    "Canonicalizer sorts query parameters by name, keeping repeated ones in order"
+
+    expect(Canonicalizer()('http://fab.com/search?q=lamp&color=red&size=2&color=blue&')).to.equal(
+        'http://fab.com/search?color=red&color=blue&q=lamp&size=2')
+
+
+def test_canonicalize_strips_ignored_parameters():
+    "Canonicalizer strips tracking parameters"
+
+    expect(Canonicalizer()('http://fab.com/product/1?utm_source=mail&UTM_Medium=x&id=2&gclid=3')).to.equal(
+        'http://fab.com/product/1?id=2')
+
+
+def test_canonicalize_with_custom_ignored_parameters():
+    "Canonicalizer(ignored_params=...) replaces the default blacklist"
+
+    canonicalize = Canonicalizer(ignored_params=['session*'])
+
+    expect(canonicalize('http://fab.com/?utm_source=mail&sessionid=42')).to.equal(
+        'http://fab.com/?utm_source=mail')
+
+
+def test_canonicalize_empty_url():
+    "Canonicalizer leaves empty urls alone"
+
+    expect(Canonicalizer()(None)).to.be.none
+    expect(Canonicalizer()('')).to.equal('')
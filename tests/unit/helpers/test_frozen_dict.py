@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import pickle
+from cello.helpers import FrozenDict
+from sure import expect
+
+
+def test_frozen_dict_is_a_dict():
+    "FrozenDict reads and compares like the dict it was built from"
+
+    data = FrozenDict({'brand': 'Fab'})
+
+    expect(data).to.equal({'brand': 'Fab'})
+    expect(data['brand']).to.equal('Fab')
+    expect(data.get('price')).to.be.none
+
+
+def test_frozen_dict_cant_be_changed():
+    "FrozenDict raises TypeError on every change"
+
+    data = FrozenDict({'brand': 'Fab'})
+
+    data.__setitem__.when.called_with('brand', 'Other').should.throw(TypeError, 'FrozenDict is immutable')
+    data.__delitem__.when.called_with('brand').should.throw(TypeError)
+    data.update.when.called_with(price=10).should.throw(TypeError)
+    data.setdefault.when.called_with('price', 10).should.throw(TypeError)
+    data.pop.when.called_with('brand').should.throw(TypeError)
+    data.popitem.when.called_with().should.throw(TypeError)
+    data.clear.when.called_with().should.throw(TypeError)
+    expect(data).to.equal({'brand': 'Fab'})
+
+
+def test_frozen_dict_copies_are_mutable():
+    "FrozenDict.copy returns a plain dict"
+
+    copy = FrozenDict({'brand': 'Fab'}).copy()
+    copy['price'] = 10
+
+    expect(type(copy)).to.be(dict)
+
+
+def test_frozen_dict_pickles():
+    "FrozenDict survives pickling with every protocol"
+
+    data = FrozenDict({'brand': 'Fab'})
+
+    for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+        loaded = pickle.loads(pickle.dumps(data, protocol))
+        expect(loaded).to.equal(data)
+        expect(loaded).to.be.a(FrozenDict)
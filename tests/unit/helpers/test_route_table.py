@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import re
+from mock import patch
+from cello.helpers import RouteTable, InvalidURLMapping
+from sure import expect
+
+
+class Product(object):
+    pass
+
+
+class Sale(object):
+    pass
+
+
+def make_table(**kw):
+    return RouteTable([
+        ('product', r'/product/(?P<id>\d+)', 'http://fab.com/product/{id}', Product),
+        ('sale', r'/sale/(?P<name>[\w-]+)', 'http://fab.com/sale/{name}', Sale),
+        ('page', r'/(?P<name>\w+)\.php$', 'http://fab.com/{name}'),
+    ], **kw)
+
+
+def test_dispatching_to_the_matching_route():
+    "RouteTable.dispatch translates a url with the mapping of the route it matches, along with its stage"
+
+    table = make_table()
+
+    expect(table.dispatch('/product/42?ref=home')).to.equal(('http://fab.com/product/42', Product))
+    expect(table.dispatch('/sale/lamps-and-more')).to.equal(('http://fab.com/sale/lamps-and-more', Sale))
+    expect(table.dispatch('/about.php')).to.equal(('http://fab.com/about', None))
+    expect(table.translate('/product/7')).to.equal('http://fab.com/product/7')
+    expect(table.stage('/sale/lamps')).to.be(Sale)
+    expect(table.stage('/nowhere')).to.be.none
+
+
+def test_routes_take_precedence_in_order():
+    "RouteTable dispatches a url that many routes match to the first one added, wherever they match"
+
+    table = RouteTable([
+        ('product', r'/product/(?P<id>\d+)', 'product {id}'),
+        ('anything', r'/(?P<path>.*)', 'anything {path}'),
+    ])
+
+    expect(table.translate('/sale/1/product/2')).to.equal('product 2')
+    expect(table.translate('/sale/1')).to.equal('anything sale/1')
+
+
+def test_named_backreferences_are_kept():
+    "RouteTable keeps the named backreferences of its patterns pointing to their own groups"
+
+    table = RouteTable([
+        ('twice', r'/(?P<word>\w+)/(?P=word)$', 'twice {word}'),
+        ('once', r'/(?P<word>\w+)$', 'once {word}'),
+    ])
+
+    expect(table.translate('/cello/cello')).to.equal('twice cello')
+    expect(table.translate('/cello/viola')).to.equal('once viola')
+
+
+def test_dispatching_when_not_found():
+    "RouteTable.dispatch raises InvalidURLMapping for urls that match no route"
+
+    expect(make_table().dispatch).when.called_with('/nowhere').to.throw(
+        InvalidURLMapping,
+        'url /nowhere does not match any of the routes product, sale, page')
+
+
+def test_many_routes_are_compiled_in_as_few_regexes_as_possible():
+    "RouteTable splits routes in as many regexes as python can handle"
+
+    table = RouteTable([
+        ('route%d' % n, r'/(?P<first>a{%d})(?P<second>b)$' % n, '{first} {second}')
+        for n in range(1, 81)])
+
+    expect(len(table.compile())).to.equal(3)
+    expect(table.translate('/aaaab')).to.equal('aaaa b')
+    expect(table.translate('/' + 'a' * 80 + 'b')).to.equal('a' * 80 + ' b')
+
+
+def test_memoizes_the_latest_urls():
+    "RouteTable remembers where the latest urls were dispatched"
+
+    table = make_table(memo_size=2)
+
+    with patch.object(table, 'match', wraps=table.match) as match:
+        table.translate('/product/1')
+        table.translate('/product/1')
+        table.stage('/product/2')
+        table.stage('/product/3')
+        table.translate('/product/1')
+
+    expect(match.call_count).to.equal(4)
+    expect(table.report()).to.equal({'routes.memo_hits': 1, 'routes.memo_misses': 4})
+
+
+def test_adding_routes_compiles_the_table_again():
+    "RouteTable.add makes the table dispatch to the new route"
+
+    table = make_table()
+    expect(table.stage('/brand/eames')).to.be.none
+
+    table.add('brand', re.compile(r'/BRAND/(?P<name>\w+)', re.I), 'http://fab.com/brand/{name}')
+
+    expect(table.translate('/brand/eames')).to.equal('http://fab.com/brand/eames')
@@ -2,6 +2,8 @@
 # -*- coding: utf-8 -*-
 from mock import Mock, patch
 from sure import expect
+from lxml import html as lhtml
+from cello.helpers import Canonicalizer
 from cello.models import (
     DOMWrapper,
 )
@@ -31,3 +33,98 @@ def test_dom_wrapper_query_returns_query(Query):
 
     Query.assert_called_once_with(dom)
     Query.return_value.query.assert_called_once_with('.menu a')
+
+
+LINKS_PAGE = '''<html><body>
+<a href="/sale/shoes#top">shoes</a>
+<a href="/sale/shoes">shoes again</a>
+<a href="http://other.com/sale/hats">hats</a>
+<a href="/product/1">product</a>
+<a href="#footer">footer</a>
+<a href="mailto:sales@fab.com">mail us</a>
+<a>no href</a>
+<div class="menu"><a href="/sale/bags"> bags </a></div>
+<map><area href="/sale/maps" /></map>
+</body></html>'''
+
+
+def test_links_are_absolute_without_fragments_and_unique():
+    "DOMWrapper.links resolves, defragments and deduplicates links"
+
+    wrapper = DOMWrapper(lhtml.fromstring(LINKS_PAGE), base_url='http://fab.com/brands/')
+
+    expect(wrapper.links()).to.equal([
+        'http://fab.com/sale/shoes',
+        'http://other.com/sale/hats',
+        'http://fab.com/product/1',
+        'http://fab.com/sale/bags',
+        'http://fab.com/sale/maps',
+    ])
+
+
+def test_links_matching_a_pattern():
+    "DOMWrapper.links(pattern=...) keeps only the links matching the regex"
+
+    wrapper = DOMWrapper(lhtml.fromstring(LINKS_PAGE), base_url='http://fab.com')
+
+    expect(wrapper.links(pattern=r'fab\.com/sale/')).to.equal([
+        'http://fab.com/sale/shoes',
+        'http://fab.com/sale/bags',
+        'http://fab.com/sale/maps',
+    ])
+
+
+def test_links_from_a_selector():
+    "DOMWrapper.links(selector=...) only considers the selected elements"
+
+    wrapper = DOMWrapper(lhtml.fromstring(LINKS_PAGE), base_url='http://fab.com')
+
+    expect(wrapper.links(selector='.menu a')).to.equal([
+        'http://fab.com/sale/bags',
+    ])
+
+
+def test_links_without_base_url_are_left_relative():
+    "DOMWrapper.links keeps relative links when there is no base url"
+
+    wrapper = DOMWrapper(lhtml.fromstring(LINKS_PAGE))
+
+    expect(wrapper.links(pattern='/product/')).to.equal(['/product/1'])
+
+
+def test_links_are_canonicalized():
+    "DOMWrapper.links deduplicates the canonical form of the links"
+
+    page = '<p><a href="/p/1?utm_source=x&b=2&a=1">1</a><a href="/p/1?a=1&b=2">1</a></p>'
+    wrapper = DOMWrapper(lhtml.fromstring(page), base_url='http://Fab.com',
+                         canonicalize=Canonicalizer())
+
+    expect(wrapper.links()).to.equal(['http://fab.com/p/1?a=1&b=2'])
+
+
+def test_links_count_the_rewritten_links():
+    "DOMWrapper.links reports how many of its links the canonicalizer rewrote"
+
+    page = ('<p><a href="/p/2?utm_source=x">2</a><a href="/p/3#frag">3</a>'
+            '<a href="/p/4">4</a><a href="/p/2">2 again</a><a href="/about?utm_source=x">about</a></p>')
+    collapse = Mock()
+    wrapper = DOMWrapper(lhtml.fromstring(page), base_url='http://fab.com',
+                         canonicalize=Canonicalizer(), collapse=collapse)
+
+    expect(wrapper.links(pattern='/p/')).to.equal([
+        'http://fab.com/p/2',
+        'http://fab.com/p/3',
+        'http://fab.com/p/4',
+    ])
+    collapse.assert_called_once_with(2)
+
+
+def test_links_without_canonicalizer_collapse_nothing():
+    "DOMWrapper.links doesn't count dropped fragments when there is no canonicalizer"
+
+    collapse = Mock()
+    wrapper = DOMWrapper(lhtml.fromstring(LINKS_PAGE), base_url='http://fab.com', collapse=collapse)
+
+    wrapper.links()
+
+    collapse.called.should.be.false
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import pickle
+from mock import Mock
+from cello.helpers import FrozenDict
+from cello.models import Stage, ParentContext
+
+
+class Brand(Stage):
+    def context_data(self):
+        return {'brand': 'cello'}
+
+
+def test_from_stage():
+    ("ParentContext.from_stage keeps the url, base url, "
+     "name and context data of a stage")
+
+    context = ParentContext.from_stage(Brand(Mock(), url='http://fab.com/brand/1?page=2'))
+
+    context.url.should.equal('http://fab.com/brand/1?page=2')
+    context.base_url.should.equal('http://fab.com')
+    context.name.should.equal('tests.unit.models.test_parent_context.Brand')
+    context.data.should.equal({'brand': 'cello'})
+
+
+def test_from_stage_keeps_contexts_and_nones():
+    ("ParentContext.from_stage returns contexts and None as they are")
+
+    context = ParentContext('http://fab.com', 'http://fab.com', 'brand', {})
+
+    ParentContext.from_stage(context).should.be(context)
+    ParentContext.from_stage(None).should.be.none
+
+
+def test_is_immutable():
+    ("ParentContext can't be changed")
+
+    context = ParentContext('http://fab.com', 'http://fab.com', 'brand', {})
+
+    context.__setattr__.when.called_with('url', 'http://other.com').should.throw(AttributeError)
+
+
+def test_data_is_frozen():
+    ("ParentContext freezes its data, which every child of the parent shares")
+
+    context = ParentContext.from_stage(Brand(Mock(), url='http://fab.com/brand/1'))
+
+    context.data.should.be.a(FrozenDict)
+    context.data.__setitem__.when.called_with('brand', 'other').should.throw(TypeError)
+    ParentContext('http://fab.com', 'http://fab.com', 'brand', {'brand': 'cello'}).data.should.be.a(FrozenDict)
+    ParentContext('http://fab.com', 'http://fab.com', 'brand', None).data.should.equal({})
+
+
+def test_stage_data_matches_its_context():
+    ("Stage.data is the data of the context of the stage, so children "
+     "read it the same way whether their parent is a stage or a context")
+
+    stage = Brand(Mock(), url='http://fab.com/brand/1')
+
+    stage.data.should.equal({'brand': 'cello'})
+    stage.data.should.be.a(FrozenDict)
+    stage.data.should.equal(ParentContext.from_stage(stage).data)
+
+
+def test_pickles():
+    ("ParentContext survives pickling")
+
+    context = ParentContext.from_stage(Brand(Mock(), url='http://fab.com/brand/1'))
+
+    for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+        loaded = pickle.loads(pickle.dumps(context, protocol))
+        loaded.should.equal(context)
+        loaded.data.should.be.a(FrozenDict)
+
+
+def test_fallback_url_from_a_context():
+    ("Stage.url falls back to the base url of a parent context")
+
+    context = ParentContext.from_stage(Brand(Mock(), url='http://fab.com/brand/1'))
+
+    Stage(Mock(), url='/product/2', parent=context).url.should.equal(
+        'http://fab.com/product/2')
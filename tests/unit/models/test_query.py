@@ -5,25 +5,58 @@ from sure import expect
 from cello.models import Query
 
 
-def test_query_methods_never_fail_by_returning_itself():
+@patch('cello.models.selector_cache')
+def test_query_methods_never_fail_by_returning_itself(selector_cache):
     "Query methods never fail because it always returns itself"
 
     dom = Mock()
-    dom.cssselect.return_value = []
+    selector_cache.css.return_value.return_value = []
     query = Query(dom)
 
     expect(query.query('a')).to.be.a(Query)
     expect(query.query('a').attr('href')).to.be.a(Query)
 
+@patch('cello.models.selector_cache')
+def test_query_uses_the_compiled_selector(selector_cache):
+    "Query.query evaluates the cached compiled selector against the dom"
+
+    dom = Mock()
+    selector_cache.css.return_value.return_value = []
+
+    Query(dom).query('li a')
+
+    selector_cache.css.assert_called_once_with('li a')
+    selector_cache.css.return_value.assert_called_once_with(dom)
+
+
+@patch('cello.models.selector_cache')
+def test_query_is_as_long_as_its_elements(selector_cache):
+    "Query has the length of the elements it matched and iterates over them, so an empty one is falsy"
+
+    dom = Mock()
+    l1 = Mock(attrib={})
+    l2 = Mock(attrib={})
+    query = Query(dom)
+
+    selector_cache.css.return_value.return_value = []
+    expect(len(query.query('li a'))).to.equal(0)
+    expect(bool(query.query('li a'))).to.be.false
+
+    selector_cache.css.return_value.return_value = [l1, l2]
+    expect(len(query.query('li a'))).to.equal(2)
+    expect(bool(query.query('li a'))).to.be.true
+    expect(list(query.query('li a'))).to.equal([l1, l2])
+
 # Testing .__repr__
 
 
-def test_query_and_repr_with_no_objects():
+@patch('cello.models.selector_cache')
+def test_query_and_repr_with_no_objects(selector_cache):
     "Query by atributes with no objects"
 
     dom = Mock()
 
-    dom.cssselect.return_value = range(10)
+    selector_cache.css.return_value.return_value = range(10)
 
     query = Query(dom)
 
@@ -32,12 +65,13 @@ def test_query_and_repr_with_no_objects():
 
 # Testing .attr
 
-def test_query_and_attr_with_no_objects():
+@patch('cello.models.selector_cache')
+def test_query_and_attr_with_no_objects(selector_cache):
     "Query by atributes with no objects"
 
     dom = Mock()
 
-    dom.cssselect.return_value = []
+    selector_cache.css.return_value.return_value = []
 
     query = Query(dom)
 
@@ -46,14 +80,35 @@ def test_query_and_attr_with_no_objects():
     expect(q.raw()).to.equal([])
 
 
-def test_query_and_attr_with_many_objects():
+@patch('cello.models.selector_cache')
+def test_query_and_attr_missing_from_some_objects(selector_cache):
+    "Query by atributes reads the ones missing from an element as an empty string"
+
+    dom = Mock()
+    l1 = Mock(attrib={'href': 'http://yipit.com'})
+    l2 = Mock(attrib={'title': 'no link'})
+    l3 = Mock(attrib={'href': ''})
+
+    selector_cache.css.return_value.return_value = [l1, l2, l3]
+
+    query = Query(dom)
+
+    expect(query.query('li a').attr('href').raw()).to.equal(['http://yipit.com', '', ''])
+    expect(query.query('li a').attr('href').last()).to.equal('')
+
+    selector_cache.css.return_value.return_value = [l2]
+    expect(query.query('li a').attr('href').first()).to.equal('')
+
+
+@patch('cello.models.selector_cache')
+def test_query_and_attr_with_many_objects(selector_cache):
     "Query by atributes with many"
 
     dom = Mock()
     l1 = Mock(attrib={'href': 'http://yipit.com'})
     l2 = Mock(attrib={'href': 'http://github.com'})
 
-    dom.cssselect.return_value = [l1, l2]
+    selector_cache.css.return_value.return_value = [l1, l2]
 
     query = Query(dom)
 
@@ -63,13 +118,14 @@ def test_query_and_attr_with_many_objects():
     ])
 
 
-def test_query_and_attr_with_one_object():
+@patch('cello.models.selector_cache')
+def test_query_and_attr_with_one_object(selector_cache):
     "Query by atributes with one object"
 
     dom = Mock()
     link = Mock(attrib={'href': 'http://yipit.com'})
 
-    dom.cssselect.return_value = [link]
+    selector_cache.css.return_value.return_value = [link]
 
     query = Query(dom)
 
@@ -79,14 +135,15 @@ def test_query_and_attr_with_one_object():
 
 # .one ()
 
-def test_query_attr_one_with_many_objects():
+@patch('cello.models.selector_cache')
+def test_query_attr_one_with_many_objects(selector_cache):
     "Query by atributes with many and calling .one()"
 
     dom = Mock()
     l1 = Mock(attrib={'href': 'http://yipit.com'})
     l2 = Mock(attrib={'href': 'http://github.com'})
 
-    dom.cssselect.return_value = [l1, l2]
+    selector_cache.css.return_value.return_value = [l1, l2]
 
     query = Query(dom)
 
@@ -94,13 +151,14 @@ def test_query_attr_one_with_many_objects():
         'http://yipit.com')
 
 
-def test_query_attr_one_with_one_object():
+@patch('cello.models.selector_cache')
+def test_query_attr_one_with_one_object(selector_cache):
     "Query by atributes with one object"
 
     dom = Mock()
     link = Mock(attrib={'href': 'http://yipit.com'})
 
-    dom.cssselect.return_value = [link]
+    selector_cache.css.return_value.return_value = [link]
 
     query = Query(dom)
 
@@ -108,11 +166,12 @@ def test_query_attr_one_with_one_object():
         'http://yipit.com')
 
 
-def test_query_attr_one_with_no_objects():
+@patch('cello.models.selector_cache')
+def test_query_attr_one_with_no_objects(selector_cache):
     "Query by atributes with no objects"
 
     dom = Mock()
-    dom.cssselect.return_value = []
+    selector_cache.css.return_value.return_value = []
 
     query = Query(dom)
 
@@ -121,14 +180,15 @@ def test_query_attr_one_with_no_objects():
 
 # Testing .first
 
-def test_query_attr_first_with_many_objects():
+@patch('cello.models.selector_cache')
+def test_query_attr_first_with_many_objects(selector_cache):
     "Query by atributes with many and calling .first()"
 
     dom = Mock()
     l1 = Mock(attrib={'href': 'http://yipit.com'})
     l2 = Mock(attrib={'href': 'http://github.com'})
 
-    dom.cssselect.return_value = [l1, l2]
+    selector_cache.css.return_value.return_value = [l1, l2]
 
     query = Query(dom)
 
@@ -136,13 +196,14 @@ def test_query_attr_first_with_many_objects():
         'http://yipit.com')
 
 
-def test_query_attr_first_with_first_object():
+@patch('cello.models.selector_cache')
+def test_query_attr_first_with_first_object(selector_cache):
     "Query by atributes with one object"
 
     dom = Mock()
     link = Mock(attrib={'href': 'http://yipit.com'})
 
-    dom.cssselect.return_value = [link]
+    selector_cache.css.return_value.return_value = [link]
 
     query = Query(dom)
 
@@ -150,11 +211,12 @@ def test_query_attr_first_with_first_object():
         'http://yipit.com')
 
 
-def test_query_attr_first_with_no_objects():
+@patch('cello.models.selector_cache')
+def test_query_attr_first_with_no_objects(selector_cache):
     "Query by atributes with no objects"
 
     dom = Mock()
-    dom.cssselect.return_value = []
+    selector_cache.css.return_value.return_value = []
 
     query = Query(dom)
 
@@ -163,14 +225,15 @@ def test_query_attr_first_with_no_objects():
 
 # Testing .last
 
-def test_query_attr_last_with_many_objects():
+@patch('cello.models.selector_cache')
+def test_query_attr_last_with_many_objects(selector_cache):
     "Query by atributes with many and calling .last()"
 
     dom = Mock()
     l1 = Mock(attrib={'href': 'http://yipit.com'})
     l2 = Mock(attrib={'href': 'http://github.com'})
 
-    dom.cssselect.return_value = [l1, l2]
+    selector_cache.css.return_value.return_value = [l1, l2]
 
     query = Query(dom)
 
@@ -178,13 +241,14 @@ def test_query_attr_last_with_many_objects():
         'http://github.com')
 
 
-def test_query_attr_last_with_last_object():
+@patch('cello.models.selector_cache')
+def test_query_attr_last_with_last_object(selector_cache):
     "Query by atributes with one object"
 
     dom = Mock()
     link = Mock(attrib={'href': 'http://yipit.com'})
 
-    dom.cssselect.return_value = [link]
+    selector_cache.css.return_value.return_value = [link]
 
     query = Query(dom)
 
@@ -192,11 +256,12 @@ def test_query_attr_last_with_last_object():
         'http://yipit.com')
 
 
-def test_query_attr_last_with_no_objects():
+@patch('cello.models.selector_cache')
+def test_query_attr_last_with_no_objects(selector_cache):
     "Query by atributes with no objects"
 
     dom = Mock()
-    dom.cssselect.return_value = []
+    selector_cache.css.return_value.return_value = []
 
     query = Query(dom)
 
@@ -205,49 +270,53 @@ def test_query_attr_last_with_no_objects():
 
 # Testing .text
 
-def test_query_and_text_with_no_objects():
+@patch('cello.models.selector_cache')
+def test_query_and_text_with_no_objects(selector_cache):
     "Query and retrieve text with no objects"
 
     dom = Mock()
 
-    dom.cssselect.return_value = []
+    selector_cache.css.return_value.return_value = []
 
     query = Query(dom)
     expect(query.query('ul.menu li a').text()).to.equal('')
 
 
-def test_query_and_text_with_many_objects():
+@patch('cello.models.selector_cache')
+def test_query_and_text_with_many_objects(selector_cache):
     "Query and retrieve text with many objects"
 
     dom = Mock()
     l1 = Mock(text='  foo  ')
     l2 = Mock(text=' \n bar \n  ')
 
-    dom.cssselect.return_value = [l1, l2]
+    selector_cache.css.return_value.return_value = [l1, l2]
 
     query = Query(dom)
     expect(query.query('ul.menu li a').text()).to.equal(['foo', 'bar'])
 
 
-def test_query_and_text_with_none():
+@patch('cello.models.selector_cache')
+def test_query_and_text_with_none(selector_cache):
     "Query and retrieve text when it's None"
 
     dom = Mock()
     l1 = Mock(text=None)
 
-    dom.cssselect.return_value = [l1]
+    selector_cache.css.return_value.return_value = [l1]
 
     query = Query(dom)
     expect(query.query('ul.menu li a').text()).to.equal([''])
 
 
-def test_query_and_text_with_one_object():
+@patch('cello.models.selector_cache')
+def test_query_and_text_with_one_object(selector_cache):
     "Query and retrieve text with one object"
 
     dom = Mock()
     l1 = Mock(text='  foo  ')
 
-    dom.cssselect.return_value = [l1]
+    selector_cache.css.return_value.return_value = [l1]
 
     query = Query(dom)
     expect(query.query('ul.menu li a').text()).to.equal('foo')
@@ -255,16 +324,69 @@ def test_query_and_text_with_one_object():
 
 # Testing .html
 
+@patch('cello.models.selector_cache')
 @patch('cello.models.lhtml')
-def test_query_and_html_calls_tostring(lhtml):
+def test_query_and_html_calls_tostring(lhtml, selector_cache):
     "Query and retrieve html calls lxml"
 
     dom = Mock()
 
     lhtml.tostring.return_value = '<a></a>'
-    dom.cssselect.return_value = ['whatever']
+    selector_cache.css.return_value.return_value = ['whatever']
 
     query = Query(dom)
     expect(query.query('ul.menu li a').html()).to.equal('<a></a>')
 
     lhtml.tostring.assert_called_once_with('whatever')
+
+
+# Immutability
+
+def test_query_results_are_immutable():
+    "Query results can't be changed once created"
+
+    query = Query(Mock())
+
+    def change_it():
+        query._elements = ['foo']
+
+    expect(change_it).when.called.to.throw(
+        AttributeError, 'Query results are immutable, cannot set _elements')
+    expect(query).to_not.have.property('__dict__')
+
+
+@patch('cello.models.selector_cache')
+def test_interleaved_queries_do_not_clobber_each_other(selector_cache):
+    "Query.query returns a new result every time"
+
+    dom = Mock()
+    l1 = Mock(attrib={'href': 'http://yipit.com'})
+    l2 = Mock(attrib={'href': 'http://github.com'})
+
+    selector_cache.css.return_value.side_effect = [[l1], [l1, l2]]
+
+    query = Query(dom)
+    first = query.query('li.first a')
+    both = query.query('li a')
+
+    expect(first.attr('href').raw()).to.equal('http://yipit.com')
+    expect(both.attr('href').raw()).to.equal([
+        'http://yipit.com',
+        'http://github.com',
+    ])
+    expect(len(first)).to.equal(1)
+    expect(list(both)).to.equal([l1, l2])
+
+
+@patch('cello.models.selector_cache')
+def test_attr_shares_the_matched_elements(selector_cache):
+    "Query.attr returns a new result that shares the matched elements"
+
+    dom = Mock()
+    selector_cache.css.return_value.return_value = [Mock(attrib={'href': 'http://yipit.com'})]
+
+    links = Query(dom).query('a')
+    hrefs = links.attr('href')
+
+    expect(hrefs).to_not.equal(links)
+    expect(hrefs._elements).to.be(links._elements)
@@ -1,6 +1,10 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import os
 import re
+import time
+import shutil
+import tempfile
 from mock import Mock
 from mock import patch
 from sure import expect
@@ -8,11 +12,16 @@ from cello import models
 from cello.models import Stage
 from cello.models import InvalidStateError
 from cello.models import DOMWrapper
+from cello.models import ParentContext
 from cello.models import CelloStopScraping
 from cello.models import CelloJumpToNextStage
 from cello.models import BadTuneReturnValue
-from cello.storage import Case
-from cello.helpers import Route
+from cello.storage import Case, PersistWriter, FingerprintStore
+from cello.cache import ContentIndex, ResponseCache
+from cello.extraction import Field
+from cello.frontier import Frontier, FETCHED, TUNED, PERSISTED
+from cello.scheduler import Scheduler
+from cello.helpers import Route, RouteTable
 from cello.helpers import InvalidURLMapping
 
 models.DEBUG = True
@@ -43,7 +52,79 @@ def test_stop_scraping_all_of_the_sudden():
     browser.get.return_value.html = '<html><ul></ul></html>'
     browser.get.return_value.url = 'http://foobar.com'
 
-    StoppableStage.visit(browser)
+    result = StoppableStage.visit(browser)
+
+    expect(result).to.be.a(CelloStopScraping)
+    expect(result.stats['frontier.urls']).to.equal(0)
+
+
+def test_visit_returns_the_stats_of_the_crawl():
+    "Stage.visit returns the counters of the stages, frontier, scheduler and caches of the crawl"
+
+    class Product(Stage):
+        cache = ResponseCache(tempfile.mkdtemp())
+
+        def play(self):
+            pass
+
+    class Listing(Stage):
+        url = 'http://foo.com'
+        next_stage = Product
+
+        def play(self):
+            self.fetch()
+            self.scrape(['http://foo.com/1', 'http://foo.com/2', 'http://foo.com/1'])
+
+    browser = Mock()
+    browser.get.return_value = Mock(content='<p>cello</p>', status_code=200, headers={})
+
+    try:
+        stats = Listing.visit(browser)
+    finally:
+        shutil.rmtree(Product.cache.directory)
+
+    expect(stats['frontier.urls']).to.equal(2)
+    expect(stats['frontier.duplicates']).to.equal(1)
+    expect(stats['scheduler.hosts']).to.equal(1)
+    expect(stats['cache.misses']).to.equal(2)
+    expect(stats['cache.stored']).to.equal(2)
+
+
+def test_children_read_the_data_of_their_parent():
+    "Stage.visit hands children a parent whose data is the context data of the parent"
+
+    saved = []
+
+    class SavingCase(Case):
+        def save(self, data):
+            saved.append(data)
+
+    class Product(Stage):
+        case = SavingCase
+
+        def play(self):
+            pass
+
+        def tune(self):
+            return {'brand': self.parent.data['brand']}
+
+    class Brand(Stage):
+        url = 'http://foo.com/brand'
+        next_stage = Product
+
+        def context_data(self):
+            return {'brand': self.dom.query('h1').text()}
+
+        def play(self):
+            self.fetch()
+            self.scrape(['http://foo.com/1'])
+
+    browser = Mock()
+    browser.get.return_value = Mock(content='<h1>cello</h1>', status_code=200, headers={})
+
+    Brand.visit(browser)
+
+    expect(saved).to.equal([{'url': 'http://foo.com/1', 'brand': 'cello'}])
 
 
 def test_absolute_url():
@@ -95,6 +176,32 @@ def test_dom_is_a_dom_wrapper(lhtml):
     expect(stage.dom).to.be.a(DOMWrapper)
 
 
+@patch('cello.models.lhtml')
+def test_dom_is_parsed_once_per_response(lhtml):
+    "Stage.dom parses the response only once and reuses it"
+    stage = Stage(Mock(), response=Mock())
+
+    expect(stage.dom).to.equal(stage.dom)
+
+    lhtml.fromstring.assert_called_once_with(stage.response.content)
+    expect(stage.stats['dom.parsed']).to.equal(1)
+
+
+@patch('cello.models.lhtml')
+def test_dom_is_dropped_when_the_response_changes(lhtml):
+    "Stage.dom is parsed again after fetch() replaces the response"
+
+    browser = Mock()
+    stage = Stage(browser, url='http://foobar.com', response=Mock())
+
+    first_dom = stage.dom
+    stage.fetch()
+
+    expect(stage.dom).to_not.equal(first_dom)
+    expect(lhtml.fromstring.call_count).to.equal(2)
+    expect(stage.stats['dom.parsed']).to.equal(2)
+
+
 def test_dom_raises_exception_if_response_is_none():
     "Stage.dom raises exception is self.response is None"
 
@@ -162,6 +269,38 @@ def test_url_fallsback_to_parent_if_routed_is_not_absolute():
     expect(st.url).to.equal('http://awesome.io/test/one.php')
 
 
+def test_url_is_resolved_once():
+    ("Stage.url resolves the url once, until the url or the parent of the stage change")
+
+    class MyRoute(Route):
+        url_mapping = 'foo.bar.com/{page}'
+        url_regex = re.compile(r'(?P<page>.*).php')
+
+    class ChildrenSomeStage(Stage):
+        route = MyRoute
+
+    class SomeStage(Stage):
+        url = 'http://awesome.io'
+
+    browser = Mock()
+    st = ChildrenSomeStage(browser=browser, parent=SomeStage(browser=browser), url='/test/one.php')
+
+    with patch.object(MyRoute, 'translate', wraps=MyRoute.translate) as translate:
+        expect(st.url).to.equal('http://awesome.io/test/one.php')
+        expect(st.absolute_url('/two')).to.equal('http://awesome.io/two')
+        expect(st.url_parts.path).to.equal('/test/one.php')
+        expect(translate.call_count).to.equal(1)
+
+        st._url = '/test/two.php'
+        expect(st.url).to.equal('http://awesome.io/test/two.php')
+        st.parent = ParentContext('http://cool.io/sale', 'http://cool.io', 'SomeStage', {})
+        expect(st.url).to.equal('http://cool.io/test/two.php')
+        expect(translate.call_count).to.equal(3)
+
+    expect(st.stats['url.resolved']).to.equal(3)
+    expect(st.stats['url.cached']).to.equal(2)
+
+
 def test_url_using_mapping():
     ("Stage.url will attempt to use the URL from the route")
 
@@ -338,3 +477,505 @@ def test_tune_calls_fetch_by_default(datetime):
         'datetime': '[iso date]',
         'stage': 'tests.unit.models.test_stage.TuneStage',
     })
+
+
+@patch('cello.models.datetime')
+def test_tune_extracts_declared_fields(datetime):
+    ("Stage.tune() extracts the declared fields from the dom")
+
+    datetime.now.return_value.isoformat.return_value = '[iso date]'
+
+    class ProductStage(Stage):
+        fields = {
+            'name': '.product h1',
+            'image': Field('img', attr='src'),
+        }
+
+    response = Mock(content='<div class="product"><h1>Lamp</h1><img src="/lamp.png"></div>')
+    st = ProductStage(Mock(), response=response)
+
+    expect(st.tune()).to.equal({
+        'datetime': '[iso date]',
+        'stage': 'tests.unit.models.test_stage.ProductStage',
+        'name': 'Lamp',
+        'image': '/lamp.png',
+    })
+
+
+def test_fields_are_compiled_once_per_stage_class():
+    ("Stage subclasses compile their fields when the class is created")
+
+    class ProductStage(Stage):
+        fields = {'name': 'h1'}
+
+    class OtherStage(Stage):
+        fields = {'price': '.price'}
+
+    expect(ProductStage._extractor).to.equal(ProductStage(Mock())._extractor)
+    expect(ProductStage._extractor.fields.keys()).to.equal(['name'])
+    expect(OtherStage._extractor.fields.keys()).to.equal(['price'])
+
+
+def test_dom_resolves_links_against_the_stage_url():
+    ("Stage.dom knows the stage url so its links are absolute")
+
+    class ListingStage(Stage):
+        url = 'http://fab.com/sales/'
+
+    response = Mock(content='<ul><li><a href="/sale/lamps">lamps</a></li></ul>')
+    st = ListingStage(Mock(), response=response)
+
+    expect(st.dom.links()).to.equal(['http://fab.com/sale/lamps'])
+
+
+def test_scrape_fetches_each_url_once_per_crawl():
+    ("Stage.scrape skips links that the crawl frontier has already seen")
+
+    persist_mock = Mock()
+
+    class ProductStage(Stage):
+        persist = persist_mock
+
+        def tune(self):
+            return {'foo': 'bar'}
+
+    browser = Mock()
+    frontier = Frontier()
+
+    st = ProductStage(browser, frontier=frontier)
+    st.scrape(['http://fab.com/product/1', 'http://fab.com/product/1'])
+    ProductStage(browser, frontier=frontier).scrape('http://fab.com/product/1')
+
+    browser.get.assert_called_once_with(
+        'http://fab.com/product/1',
+        config=dict(screenshot=True),
+    )
+    persist_mock.assert_called_once_with({'foo': 'bar'})
+    expect(frontier.duplicates).to.equal(2)
+
+
+def test_next_stages_share_the_frontier():
+    ("Stage.proceed_to_next hands its frontier to the next stage")
+
+    class SecondStage(Stage):
+        def play(self):
+            pass
+
+    class FirstStage(Stage):
+        next_stage = SecondStage
+
+    st = FirstStage(Mock())
+
+    expect(st.proceed_to_next('http://foobar.com').frontier).to.be(st.frontier)
+    expect(st.proceed_to_next('http://foobar.com')).to.be.none
+
+
+def test_frontier_is_keyed_on_canonical_urls():
+    ("Stage.scrape fetches canonical urls once, counting the "
+     "urls the canonicalizer rewrote")
+
+    class ProductStage(Stage):
+        persist = Mock()
+
+        def tune(self):
+            return {'foo': 'bar'}
+
+    browser = Mock()
+    st = ProductStage(browser)
+    st.scrape([
+        'http://fab.com/product/1?utm_source=mail',
+        'http://FAB.com/product/1#reviews',
+        'http://fab.com/product/1',
+    ])
+
+    browser.get.assert_called_once_with(
+        'http://fab.com/product/1',
+        config=dict(screenshot=True),
+    )
+    expect(st.frontier.report()).to.equal({
+        'frontier.urls': 1,
+        'frontier.duplicates': 2,
+        'frontier.collapsed': 2,
+    })
+
+
+def test_frontier_counts_the_links_the_dom_canonicalized():
+    ("Stage.scrape(self.dom.links()) counts the links the canonicalizer "
+     "rewrote, even though they reach the frontier already canonical")
+
+    class ProductStage(Stage):
+        persist = Mock()
+
+        def play(self):
+            pass
+
+        def tune(self):
+            return {'foo': 'bar'}
+
+    class ListingStage(Stage):
+        url = 'http://fab.com/sales/'
+        next_stage = ProductStage
+
+    response = Mock(content='<p><a href="/product/2?utm_source=x">2</a>'
+                            '<a href="/product/3#frag">3</a><a href="/product/4">4</a></p>')
+    st = ListingStage(Mock(), response=response)
+    st.scrape(st.dom.links(pattern='/product/'))
+
+    expect(st.frontier.report()).to.equal({
+        'frontier.urls': 3,
+        'frontier.duplicates': 0,
+        'frontier.collapsed': 2,
+    })
+
+
+def test_stage_with_custom_canonicalizer():
+    ("Stage.canonicalizer can be replaced by any callable")
+
+    class NoQueryStage(Stage):
+        url = 'http://fab.com/?page=1'
+        canonicalizer = staticmethod(lambda url: url.split('?')[0])
+
+    expect(NoQueryStage(Mock()).canonical_url).to.equal('http://fab.com/')
+
+
+def test_persist_through_a_buffer():
+    ("Stage.persist hands the data to the buffer of the crawl if there is one")
+
+    class MyCase(Case):
+        save = Mock()
+
+    class MyStage(Stage):
+        case = MyCase
+
+    buffer = Mock()
+    stage = MyStage(Mock(), url='http://foo.com', buffer=buffer)
+
+    stage.persist({'name': 'cello'})
+
+    buffer.add.assert_called_once_with(MyCase, stage, {'url': 'http://foo.com', 'name': 'cello'})
+    MyCase.save.called.should.be.false
+
+
+def test_persist_skips_unchanged_items():
+    ("Stage.persist doesn't save the items that are the same as the ones "
+     "saved by a previous crawl")
+
+    directory = tempfile.mkdtemp()
+
+    class MyCase(Case):
+        save = Mock()
+
+    class MyStage(Stage):
+        case = MyCase
+        fingerprints = FingerprintStore(os.path.join(directory, 'items.db'))
+
+    try:
+        frontier = Mock()
+        for name in ('cello', 'cello', 'viola'):
+            stage = MyStage(Mock(), url='http://foo.com', frontier=frontier)
+            stage.persist(dict(stage.tune(), name=name))
+    finally:
+        shutil.rmtree(directory)
+
+    MyCase.save.call_count.should.equal(2)
+    [state for (stage, state), kw in frontier.mark.call_args_list].should.equal(
+        [PERSISTED, PERSISTED, PERSISTED])
+    MyStage.fingerprints.report().should.equal({'items.changed': 2, 'items.unchanged': 1})
+
+
+def test_visit_flushes_the_buffer():
+    ("Stage.visit hands the buffer to every stage and flushes it at the end")
+
+    class Product(Stage):
+        def fetch(self):
+            pass
+
+        def play(self):
+            pass
+
+        def tune(self):
+            return {'product': self.url}
+
+    class Listing(Stage):
+        url = 'http://foo.com'
+        next_stage = Product
+
+        def fetch(self):
+            pass
+
+        def play(self):
+            self.scrape(['http://foo.com/1', 'http://foo.com/2'])
+            raise CelloStopScraping('done')
+
+    buffer = Mock()
+    buffer.report.return_value = {}
+
+    Listing.visit(Mock(), buffer=buffer)
+
+    [call[0][2]['product'] for call in buffer.add.call_args_list].should.equal(
+        ['http://foo.com/1', 'http://foo.com/2'])
+    buffer.flush.assert_called_once_with()
+
+
+def test_visit_waits_for_the_writer():
+    ("Stage.visit returns once the background writer saved everything")
+
+    saved = []
+
+    class SlowCase(Case):
+        def save(self, data):
+            time.sleep(0.01)
+            saved.append(data['url'])
+
+    class Product(Stage):
+        case = SlowCase
+
+        def fetch(self):
+            pass
+
+        def play(self):
+            pass
+
+    class Listing(Stage):
+        url = 'http://foo.com'
+        next_stage = Product
+
+        def fetch(self):
+            pass
+
+        def play(self):
+            self.scrape(['http://foo.com/1', 'http://foo.com/2', 'http://foo.com/3'])
+            raise CelloStopScraping('done')
+
+    Listing.visit(Mock(), buffer=PersistWriter(maxsize=1))
+
+    saved.should.equal(['http://foo.com/1', 'http://foo.com/2', 'http://foo.com/3'])
+
+
+def test_proceed_to_next_dispatches_links_through_the_route_table():
+    ("Stage.proceed_to_next hands each link to the stage its route names, "
+     "and to the next stage when it has none")
+
+    class ProductStage(Stage):
+        def play(self):
+            pass
+
+    class SaleStage(ProductStage):
+        pass
+
+    class ListingStage(Stage):
+        next_stage = SaleStage
+        route = RouteTable([
+            ('product', r'/product/(?P<id>\d+)', 'http://fab.com/product/{id}', ProductStage),
+            ('sale', r'/sale/(?P<name>\w+)', 'http://fab.com/sale/{name}'),
+        ])
+
+    listing = ListingStage(Mock())
+
+    listing.proceed_to_next('http://fab.com/product/1').__class__.should.be(ProductStage)
+    listing.proceed_to_next('http://fab.com/sale/lamps').__class__.should.be(SaleStage)
+    listing.proceed_to_next('http://fab.com/about').__class__.should.be(SaleStage)
+
+
+def test_fetch_through_the_cache():
+    ("Stage.fetch goes through the cache of the stage when it has one")
+
+    class CachedStage(Stage):
+        cache = Mock()
+
+    browser = Mock()
+    stage = CachedStage(browser, url='http://foo.com')
+    stage.fetch()
+
+    CachedStage.cache.fetch.call_count.should.equal(1)
+    url, get_response, get_conditional_response = CachedStage.cache.fetch.call_args[0]
+    url.should.equal('http://foo.com')
+    stage.response.should.equal(CachedStage.cache.fetch.return_value)
+
+    get_response('http://foo.com').should.equal(browser.get.return_value)
+    get_conditional_response('http://foo.com', {'If-None-Match': '"v1"'}).should.equal(
+        browser.get.return_value)
+    browser.get.call_count.should.equal(2)
+
+
+def test_fetch_through_the_index():
+    ("Stage.fetch tells whether the page changed since the previous crawl "
+     "when the stage has a content index")
+
+    class IndexedStage(Stage):
+        index = Mock()
+
+    IndexedStage.index.fetch.return_value = ('response', True, None)
+    browser = Mock()
+    stage = IndexedStage(browser, url='http://foo.com')
+    stage.fetch()
+
+    url, get_response, get_conditional_response = IndexedStage.index.fetch.call_args[0]
+    url.should.equal('http://foo.com')
+    get_response('http://foo.com').should.equal(browser.get.return_value)
+    stage.response.should.equal('response')
+    stage.unchanged.should.be.true
+    stage.not_modified.should.be.false
+
+
+def test_scrape_skips_unchanged_pages():
+    ("Stage.scrape neither tunes nor persists pages that didn't change "
+     "since the previous crawl, and doesn't play those that were not modified")
+
+    class ProductStage(Stage):
+        index = Mock()
+        play = Mock()
+        tune = Mock()
+        persist = Mock()
+
+    class ListingStage(Stage):
+        next_stage = ProductStage
+
+    ProductStage.index.fetch.side_effect = [('response', True, None), (None, True, None)]
+    frontier = Mock()
+    frontier.add.return_value = True
+
+    ListingStage(Mock(), frontier=frontier).scrape(['http://fab.com/product/1', 'http://fab.com/product/2'])
+
+    ProductStage.play.call_count.should.equal(1)
+    ProductStage.tune.called.should.be.false
+    ProductStage.persist.called.should.be.false
+    [state for (stage, state), kw in frontier.mark.call_args_list].should.equal(
+        [FETCHED, PERSISTED, FETCHED, PERSISTED])
+
+
+def test_pages_whose_item_failed_to_save_are_saved_by_the_next_crawl():
+    ("Stage.scrape only remembers a page in its content index once it is "
+     "persisted, so that a failed save is made up for by the next crawl")
+
+    directory = tempfile.mkdtemp()
+    saved = []
+
+    class FlakyCase(Case):
+        fail = True
+
+        def save(self, data):
+            if FlakyCase.fail:
+                raise IOError('disk is full')
+            saved.append(data['url'])
+
+    class ProductStage(Stage):
+        case = FlakyCase
+        index = ContentIndex(os.path.join(directory, 'index.db'))
+
+        def play(self):
+            pass
+
+    class ListingStage(Stage):
+        next_stage = ProductStage
+
+    browser = Mock()
+    browser.get.return_value = Mock(content='<p>cello</p>', status_code=200, headers={})
+    try:
+        expect(ListingStage(browser).scrape).when.called_with('http://fab.com/product/1').to.throw(IOError)
+        FlakyCase.fail = False
+        ListingStage(browser).scrape('http://fab.com/product/1')
+        ListingStage(browser).scrape('http://fab.com/product/1')
+    finally:
+        shutil.rmtree(directory)
+
+    saved.should.equal(['http://fab.com/product/1'])
+    ProductStage.index.report()['incremental.unchanged'].should.equal(1)
+
+
+def test_reachable_attributes_of_the_stages():
+    ("Stage.reachable returns an attribute of a stage and of the ones that follow "
+     "it, like their content indexes")
+
+    content_index = Mock()
+
+    class ProductStage(Stage):
+        index = content_index
+
+    class BrandStage(Stage):
+        next_stage = ProductStage
+        index = content_index
+
+    class HomeStage(Stage):
+        next_stage = BrandStage
+
+    HomeStage.reachable('index').should.equal([content_index])
+    Stage.reachable('index').should.equal([])
+
+
+def test_fetch_goes_through_the_scheduler():
+    ("Stage.fetch requests the page through the scheduler of the crawl")
+
+    scheduler = Mock()
+    stage = Stage(Mock(), url='http://foo.com/bar', scheduler=scheduler)
+
+    stage.fetch()
+
+    scheduler.request.assert_called_once_with(stage.get_response, 'http://foo.com/bar')
+    stage.response.should.equal(scheduler.request.return_value)
+
+
+def test_next_stages_share_the_scheduler():
+    ("Stage#proceed_to_next hands the scheduler down to the next stages")
+
+    class Last(Stage):
+        pass
+
+    class First(Stage):
+        next_stage = Last
+
+        def play(self):
+            pass
+
+    scheduler = Scheduler()
+    stage = First(Mock(), url='http://foo.com', scheduler=scheduler)
+
+    stage.proceed_to_next('http://foo.com/bar').scheduler.should.be(scheduler)
+
+
+def test_visit_records_the_progress_of_links_in_a_durable_frontier():
+    ("Stage.visit records every link found in a durable frontier, "
+     "and how far each one went")
+
+    class Product(Stage):
+        def play(self):
+            pass
+
+        def tune(self):
+            return {'product': self.url}
+
+    class Listing(Stage):
+        url = 'http://foo.com'
+        next_stage = Product
+
+        def play(self):
+            self.scrape(['http://foo.com/1'])
+
+    frontier = Mock(durable=True)
+    frontier.add.return_value = True
+    frontier.report.return_value = {}
+
+    Listing.visit(Mock(), frontier=frontier)
+
+    url, Stage_, parent = frontier.discover.call_args[0]
+    url.should.equal('http://foo.com/1')
+    Stage_.should.be(Product)
+    parent.should.equal(ParentContext('http://foo.com', 'http://foo.com', 'tests.unit.models.test_stage.Listing', {}))
+
+    [(stage.url, state) for (stage, state), kw in frontier.mark.call_args_list].should.equal([
+        ('http://foo.com/1', FETCHED),
+        ('http://foo.com/1', TUNED),
+        ('http://foo.com/1', PERSISTED),
+    ])
+
+
+def test_visit_resume_needs_a_durable_frontier():
+    ("Stage.visit can only resume a crawl through a durable frontier")
+
+    class Listing(Stage):
+        url = 'http://foo.com'
+
+    Listing.visit.when.called_with(Mock(), resume=True).should.throw(
+        InvalidStateError, 'Cannot resume a crawl of Listing without a durable frontier, '
+        'try frontier=SQLiteFrontier(path)')
+    Listing.visit.when.called_with(Mock(), resume=True, frontier=Frontier()).should.throw(InvalidStateError)
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import os
+import tempfile
+import threading
+from StringIO import StringIO
+from cello.storage import Case
+from cello.multi.browsers import BrowserPool
+from cello.multi.processing import WorkerPool, PersistencePool
+from cello.multi.serializers import PickleSerializer
+
+
+def double(number):
+    return number * 2, []
+
+
+def large(number):
+    # more than the 64KB that a pipe holds
+    return 'x' * 100000 + str(number), []
+
+
+def test_creates_queues_and_slots():
+    ("WorkerPool uses multiprocessing queues and shared slots [multiprocessing implementation]")
+
+    pool = WorkerPool(10, output=StringIO())
+
+    pool.max_workers.should.equal(10)
+    pool.tasks.should.be.a('multiprocessing.queues.Queue')
+    list(pool.current).should.equal([0] * 10)
+
+
+def test_counts_browsers_in_shared_memory():
+    ("WorkerPool wraps the browser factory in a BrowserPool whose "
+     "counters are shared with its workers [multiprocessing implementation]")
+
+    pool = WorkerPool(1, output=StringIO(), context={'browser_factory': 'factory'})
+
+    pool.context['browser_factory'].should.be.a(BrowserPool)
+    pool.context['browser_factory'].counters.shouldnt.be.a(list)
+
+
+def test_pickles_messages():
+    ("WorkerPool pickles messages before they hit the queues [multiprocessing implementation]")
+
+    pool = WorkerPool(1, output=StringIO())
+    message = (1, double, {'number': 2})
+
+    pool.serializer.should.be.a(PickleSerializer)
+    pool.encode(message).should.be.a(str)
+    pool.decode(pool.encode(message)).should.equal(message)
+
+
+def test_runs_tasks_on_recycled_processes():
+    ("WorkerPool replaces the processes that ran max_tasks_per_child "
+     "tasks [multiprocessing implementation]")
+
+    pool = WorkerPool(2, max_tasks_per_child=1, output=StringIO())
+    pool.start()
+    first = [worker.pid for worker in pool.workers]
+    try:
+        for number in range(4):
+            pool.submit(double, number=number)
+
+        results = []
+        while pool.pending:
+            result = pool.next_result()
+            if result is not None:
+                results.append(result[1])
+    finally:
+        pool.stop()
+
+    sorted(results).should.equal([0, 2, 4, 6])
+    pool.workers.should_not.contain(None)
+    [worker.pid for worker in pool.workers].should_not.equal(first)
+
+
+def test_submits_more_tasks_than_queued_with_large_results_and_recycling():
+    ("WorkerPool keeps reading results while submit waits for room, so that "
+     "retiring workers can flush large results and exit [multiprocessing implementation]")
+
+    pool = WorkerPool(2, max_tasks_per_child=2, max_queued=2, output=StringIO())
+    results = []
+
+    def crawl():
+        for number in range(20):
+            pool.submit(large, number=number)
+
+        while pool.pending:
+            result = pool.next_result()
+            if result is not None:
+                results.append(result[1])
+
+    pool.start()
+    try:
+        crawling = threading.Thread(target=crawl)
+        crawling.daemon = True
+        crawling.start()
+        crawling.join(30)
+        crawling.is_alive().should.be.false
+    finally:
+        pool.stop()
+
+    sorted(int(result[100000:]) for result in results).should.equal(range(20))
+
+
+class FileCase(Case):
+    def save_many(self, items):
+        with open(items[0]['path'], 'a') as output:
+            output.write('{0}\n'.format(len(items)))
+
+
+class FakeStage(object):
+    def __init__(self, browser_factory, url=None, frontier=None):
+        self.url = url
+
+
+def test_persistence_pool_saves_from_its_own_process():
+    ("PersistencePool saves items in batches from a "
+     "long-lived process [multiprocessing implementation]")
+
+    path = os.path.join(tempfile.mkdtemp(), 'saved.txt')
+    pool = PersistencePool(1, batch_size=2)
+    pool.start()
+
+    for n in range(5):
+        pool.put('tests.unit.multi.processing.test_worker_pool', 'FakeStage',
+                 'tests.unit.multi.processing.test_worker_pool', 'FileCase',
+                 'http://foo.com/%d' % n, {'path': path})
+
+    pool.close().should.be.empty
+
+    open(path).read().split().should.equal(['2', '2', '1'])
@@ -0,0 +1,425 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import gevent
+from mock import Mock, patch
+from sure import expect
+from cello.storage import Case, PersistBuffer
+from cello.models import CelloStopScraping, CelloJumpToNextStage, BadTuneReturnValue
+from cello.scheduler import Scheduler
+from cello.cache import ContentIndex
+from cello.frontier import SQLiteFrontier, PERSISTED
+from cello.models import ParentContext
+from cello.multi.asynchronous import AsyncStage, AsyncCrawl
+
+LISTING = '''<html><body>
+<a href="/product/1">1</a>
+<a href="/product/2">2</a>
+<a href="/product/3">3</a>
+<a href="/product/1">1 again</a>
+</body></html>'''
+
+
+class FakeBrowser(object):
+    def __init__(self, pages, crawl_stats):
+        self.pages = pages
+        self.crawl_stats = crawl_stats
+
+    def get(self, url):
+        self.crawl_stats['in_flight'] += 1
+        self.crawl_stats['peak'] = max(self.crawl_stats['peak'], self.crawl_stats['in_flight'])
+        gevent.sleep(0.01)
+        self.crawl_stats['in_flight'] -= 1
+        self.crawl_stats['fetched'].append(url)
+        return Mock(content=self.pages.get(url, '<p>{}</p>'.format(url)), status_code=200, headers={})
+
+
+def make_browser_factory(pages=None):
+    crawl_stats = {'in_flight': 0, 'peak': 0, 'fetched': []}
+    return (lambda: FakeBrowser(pages or {}, crawl_stats)), crawl_stats
+
+
+def test_async_stage_fetches_links_concurrently():
+    ("AsyncStage.visit fetches the links in greenlets, "
+     "tuning and persisting each one of them")
+
+    saved = []
+
+    class SavingCase(Case):
+        def save(self, data):
+            saved.append(data['url'])
+
+    class Product(AsyncStage):
+        case = SavingCase
+
+        def play(self):
+            pass
+
+    class Listing(AsyncStage):
+        url = 'http://fab.com/sale'
+        next_stage = Product
+
+        def play(self):
+            self.fetch()
+            self.scrape(self.dom.links(pattern='/product/'))
+
+    browser_factory, crawl_stats = make_browser_factory({'http://fab.com/sale': LISTING})
+
+    stats = Listing.visit(browser_factory, concurrency=10)
+
+    # counted once every greenlet is done, not when the root stage returns
+    expect(stats['frontier.urls']).to.equal(3)
+    expect(stats['dom.parsed']).to.equal(1)
+    expect(sorted(saved)).to.equal([
+        'http://fab.com/product/1',
+        'http://fab.com/product/2',
+        'http://fab.com/product/3',
+    ])
+    expect(crawl_stats['peak']).to.equal(3)
+
+
+def test_async_stage_children_read_the_data_of_their_parent():
+    ("AsyncStage.visit hands children a parent whose data is the "
+     "context data of the parent")
+
+    saved = []
+
+    class SavingCase(Case):
+        def save(self, data):
+            saved.append((data['url'], data['brand']))
+
+    class Product(AsyncStage):
+        case = SavingCase
+
+        def play(self):
+            pass
+
+        def tune(self):
+            return {'brand': self.parent.data['brand']}
+
+    class Listing(AsyncStage):
+        url = 'http://fab.com/sale'
+        next_stage = Product
+
+        def context_data(self):
+            return {'brand': 'fab'}
+
+        def play(self):
+            self.fetch()
+            self.scrape(self.dom.links(pattern='/product/'))
+
+    browser_factory, crawl_stats = make_browser_factory({'http://fab.com/sale': LISTING})
+
+    Listing.visit(browser_factory, concurrency=10)
+
+    expect(sorted(saved)).to.equal([
+        ('http://fab.com/product/1', 'fab'),
+        ('http://fab.com/product/2', 'fab'),
+        ('http://fab.com/product/3', 'fab'),
+    ])
+
+
+def test_async_stage_flushes_the_buffer_after_the_crawl():
+    ("AsyncStage.visit saves the buffered items once every greenlet is done")
+
+    batches = []
+
+    class BatchCase(Case):
+        def save_many(self, items):
+            batches.append(sorted(data['url'] for data in items))
+
+    class Product(AsyncStage):
+        case = BatchCase
+
+        def play(self):
+            pass
+
+    class Listing(AsyncStage):
+        url = 'http://fab.com/sale'
+        next_stage = Product
+
+        def play(self):
+            self.fetch()
+            self.scrape(self.dom.links(pattern='/product/'))
+
+    browser_factory, crawl_stats = make_browser_factory({'http://fab.com/sale': LISTING})
+
+    Listing.visit(browser_factory, concurrency=10, buffer=PersistBuffer(size=100))
+
+    expect(batches).to.equal([[
+        'http://fab.com/product/1',
+        'http://fab.com/product/2',
+        'http://fab.com/product/3',
+    ]])
+
+
+def test_async_stage_honors_the_concurrency_limit():
+    ("AsyncStage.visit never has more than `concurrency` fetches in flight")
+
+    class Product(AsyncStage):
+        pass
+
+    class Listing(AsyncStage):
+        url = 'http://fab.com/sale'
+        next_stage = Product
+
+        def play(self):
+            self.scrape(['http://fab.com/product/{}'.format(i) for i in range(20)])
+
+    browser_factory, crawl_stats = make_browser_factory()
+
+    Listing.visit(browser_factory, concurrency=4)
+
+    expect(len(crawl_stats['fetched'])).to.equal(20)
+    expect(crawl_stats['peak']).to.equal(4)
+
+
+def test_async_stage_honors_the_scheduler():
+    ("AsyncStage.visit keeps the fetches of a host within the limits "
+     "of the scheduler, while other hosts are fetched")
+
+    class Product(AsyncStage):
+        pass
+
+    class Listing(AsyncStage):
+        url = 'http://fab.com/sale'
+        next_stage = Product
+
+        def play(self):
+            self.scrape(['http://fab.com/product/{}'.format(i) for i in range(6)] +
+                        ['http://other.com/product/{}'.format(i) for i in range(6)])
+
+    browser_factory, crawl_stats = make_browser_factory()
+    scheduler = Scheduler(sleep=gevent.sleep, hosts={'fab.com': {'concurrency': 1}})
+
+    Listing.visit(browser_factory, concurrency=10, scheduler=scheduler)
+
+    expect(len(crawl_stats['fetched'])).to.equal(12)
+    # other.com is fetched all at once, fab.com one page at a time
+    expect(crawl_stats['peak']).to.equal(7)
+    expect(scheduler.report()['scheduler.throttled']).to.equal(5)
+
+
+def test_async_stage_stops_scraping():
+    ("AsyncStage.visit returns CelloStopScraping raised by any greenlet "
+     "and kills the rest of the crawl")
+
+    class StopCase(Case):
+        def save(self, data):
+            raise CelloStopScraping('enough')
+
+    class Product(AsyncStage):
+        case = StopCase
+
+    class Listing(AsyncStage):
+        url = 'http://fab.com/sale'
+        next_stage = Product
+
+        def play(self):
+            self.scrape(['http://fab.com/product/{}'.format(i) for i in range(20)])
+
+    browser_factory, crawl_stats = make_browser_factory()
+
+    with patch.object(gevent.get_hub(), 'handle_error') as handle_error:
+        result = Listing.visit(browser_factory, concurrency=2)
+
+    expect(result).to.be.a(CelloStopScraping)
+    expect(result.stats['frontier.urls']).to.be.greater_than(0)
+    expect(len(crawl_stats['fetched'])).to.be.lower_than(20)
+    # gevent doesn't print the traceback of every greenlet that stopped
+    expect(handle_error.called).to.be.false
+
+
+def test_async_stage_raises_errors_of_the_crawl():
+    ("AsyncStage.visit raises the first error of the crawl, "
+     "without gevent printing it as well")
+
+    class Product(AsyncStage):
+        def tune(self):
+            return None
+
+    class Listing(AsyncStage):
+        url = 'http://fab.com/sale'
+        next_stage = Product
+
+        def play(self):
+            self.scrape('http://fab.com/product/1')
+
+    browser_factory, crawl_stats = make_browser_factory()
+
+    with patch.object(gevent.get_hub(), 'handle_error') as handle_error:
+        expect(Listing.visit).when.called_with(browser_factory).to.throw(BadTuneReturnValue)
+
+    expect(handle_error.called).to.be.false
+
+
+def test_async_stage_raises_errors_of_the_root_stage():
+    ("AsyncStage.visit raises the errors of the play() of its own stage")
+
+    class Listing(AsyncStage):
+        url = 'http://fab.com/sale'
+
+        def play(self):
+            raise ValueError('broken listing')
+
+    browser_factory, crawl_stats = make_browser_factory()
+
+    with patch.object(gevent.get_hub(), 'handle_error') as handle_error:
+        expect(Listing.visit).when.called_with(browser_factory).to.throw(ValueError, 'broken listing')
+
+    expect(handle_error.called).to.be.false
+
+
+def test_async_stage_jumping_to_next_stage():
+    ("AsyncStage skips persisting links whose tune() raises CelloJumpToNextStage")
+
+    persist = Mock()
+
+    class Product(AsyncStage):
+        def tune(self):
+            raise CelloJumpToNextStage('not a product')
+
+    Product.persist = persist
+
+    class Listing(AsyncStage):
+        url = 'http://fab.com/sale'
+        next_stage = Product
+
+        def play(self):
+            self.scrape('http://fab.com/product/1')
+
+    browser_factory, crawl_stats = make_browser_factory()
+    Listing.visit(browser_factory)
+
+    expect(crawl_stats['fetched']).to.equal(['http://fab.com/product/1'])
+    persist.called.should.be.false
+
+
+def test_async_stage_skips_unchanged_pages():
+    ("AsyncStage.visit neither tunes nor persists the pages that "
+     "didn't change since the previous crawl")
+
+    directory = tempfile.mkdtemp()
+    saved = []
+
+    class SavingCase(Case):
+        def save(self, data):
+            saved.append(data['url'])
+
+    class Product(AsyncStage):
+        case = SavingCase
+        index = ContentIndex(os.path.join(directory, 'index.db'))
+
+        def play(self):
+            pass
+
+    class Listing(AsyncStage):
+        url = 'http://fab.com/sale'
+        next_stage = Product
+
+        def play(self):
+            self.fetch()
+            self.scrape(self.dom.links(pattern='/product/'))
+
+    try:
+        pages = {'http://fab.com/sale': LISTING}
+        Listing.visit(make_browser_factory(pages)[0])
+        pages['http://fab.com/product/2'] = '<p>sold out</p>'
+        Listing.visit(make_browser_factory(pages)[0])
+    finally:
+        shutil.rmtree(directory)
+
+    expect(sorted(saved)).to.equal([
+        'http://fab.com/product/1',
+        'http://fab.com/product/2',
+        'http://fab.com/product/2',
+        'http://fab.com/product/3',
+    ])
+    expect(Product.index.report()['incremental.unchanged']).to.equal(2)
+
+
+def test_async_crawl_in_flight():
+    ("AsyncCrawl.in_flight tells how many slots are taken")
+
+    crawl = AsyncCrawl(concurrency=3)
+
+    with crawl.slots:
+        expect(crawl.in_flight).to.equal(1)
+
+    expect(crawl.in_flight).to.equal(0)
+
+
+def test_async_crawl_stop():
+    ("AsyncCrawl.stop kills every greenlet and wait() raises the "
+     "first reason it was given")
+
+    crawl = AsyncCrawl()
+    sleeping = crawl.spawn(gevent.sleep, 10)
+    crawl.spawn(crawl.stop, CelloStopScraping('enough'))
+    crawl.spawn(crawl.stop, CelloStopScraping('too late'))
+
+    expect(crawl.wait).when.called.to.throw(CelloStopScraping, 'enough')
+    expect(sleeping.dead).to.be.true
+
+
+def test_async_crawl_failures_stop_the_crawl():
+    ("AsyncCrawl stops every greenlet when one of them fails, "
+     "and wait() raises the first failure")
+
+    def fail(message):
+        raise RuntimeError(message)
+
+    crawl = AsyncCrawl()
+    sleeping = crawl.spawn(gevent.sleep, 10)
+    crawl.spawn(fail, 'first')
+
+    with patch.object(gevent.get_hub(), 'handle_error') as handle_error:
+        expect(crawl.wait).when.called.to.throw(RuntimeError, 'first')
+
+    expect(sleeping.dead).to.be.true
+    expect(handle_error.called).to.be.false
+
+
+class ResumedProduct(AsyncStage):
+    saved = []
+
+    def play(self):
+        pass
+
+    def tune(self):
+        return {'product': self.url}
+
+    def persist(self, data):
+        self.saved.append(data['product'])
+
+
+class ResumedListing(AsyncStage):
+    url = 'http://fab.com/sale'
+    next_stage = ResumedProduct
+
+    def play(self):
+        pass
+
+
+def test_async_stage_resumes_a_dead_crawl():
+    ("AsyncStage.visit(resume=True) follows the links that a dead crawl "
+     "found but didn't persist")
+
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'crawl.db')
+        parent = ParentContext('http://fab.com/sale', 'http://fab.com', 'ResumedListing', {})
+        dead = SQLiteFrontier(path)
+        for number in range(3):
+            dead.discover('http://fab.com/product/{}'.format(number), ResumedProduct, parent)
+        dead.mark(ResumedProduct(None, url='http://fab.com/product/0'), PERSISTED)
+
+        browser_factory, crawl_stats = make_browser_factory()
+        ResumedListing.visit(browser_factory, frontier=SQLiteFrontier(path), resume=True)
+    finally:
+        shutil.rmtree(directory)
+
+    expect(sorted(crawl_stats['fetched'])).to.equal(['http://fab.com/product/1', 'http://fab.com/product/2'])
+    expect(sorted(ResumedProduct.saved)).to.equal(['http://fab.com/product/1', 'http://fab.com/product/2'])
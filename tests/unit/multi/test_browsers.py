@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import threading
+import multiprocessing
+from mock import Mock, patch
+from cello.multi.browsers import BrowserPool
+
+
+def test_reuses_the_browser_of_the_current_thread():
+    ("BrowserPool builds one browser per thread and reuses it")
+
+    factory = Mock(side_effect=lambda: Mock())
+    browsers = BrowserPool(factory)
+
+    browser = browsers()
+    browsers().should.be(browser)
+
+    other = []
+    thread = threading.Thread(target=lambda: other.append(browsers()))
+    thread.start()
+    thread.join()
+
+    other[0].should_not.be(browser)
+    factory.call_count.should.equal(2)
+    browsers.report().should.equal({'browsers.created': 2})
+
+
+def test_recycles_browsers_after_max_pages():
+    ("BrowserPool closes a browser and builds a new one after max_pages pages")
+
+    factory = Mock(side_effect=lambda: Mock())
+    browsers = BrowserPool(factory, max_pages=2)
+
+    first = browsers()
+    browsers().should.be(first)
+    second = browsers()
+
+    second.should_not.be(first)
+    first.close.assert_called_once_with()
+    browsers.report().should.equal({
+        'browsers.created': 2,
+        'browsers.recycled': 1,
+    })
+
+
+def test_replaces_unhealthy_browsers():
+    ("BrowserPool replaces a browser that fails the health check")
+
+    factory = Mock(side_effect=lambda: Mock())
+    check = Mock(return_value=False)
+    browsers = BrowserPool(factory, check=check)
+
+    first = browsers()
+    second = browsers()
+
+    second.should_not.be(first)
+    check.assert_called_once_with(first)
+    first.close.assert_called_once_with()
+    browsers.report()['browsers.unhealthy'].should.equal(1)
+
+
+def test_discards_a_failed_browser():
+    ("BrowserPool#discard closes the current browser so that the "
+     "next page gets a new one")
+
+    class Browser(object):
+        quit = Mock()
+
+    factory = Mock(side_effect=Browser)
+    browsers = BrowserPool(factory)
+
+    first = browsers()
+    browsers.discard(Mock())
+    browsers().should.be(first)
+
+    browsers.discard(first)
+    Browser.quit.assert_called_once_with()
+    browsers().should_not.be(first)
+    browsers.report()['browsers.discarded'].should.equal(1)
+
+
+def test_release_closes_the_browser_of_the_current_thread():
+    ("BrowserPool#release closes the browser of the current thread")
+
+    factory = Mock(side_effect=lambda: Mock())
+    browsers = BrowserPool(factory)
+    browsers.release()
+
+    first = browsers()
+    browsers.release()
+
+    first.close.assert_called_once_with()
+    browsers().should_not.be(first)
+
+
+@patch('cello.multi.browsers.logger')
+def test_ignores_browsers_failing_to_close(logger):
+    ("BrowserPool logs browsers that fail to close and goes on")
+
+    factory = Mock(side_effect=lambda: Mock(**{'close.side_effect': IOError('gone')}))
+    browsers = BrowserPool(factory, max_pages=1)
+
+    first = browsers()
+    browsers().should_not.be(first)
+    logger.exception.call_count.should.equal(1)
+
+
+@patch('cello.multi.browsers.os')
+def test_forked_workers_build_their_own_browser(os):
+    ("BrowserPool doesn't reuse a browser inherited from another process")
+
+    factory = Mock(side_effect=lambda: Mock())
+    browsers = BrowserPool(factory)
+
+    os.getpid.return_value = 1
+    first = browsers()
+
+    os.getpid.return_value = 2
+    browsers().should_not.be(first)
+    first.close.call_count.should.equal(0)
+
+
+def test_shared_pools_count_the_browsers_of_forked_workers():
+    ("BrowserPool(shared=True) counts the browsers that worker "
+     "processes build in shared memory")
+
+    factory = Mock(side_effect=lambda: Mock())
+    browsers = BrowserPool(factory, max_pages=1, shared=True)
+    browsers()
+
+    worker = multiprocessing.Process(target=lambda: [browsers() for page in range(3)])
+    worker.start()
+    worker.join()
+
+    browsers.report().should.equal({
+        'browsers.created': 4,
+        'browsers.recycled': 2,
+    })
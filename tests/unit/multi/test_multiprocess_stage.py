@@ -2,11 +2,14 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 import sys
-import json
-from mock import Mock, call, patch
-from cello.models import CelloStopScraping
+import pickle
+from StringIO import StringIO
+from mock import Mock, patch
+from cello.models import CelloStopScraping, CelloPersistenceError, InvalidStateError, ParentContext
 from cello.multi.base import BaseMultiProcessStage as Stage
-from cello.multi.base import fetch_async, persist_async
+from cello.multi.base import fetch_async
+from cello.multi.browsers import BrowserPool
+from cello.scheduler import Scheduler
 
 
 def test_get_response_with_sleepyhollow_responses():
@@ -19,9 +22,7 @@ def test_get_response_with_sleepyhollow_responses():
     browser_factory = Mock()
     browser_factory.return_value.get.return_value = ResponseFromSleepyHollow()
 
-    worker_queue = Mock()
-
-    s = Stage(browser_factory, worker_queue)
+    s = Stage(browser_factory)
 
     response = s.get_response('http://some-url.com')
 
@@ -38,318 +39,603 @@ def test_get_response_with_requests_responses():
     browser_factory = Mock()
     browser_factory.return_value.get.return_value = ResponseFromRequestsModule()
 
-    worker_queue = Mock()
-
-    s = Stage(browser_factory, worker_queue)
+    s = Stage(browser_factory)
 
     response = s.get_response('http://some-url.com')
 
     response.should.be.a(ResponseFromRequestsModule)
 
 
-def test_proceed_to_next_returns_a_process_with_current_stage_if_not_next():
-    ("MultiProcessStage#process_next returns a new process pointing to "
+def test_proceed_to_next_returns_a_task_with_current_stage_if_not_next():
+    ("MultiProcessStage#proceed_to_next returns a task pointing to "
      "the current Stage if there are no next stages")
 
-    process_mock = Mock()
-
     class NoNextStage(Stage):
-        Process = process_mock
-
-    browser_factory = Mock()
-    worker_queue = Mock()
-    queue = Mock()
+        pass
 
-    s = NoNextStage(
-        browser_factory,
-        worker_queue,
-        queue=queue,
-    )
+    s = NoNextStage(Mock())
 
-    process = s.proceed_to_next(
+    task = s.proceed_to_next(
         'http://some-link.com/link1',
         using_response='some response',
     )
 
-    process.should.equal(process_mock.return_value)
-
-    process_mock.assert_called_once_with(
-        target=fetch_async,
-        name='http://some-link.com/link1',
-        args=(NoNextStage, browser_factory),
-        kwargs={
-            'url': 'http://some-link.com/link1',
-            'parent_response': 'some response',
-            'queue': queue,
-            'worker_queue': worker_queue,
-            'parent': None
-        }
-    )
+    task.should.equal((fetch_async, {
+        'Stage': NoNextStage,
+        'url': 'http://some-link.com/link1',
+        'parent': None,
+        'parent_response': 'some response',
+    }))
 
 
-def test_proceed_to_next_returns_a_process_with_next_stage():
-    ("MultiProcessStage#process_next returns a new process pointing to "
-     "the current Stage if there are no next stages")
-
-    process_mock = Mock()
+def test_proceed_to_next_returns_a_task_with_next_stage():
+    ("MultiProcessStage#proceed_to_next returns a task pointing to "
+     "the next stage, with the context of the current stage as its parent")
 
     class TheNextOne(Stage):
         pass
 
     class HasNextStage(Stage):
         next_stage = TheNextOne
-        Process = process_mock
 
-    browser_factory = Mock()
-    worker_queue = Mock()
-    queue = Mock()
+        def context_data(self):
+            return {'brand': 'cello'}
 
-    s = HasNextStage(
-        browser_factory,
-        worker_queue,
-        queue=queue,
-    )
+    s = HasNextStage(Mock(), url='http://some-link.com/brand')
 
-    process = s.proceed_to_next('http://some-link.com/link1',
-                                using_response='some response')
-
-    process.should.equal(process_mock.return_value)
-
-    process_mock.assert_called_once_with(
-        target=fetch_async,
-        name='http://some-link.com/link1',
-        args=(TheNextOne, browser_factory),
-        kwargs={
-            'url': 'http://some-link.com/link1',
-            'parent_response': 'some response',
-            'queue': queue,
-            'worker_queue': worker_queue,
-            'parent': s,
-        }
-    )
+    task = s.proceed_to_next('http://some-link.com/link1',
+                             using_response='some response')
 
+    task.should.equal((fetch_async, {
+        'Stage': TheNextOne,
+        'url': 'http://some-link.com/link1',
+        'parent': ParentContext(
+            url='http://some-link.com/brand',
+            base_url='http://some-link.com',
+            name='tests.unit.multi.test_multiprocess_stage.HasNextStage',
+            data={'brand': 'cello'},
+        ),
+        'parent_response': 'some response',
+    }))
 
-def test_scrape_list_of_links():
-    ("MultiProcessStage.scrape should create a worker for each link")
+    s.proceed_to_next('http://some-link.com/link2')[1]['parent'].should.be(
+        task[1]['parent'])
 
-    consume_queue_mock = Mock()
 
-    worker_start = Mock()
+def test_proceed_to_next_keeps_the_parent_context_if_not_next():
+    ("MultiProcessStage#proceed_to_next hands the context of its own "
+     "parent to the links it follows with the same Stage")
 
-    class ScrapableStage(Stage):
-        consume_queue = consume_queue_mock
+    context = ParentContext('http://foo.com/list', 'http://foo.com', 'list', {})
+    s = Stage(Mock(), url='/list?page=2', parent=context)
 
-        def proceed_to_next(self, link, using_response):
-            attrs = {}
-            attrs['name'] = 'Worker for {}'.format(link)
-            attrs['url'] = link
-            attrs['using_response'] = using_response
-            attrs['start'] = worker_start
+    task = s.proceed_to_next('/list?page=3')
 
-            return type(b'FakeWorker', (object,), attrs)
+    task[1]['parent'].should.be(context)
 
-    browser_factory = Mock()
-    worker_queue = Mock()
 
-    st = ScrapableStage(browser_factory, worker_queue)
+def test_scrape_list_of_links():
+    ("MultiProcessStage.scrape should queue a task for each link")
 
-    st.scrape(['url1', 'url2'])
+    class ScrapableStage(Stage):
+        def proceed_to_next(self, link, using_response):
+            return 'task for {}'.format(link), using_response
 
-    worker_queue.wait_for_slot.assert_has_calls([
-        call('fetch_async("Worker for url1")', 'tests.unit.multi.test_multiprocess_stage'),
-        call('fetch_async("Worker for url2")', 'tests.unit.multi.test_multiprocess_stage'),
-    ])
+    st = ScrapableStage(Mock())
 
-    worker_start.call_count.should.equal(2)
+    st.scrape(['url1', 'url2'], using_response='response')
+
+    st.tasks.should.equal([
+        ('task for url1', 'response'),
+        ('task for url2', 'response'),
+    ])
 
 
 def test_scrape_single_url_string():
     ("MultiProcessStage.scrape should consider a single string")
 
-    consume_queue_mock = Mock()
-
-    worker_start = Mock()
-
     class ScrapableStage(Stage):
-        consume_queue = consume_queue_mock
-
         def proceed_to_next(self, link, using_response):
-            attrs = {}
-            attrs['name'] = 'Worker for {}'.format(link)
-            attrs['url'] = link
-            attrs['using_response'] = using_response
-            attrs['start'] = worker_start
-
-            return type(b'FakeWorker', (object,), attrs)
-
-    browser_factory = Mock()
-    worker_queue = Mock()
+            return 'task for {}'.format(link), using_response
 
-    st = ScrapableStage(browser_factory, worker_queue)
+    st = ScrapableStage(Mock())
 
     st.scrape('the url')
 
-    worker_queue.wait_for_slot.assert_called_once_with(
-        'fetch_async("Worker for the url")',
-        'tests.unit.multi.test_multiprocess_stage')
-
-    worker_start.assert_called_once_with()
+    st.tasks.should.equal([('task for the url', None)])
 
 
 def test_consume_queue():
-    ("MultiProcessStage#consume_queue will persist next "
-     "queued item until the queue is empty")
+    ("MultiProcessStage#consume_queue submits the queued tasks to the "
+     "pool and handles its results until nothing is pending")
 
-    browser_factory = Mock()
-    worker_queue = Mock()
-    scrape_queue = Mock()
+    pool = Mock()
+    pool.pending = set([1])
+    pool.report.return_value = {'results.dropped': 3}
+
+    def next_result(timeout=None):
+        if pool.next_result.call_count == 1:
+            return
+        if pool.next_result.call_count == 2:
+            return 1, 'first', [(fetch_async, {'url': 'child'})]
+
+        pool.pending.clear()
+        return 2, 'second', []
 
-    scrape_queue.empty.side_effect = [False, False, False, True]
+    pool.next_result.side_effect = next_result
 
     class MyStage(Stage):
         persist_next_queued_item = Mock()
 
-    MyStage(browser_factory, worker_queue, queue=scrape_queue).consume_queue()
+    persistence = Mock()
+    persistence.drain.return_value = []
+    persistence.close.return_value = []
 
-    MyStage.persist_next_queued_item.call_count.should.equal(3)
+    st = MyStage(Mock(), pool=pool, persistence=persistence,
+                 tasks=[(fetch_async, {'url': 'root'})])
+    st.consume_queue()
+
+    pool.submit.call_args_list.should.equal([
+        ((fetch_async, ), {'url': 'root'}),
+        ((fetch_async, ), {'url': 'child'}),
+    ])
+    MyStage.persist_next_queued_item.call_args_list.should.equal([
+        (('first', ), {}),
+        (('second', ), {}),
+    ])
+    st.tasks.should.be.empty
+    st.report()['results.dropped'].should.equal(3)
+    persistence.close.assert_called_once_with()
+
+
+def test_report_adds_the_cache():
+    ("MultiProcessStage#report adds the cache counters to the stats of the crawl")
+
+    pool = Mock()
+    pool.pending = set()
+    pool.report.return_value = {}
+    persistence = Mock()
+    persistence.close.return_value = []
+
+    class CachedStage(Stage):
+        cache = Mock()
+
+    CachedStage.cache.report.return_value = {'cache.hits': 10}
+
+    st = CachedStage(Mock(), pool=pool, persistence=persistence)
+    st.consume_queue()
+
+    st.report()['cache.hits'].should.equal(10)
+
+
+def test_report_adds_the_browsers():
+    ("MultiProcessStage#report adds the browser counters of "
+     "its workers to the stats of the crawl")
+
+    browsers = BrowserPool(Mock(), max_pages=1)
+    browsers()
+    browsers()
+
+    pool = Mock()
+    pool.pending = set()
+    pool.report.return_value = {}
+    pool.context = {'browser_factory': browsers}
+    persistence = Mock()
+    persistence.close.return_value = []
+
+    st = Stage(Mock(), pool=pool, persistence=persistence)
+    st.consume_queue()
+
+    st.report()['browsers.created'].should.equal(2)
+    st.report()['browsers.recycled'].should.equal(1)
+
+
+def test_consume_queue_raises_persistence_errors():
+    ("MultiProcessStage#consume_queue raises the errors that the "
+     "persistence workers report, even after the last page")
+
+    pool = Mock()
+    pool.pending = set()
+    pool.report.return_value = {}
+
+    persistence = Mock()
+    persistence.close.return_value = [('CelloPersistenceError', ('IOError: disk is full', ))]
+
+    st = Stage(Mock(), pool=pool, persistence=persistence)
+
+    st.consume_queue.when.called.should.throw(
+        CelloPersistenceError, 'IOError: disk is full')
 
 
 def test_persist_next_queued_item_with_case():
     ("MultiProcessStage#persist_next_queued_item with a case "
-     "will spawn a worker for persisting that data")
-
-    process_mock = Mock()
+     "hands that data to the persistence workers")
 
-    class MyStage(Stage):
-        Process = process_mock
-        import_stage = Mock()
-        make_children_stage = Mock()
+    st = Stage(Mock(), persistence=Mock())
 
-    browser_factory = Mock()
-    worker_queue = Mock()
-    scrape_queue = Mock()
-    scrape_queue.get.return_value = json.dumps({
+    st.persist_next_queued_item({
         'foo': 'bar',
         'case.module': 'some.module',
         'case.name': 'SomeCase',
         'stage.name': 'WhateverStage',
         'stage.module': 'what.ever',
+        'stage.url': 'http://what.ever',
     })
 
-    st = MyStage(browser_factory, worker_queue, queue=scrape_queue)
+    st.persistence.put.assert_called_once_with(
+        stage_module='what.ever',
+        stage_name='WhateverStage',
+        url='http://what.ever',
+        case_module_name='some.module',
+        case_name='SomeCase',
+        indexed=None,
+        data={'foo': 'bar'},
+    )
+    st.tasks.should.be.empty
 
-    st.persist_next_queued_item()
 
-    process_mock.assert_called_once_with(
-        target=persist_async,
-        kwargs={
-            "worker_queue": worker_queue,
-            "case_module_name": 'some.module',
-            "case_name": 'SomeCase',
-            "data": {'foo': 'bar'},
-            "stage": MyStage.make_children_stage.return_value,
-            "results_queue": scrape_queue,
-        }
-    )
-    process_mock.return_value.start.assert_called_once_with()
-    worker_queue.wait_for_slot.assert_called_once_with(
-        'persist_async', 'tests.unit.multi.test_multiprocess_stage')
+def test_persist_next_queued_item_without_case():
+    ("MultiProcessStage#persist_next_queued_item does nothing "
+     "for results without a case")
+
+    st = Stage(Mock(), persistence=Mock())
+
+    st.persist_next_queued_item({})
+    st.persist_next_queued_item(None)
 
-    MyStage.import_stage.assert_called_once_with('what.ever', 'WhateverStage')
-    MyStage.make_children_stage.assert_called_once_with(
-        MyStage.import_stage.return_value)
+    st.persistence.put.called.should.be.false
 
 
 def test_persist_next_queued_item_with_an_error():
     ("MultiProcessStage#persist_next_queued_item upon error should raise it")
 
-    browser_factory = Mock()
-    worker_queue = Mock()
-    scrape_queue = Mock()
-    scrape_queue.get.return_value = json.dumps(['CelloStopScraping', ('the message',)])
+    st = Stage(Mock())
+
+    st.persist_next_queued_item.when.called_with(
+        ('CelloStopScraping', ('the message',))).should.throw(
+            CelloStopScraping, 'the message')
+
+
+def test_stage_pickles_without_what_belongs_to_the_coordinator():
+    ("MultiProcessStage drops its dom, browser factory, frontier, "
+     "pool and queued tasks when pickled")
 
-    st = Stage(browser_factory, worker_queue, queue=scrape_queue)
+    st = Stage('browser factory', url='http://foo.com', pool='pool',
+               tasks=['task'], frontier='frontier')
+    st._dom = 'dom'
 
-    st.persist_next_queued_item.when.called.to.throw(
-        CelloStopScraping, 'the message')
+    state = st.__getstate__()
+
+    state['_dom'].should.be.none
+    state['browser_factory'].should.be.none
+    state['frontier'].should.be.none
+    state['pool'].should.be.none
+    state['tasks'].should.equal([])
+    state['_url'].should.equal('http://foo.com')
+
+    pickle.loads(pickle.dumps(st)).url.should.equal('http://foo.com')
 
 
 def test_visit():
-    ("MultiProcessStage#play creates a worker queue and plays the stage")
+    ("MultiProcessStage#visit starts a worker pool, plays the "
+     "stage and stops the pool")
 
     class MyStage(Stage):
         url = "http://foo.com"
 
         fetch = Mock()
         play = Mock()
-        WorkerQueue = Mock()
+        consume_queue = Mock()
+        report = Mock(return_value={})
+        WorkerPool = Mock()
+        Frontier = Mock()
+        PersistencePool = Mock()
 
     browser_factory = Mock()
 
-    MyStage.visit(browser_factory, max_workers=30)
+    MyStage.visit(browser_factory, max_workers=30, max_tasks_per_child=7, max_queued=50,
+                  persist_workers=3, persist_batch_size=20)
 
     MyStage.play.assert_called_once_with()
-    MyStage.WorkerQueue.assert_called_once_with(30, output=sys.stdout)
+    MyStage.consume_queue.assert_called_once_with()
+    MyStage.WorkerPool.assert_called_once_with(
+        30,
+        max_tasks_per_child=7,
+        max_queued=50,
+        serializer=None,
+        output=sys.stdout,
+        context={
+            'browser_factory': browser_factory,
+            'frontier': MyStage.Frontier.return_value,
+        })
+
+    pool = MyStage.WorkerPool.return_value
+    pool.start.assert_called_once_with()
+    pool.stop.assert_called_once_with()
+
+    MyStage.PersistencePool.assert_called_once_with(
+        3,
+        batch_size=20,
+        context={
+            'browser_factory': browser_factory,
+            'frontier': MyStage.Frontier.return_value,
+        })
+    persistence = MyStage.PersistencePool.return_value
+    persistence.start.assert_called_once_with()
+    persistence.stop.assert_called_once_with()
+
+
+def test_visit_recycles_worker_processes_but_not_threads():
+    ("MultiProcessStage#visit replaces worker processes after "
+     "DEFAULT_MAX_TASKS_PER_CHILD tasks, MultiThreadStage keeps its threads")
+
+    from cello.multi.processing import MultiProcessStage
+    from cello.multi.thread import MultiThreadStage
+    from cello.multi.base import DEFAULT_MAX_TASKS_PER_CHILD
+
+    for Base, expected in ((MultiProcessStage, DEFAULT_MAX_TASKS_PER_CHILD), (MultiThreadStage, None)):
+        class MyStage(Base):
+            url = "http://foo.com"
+
+            play = Mock()
+            consume_queue = Mock()
+            report = Mock(return_value={})
+            WorkerPool = Mock()
+            Frontier = Mock()
+            PersistencePool = Mock()
+
+        MyStage.visit(Mock())
+
+        MyStage.WorkerPool.call_args[1]['max_tasks_per_child'].should.equal(expected)
+
+
+def test_visit_returns_the_stats_of_the_crawl():
+    ("MultiProcessStage#visit returns the counters of the crawl, "
+     "including the ones of its workers")
+
+    from cello.multi.thread import MultiThreadStage
+
+    class Product(MultiThreadStage):
+        def play(self):
+            pass
+
+    class Listing(MultiThreadStage):
+        url = 'http://fab.com/sale'
+        next_stage = Product
+
+        def play(self):
+            self.scrape(['http://fab.com/product/1', 'http://fab.com/product/2'])
+
+    browser = Mock()
+    browser.get.return_value.content = '<p>cello</p>'
+
+    stats = Listing.visit(lambda: browser, max_workers=2, output=StringIO())
+
+    stats['frontier.urls'].should.equal(2)
+    stats['results.dropped'].should.equal(0)
+    stats['scheduler.hosts'].should.equal(1)
+    stats['browsers.created'].should.be.greater_than(0)
+
+
+def test_visit_without_url():
+    ("MultiProcessStage#visit requires the stage to have an url")
+
+    class MyStage(Stage):
+        WorkerPool = Mock()
+
+    MyStage.visit.when.called_with(Mock()).should.throw(
+        InvalidStateError,
+        'Trying to download content for MyStage but it has no URL')
+
+    MyStage.WorkerPool.called.should.be.false
+
+
+def test_visit_creates_a_frontier_for_the_crawl():
+    ("MultiProcessStage#visit creates the crawl frontier "
+     "unless one is given")
+
+    stages = []
+
+    class MyStage(Stage):
+        url = "http://foo.com"
+
+        WorkerPool = Mock()
+        Frontier = Mock()
+        PersistencePool = Mock()
+        consume_queue = Mock()
+        report = Mock(return_value={})
+
+        def play(self):
+            stages.append(self)
+
+    MyStage.visit(Mock(), max_workers=2)
+    MyStage.visit(Mock(), max_workers=2, frontier='given frontier')
+
+    MyStage.Frontier.assert_called_once_with()
+    stages[0].frontier.should.equal(MyStage.Frontier.return_value)
+    stages[1].frontier.should.equal('given frontier')
+    stages[1].pool.should.equal(MyStage.WorkerPool.return_value)
+
+
+def test_visit_returns_cello_stop_scraping():
+    ("MultiProcessStage#visit returns the CelloStopScraping "
+     "that ended the crawl and stops the pool")
+
+    error = CelloStopScraping('enough')
+
+    class MyStage(Stage):
+        url = "http://foo.com"
+
+        play = Mock()
+        consume_queue = Mock(side_effect=error)
+        report = Mock(return_value={})
+        WorkerPool = Mock()
+        Frontier = Mock()
+        PersistencePool = Mock()
+
+    MyStage.visit(Mock(), max_workers=2).should.equal(error)
+    MyStage.WorkerPool.return_value.stop.assert_called_once_with()
 
 
 @patch('cello.multi.base.couleur')
 def test_visit_with_keyboard_interrupt(couleur):
-    ("MultiProcessStage#play creates a worker queue and plays the stage")
+    ("MultiProcessStage#visit stops the pool when the "
+     "user presses CONTROL-C")
 
     class MyStage(Stage):
         url = "http://foo.com"
 
         fetch = Mock()
         play = Mock(side_effect=KeyboardInterrupt())
-        WorkerQueue = Mock()
+        WorkerPool = Mock()
+        Frontier = Mock()
+        PersistencePool = Mock()
 
     browser_factory = Mock()
 
     MyStage.visit(browser_factory, max_workers=30)
 
     MyStage.play.assert_called_once_with()
-    MyStage.WorkerQueue.assert_called_once_with(30, output=sys.stdout)
+    MyStage.WorkerPool.return_value.stop.assert_called_once_with()
 
     couleur.Shell.return_value.bold_red.assert_called_once_with("User pressed CONTROL-C\n")
 
 
-def test_make_children_stage():
-    ("MultiProcessStage#make_children_stage should use "
-     "its own data to create a child")
+def test_get_response_discards_browsers_that_fail():
+    ("MultiProcessStage#get_response discards the browser that failed "
+     "to fetch a page")
 
     browser_factory = Mock()
-    worker_queue = Mock()
+    browser = browser_factory.return_value
+    browser.get.side_effect = IOError('connection reset')
 
-    stage = Stage(
-        browser_factory,
-        worker_queue,
-        parent_response='parent response',
-        queue='some queue',
-    )
+    s = Stage(browser_factory)
 
-    StageClassMock = Mock()
+    s.get_response.when.called_with('http://some-url.com').should.throw(IOError)
+    browser_factory.discard.assert_called_once_with(browser)
 
-    child = stage.make_children_stage(StageClassMock)
 
-    child.should.equal(StageClassMock.return_value)
+def test_consume_queue_goes_through_the_scheduler():
+    ("MultiProcessStage#consume_queue submits the links of a host once "
+     "the scheduler allows it, and the links of other hosts meanwhile")
 
-    StageClassMock.assert_called_once_with(
-        browser_factory,
-        worker_queue,
-        parent=stage,
-        parent_response='parent response',
-        queue='some queue',
-    )
+    pool = Mock()
+    pool.pending = set()
+    pool.report.return_value = {}
+    submitted = []
+
+    def submit(function, **kwargs):
+        submitted.append(kwargs['url'])
+        pool.pending.add(len(submitted))
+        return len(submitted)
+
+    def next_result(timeout=None):
+        # results come back in the order the tasks were submitted
+        task_id = min(pool.pending)
+        pool.pending.remove(task_id)
+        return task_id, {}, []
+
+    pool.submit.side_effect = submit
+    pool.next_result.side_effect = next_result
+
+    persistence = Mock()
+    persistence.drain.return_value = []
+    persistence.close.return_value = []
+
+    parent = ParentContext('http://a.com', 'http://a.com', 'parent', {})
+    st = Stage(Mock(), pool=pool, persistence=persistence, scheduler=Scheduler(concurrency=1), tasks=[
+        (fetch_async, {'url': '/1', 'parent': parent}),
+        (fetch_async, {'url': '/2', 'parent': parent}),
+        (fetch_async, {'url': 'http://b.com/1', 'parent': parent}),
+    ])
+    st.consume_queue()
+
+    submitted.should.equal(['/1', 'http://b.com/1', '/2'])
+    st.report()['scheduler.throttled'].should.equal(1)
+    st.report()['scheduler.hosts'].should.equal(2)
+
+
+def test_consume_queue_feeds_back_the_scheduler():
+    ("MultiProcessStage#consume_queue tells the scheduler how long each "
+     "fetch took and whether it failed")
+
+    pool = Mock()
+    pool.pending = set()
+    pool.report.return_value = {}
+    results = [
+        (1, {'fetch.status': 200}, []),
+        (2, None, []),
+        (3, {'fetch.status': 502}, []),
+        (4, {}, []),
+    ]
+
+    def submit(function, **kwargs):
+        task_id = len(pool.pending) + 1
+        pool.pending.add(task_id)
+        return task_id
+
+    def next_result(timeout=None):
+        result = results.pop(0)
+        pool.pending.discard(result[0])
+        return result
+
+    pool.submit.side_effect = submit
+    pool.next_result.side_effect = next_result
+
+    persistence = Mock()
+    persistence.drain.return_value = []
+    persistence.close.return_value = []
+
+    scheduler = Scheduler()
+    scheduler.record = Mock()
+    st = Stage(Mock(), pool=pool, persistence=persistence, scheduler=scheduler, tasks=[
+        (fetch_async, {'url': 'http://a.com/{}'.format(number)}) for number in range(1, 5)
+    ])
+    st.consume_queue()
+
+    [(call[0][0], call[1]) for call in scheduler.record.call_args_list].should.equal([
+        ('a.com', {'failed': False}),
+        ('a.com', {'failed': True}),
+        ('a.com', {'failed': True}),
+    ])
+    scheduler.in_flight.should.equal(0)
+
+
+def test_proceed_to_next_records_links_in_a_durable_frontier():
+    ("MultiProcessStage#proceed_to_next records the link in a durable "
+     "frontier along with its stage and parent")
+
+    class Product(Stage):
+        pass
+
+    class Listing(Stage):
+        next_stage = Product
+
+    frontier = Mock(durable=True)
+    st = Listing(Mock(), url='http://foo.com/sale', frontier=frontier)
+
+    st.proceed_to_next('/product/1')
+
+    url, NextStage, parent = frontier.discover.call_args[0]
+    url.should.equal('http://foo.com/product/1')
+    NextStage.should.be(Product)
+    parent.url.should.equal('http://foo.com/sale')
 
 
-@patch('cello.multi.base.importlib')
-def test_import_stage(importlib):
-    ("MultiProcessStage.import_stage should "
-     "import the given module and get the member from it")
-    importlib.import_module.return_value.SomeMember = 'YAY'
+def test_resume_queues_the_unfinished_links():
+    ("MultiProcessStage#resume queues a task for every link that a "
+     "dead crawl didn't persist")
 
-    GivenStage = Stage.import_stage('some.module', 'SomeMember')
+    parent = ParentContext('http://foo.com', 'http://foo.com', 'Listing', {})
+    frontier = Mock(durable=True)
+    frontier.unfinished.return_value = [('http://foo.com/1', Stage, parent)]
+    st = Stage(Mock(), frontier=frontier)
 
-    importlib.import_module.assert_called_once_with('some.module')
+    st.resume()
 
-    GivenStage.should.equal("YAY")
+    st.tasks.should.equal([(fetch_async, {
+        'Stage': Stage,
+        'url': 'http://foo.com/1',
+        'parent': parent,
+        'parent_response': None,
+    })])
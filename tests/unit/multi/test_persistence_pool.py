@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+from mock import Mock, patch
+from cello.storage import Case
+from cello.multi.base import BasePersistencePool
+from cello.multi.thread import PersistencePool
+
+SAVED = []
+
+
+class FakeStage(object):
+    def __init__(self, browser_factory, url=None, frontier=None):
+        self.url = url
+
+
+class ListCase(Case):
+    def save_many(self, items):
+        SAVED.append(items)
+
+
+class BrokenCase(Case):
+    def save(self, data):
+        raise IOError('disk is full')
+
+
+def test_base_pool_requires_queues():
+    ("BasePersistencePool#make_queue is not implemented by default")
+
+    BasePersistencePool.when.called_with(1).should.throw(NotImplementedError)
+
+
+def test_items_are_sharded_by_case():
+    ("BasePersistencePool#put always sends the items of a Case to the same worker")
+
+    pool = PersistencePool(4)
+
+    for n in range(3):
+        pool.put('stages', 'Product', 'cases', 'ProductCase', 'http://foo.com/%d' % n, {'n': n})
+    pool.put('stages', 'Brand', 'cases', 'BrandCase', 'http://foo.com/brand', {'brand': 1})
+
+    cases = [set(item[3] for item in items.queue) for items in pool.queues]
+    [names for names in cases if 'ProductCase' in names].should.have.length_of(1)
+    [names for names in cases if 'BrandCase' in names].should.have.length_of(1)
+    sum(items.qsize() for items in pool.queues).should.equal(4)
+
+
+def test_saves_in_batches_and_reports_errors():
+    ("PersistencePool saves items in batches from its own threads and "
+     "hands back the errors when closed")
+
+    del SAVED[:]
+    pool = PersistencePool(2, batch_size=2, context={'browser_factory': Mock()})
+    pool.start()
+
+    for n in range(3):
+        pool.put('tests.unit.multi.test_persistence_pool', 'FakeStage',
+                 'tests.unit.multi.test_persistence_pool', 'ListCase',
+                 'http://foo.com/%d' % n, {'n': n})
+
+    with patch('cello.multi.workers.models.logger'):
+        pool.put('tests.unit.multi.test_persistence_pool', 'FakeStage',
+                 'tests.unit.multi.test_persistence_pool', 'BrokenCase',
+                 'http://foo.com/broken', {'n': 4})
+        errors = pool.close()
+
+    SAVED.should.equal([[{'n': 0}, {'n': 1}], [{'n': 2}]])
+    errors.should.equal([('CelloPersistenceError', ('IOError: disk is full', ))])
+    pool.workers.should.be.empty
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+from nose import SkipTest
+from cello.helpers import FrozenDict
+from cello.models import ParentContext
+from cello.multi.workers import fetch_async
+from cello.multi.serializers import PickleSerializer, MsgpackSerializer, msgpack
+
+
+def test_pickle_serializer_keeps_bytes():
+    ("PickleSerializer round trips byte strings that aren't valid utf-8")
+
+    serializer = PickleSerializer()
+    message = (1, {'name': b'caf\xe9', 'price': 10}, [(fetch_async, {'url': 'http://foo.com'})])
+
+    serializer.loads(serializer.dumps(message)).should.equal(message)
+
+
+def test_pickle_serializer_protocol():
+    ("PickleSerializer uses the newest protocol by default")
+
+    PickleSerializer().dumps(None).should.equal(b'\x80\x02N.')
+    PickleSerializer(protocol=0).dumps(None).should.equal(b'N.')
+
+
+def test_msgpack_serializer():
+    ("MsgpackSerializer packs plain data and pickles the rest")
+
+    if msgpack is None:
+        raise SkipTest('msgpack is not installed')
+
+    serializer = MsgpackSerializer()
+    task = (fetch_async, {'url': 'http://foo.com'})
+
+    task_id, data, tasks = serializer.loads(serializer.dumps((1, {'name': 'cello'}, [task])))
+
+    task_id.should.equal(1)
+    data.should.equal({'name': 'cello'})
+    tasks[0][0].should.be(fetch_async)
+    tasks[0][1].should.equal({'url': 'http://foo.com'})
+
+
+def test_msgpack_serializer_keeps_the_types_of_tasks():
+    ("MsgpackSerializer round trips the tuples and namedtuples of a "
+     "fetch_async task along with their types")
+
+    if msgpack is None:
+        raise SkipTest('msgpack is not installed')
+
+    serializer = MsgpackSerializer()
+    parent = ParentContext('http://fab.com/sale', 'http://fab.com', 'Sale', {'brand': 'cello'})
+    task = (fetch_async, {'Stage': ParentContext, 'url': '/product/1', 'parent': parent, 'parent_response': None})
+    error = ('BadTuneReturnValue', ('empty', ))
+
+    task_id, data, tasks = serializer.loads(serializer.dumps(
+        (7, OrderedDict([('b', 1), ('a', 2)]), [task, error])))
+
+    task_id.should.equal(7)
+    data.should.be.a(OrderedDict)
+    list(data.items()).should.equal([('b', 1), ('a', 2)])
+    tasks[0].should.equal(task)
+    tasks[0].should.be.a(tuple)
+    tasks[0][1]['parent'].should.be.a(ParentContext)
+    tasks[0][1]['parent'].base_url.should.equal('http://fab.com')
+    tasks[0][1]['parent'].data.should.be.a(FrozenDict)
+    tasks[1].should.equal(error)
+    tasks[1][1].should.be.a(tuple)
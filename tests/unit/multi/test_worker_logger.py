@@ -8,37 +8,36 @@ from cello.multi.base import WorkerLogger
 
 @patch('cello.multi.base.couleur')
 @patch('cello.multi.base.datetime')
-def test_process_await(datetime, couleur):
-    ("WorkerLogger#process_await prints in magenta")
+def test_worker_started(datetime, couleur):
+    ("WorkerLogger#worker_started prints in bold yellow")
 
     datetime.now.return_value = "now :)"
     sh = couleur.Shell.return_value
 
     logger = WorkerLogger(StringIO())
 
-    logger.process_await('some_function', 'some pid')
+    logger.worker_started('some_worker', 'some pid')
 
     sh.bold_white.assert_called_once_with("[now :)] <~ ")
-    sh.magenta.assert_called_once_with(
-        "Worker some_function (PID some pid) is waiting "
-        "for a slot in the queue\n")
+    sh.bold_yellow.assert_called_once_with(
+        "Worker some_worker (PID some pid) is ready to run tasks\n")
 
 
 @patch('cello.multi.base.couleur')
 @patch('cello.multi.base.datetime')
-def test_permission_to_run(datetime, couleur):
-    ("WorkerLogger#permission_to_run prints in bold yellow")
+def test_worker_died(datetime, couleur):
+    ("WorkerLogger#worker_died prints in bold red")
 
     datetime.now.return_value = "now :)"
     sh = couleur.Shell.return_value
 
     logger = WorkerLogger(StringIO())
 
-    logger.permission_to_run('some_function', 'some pid')
+    logger.worker_died('some_worker', 'some pid', -11)
 
     sh.bold_white.assert_called_once_with("[now :)] <~ ")
-    sh.bold_yellow.assert_called_once_with(
-        "Worker some_function (PID some pid) has permission to run now \n")
+    sh.bold_red.assert_called_once_with(
+        "Worker some_worker (PID some pid) died with exit code -11\n")
 
 
 @patch('cello.multi.base.couleur')
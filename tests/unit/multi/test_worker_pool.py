@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+from StringIO import StringIO
+from Queue import Empty, Full
+from mock import Mock, patch
+from cello.multi.base import BaseWorkerPool
+from cello.multi.browsers import BrowserPool
+
+
+class FakeWorkerPool(BaseWorkerPool):
+    Process = Mock()
+
+    def make_queue(self, maxsize=0):
+        return Mock(maxsize=maxsize)
+
+    def make_slots(self, size):
+        return [0] * size
+
+
+def test_base_pool_requires_queues():
+    ("BaseWorkerPool#make_queue is not implemented by default")
+
+    BaseWorkerPool.when.called_with(1, output=StringIO()).should.throw(
+        NotImplementedError)
+
+
+@patch('cello.multi.base.work')
+def test_start_worker(work):
+    ("BaseWorkerPool#start_worker starts a daemon worker running "
+     "the work loop with the pool context")
+
+    FakeWorkerPool.Process.reset_mock()
+    browsers = BrowserPool('factory')
+    pool = FakeWorkerPool(2, max_tasks_per_child=5, output=StringIO(),
+                          context={'browser_factory': browsers})
+
+    pool.start()
+
+    FakeWorkerPool.Process.call_count.should.equal(2)
+    FakeWorkerPool.Process.assert_called_with(
+        target=work,
+        name='cello-worker-1',
+        args=(pool.tasks, pool.results, pool.current, 1),
+        kwargs=dict(
+            context={'browser_factory': browsers},
+            max_tasks=5,
+            serializer=None,
+        ))
+
+    worker = FakeWorkerPool.Process.return_value
+    worker.daemon.should.be.true
+    worker.start.call_count.should.equal(2)
+    pool.workers.should.equal([worker, worker])
+
+
+def test_submit_and_next_result():
+    ("BaseWorkerPool#submit queues a numbered task which "
+     "is no longer pending once its result arrives")
+
+    pool = FakeWorkerPool(1, output=StringIO())
+
+    pool.submit('function', url='foo').should.equal(1)
+    pool.submit('function', url='bar').should.equal(2)
+
+    pool.tasks.put.call_args_list[0].should.equal(
+        (((1, 'function', {'url': 'foo'}), ), {'timeout': pool.poll_interval}))
+    pool.pending.should.equal(set([1, 2]))
+
+    pool.results.get.return_value = (2, 'raw', ['child'])
+    pool.next_result().should.equal((2, 'raw', ['child']))
+    pool.pending.should.equal(set([1]))
+
+
+def test_next_result_waits_no_longer_than_the_poll_interval():
+    ("BaseWorkerPool#next_result waits for a result up to the given "
+     "timeout, never longer than the poll interval")
+
+    pool = FakeWorkerPool(1, output=StringIO())
+    pool.results.get.return_value = (1, 'raw', [])
+
+    pool.next_result(timeout=0.01)
+    pool.results.get.assert_called_with(timeout=0.01)
+
+    pool.next_result(timeout=60)
+    pool.results.get.assert_called_with(timeout=pool.poll_interval)
+
+    pool.next_result()
+    pool.results.get.assert_called_with(timeout=pool.poll_interval)
+
+
+def test_next_result_counts_dropped_results():
+    ("BaseWorkerPool#next_result counts the results that a "
+     "worker could not serialize")
+
+    pool = FakeWorkerPool(1, output=StringIO())
+    pool.submit('function')
+
+    pool.results.get.return_value = (1, None, None)
+    pool.next_result().should.equal((1, None, []))
+
+    pool.pending.should.be.empty
+    pool.report().should.equal({'results.dropped': 1})
+
+
+def test_messages_go_through_the_serializer():
+    ("BaseWorkerPool serializes tasks and results "
+     "when it has a serializer")
+
+    serializer = Mock()
+    pool = FakeWorkerPool(1, output=StringIO(), serializer=serializer)
+
+    pool.submit('function', url='foo')
+    serializer.dumps.assert_called_once_with((1, 'function', {'url': 'foo'}))
+    pool.tasks.put.call_args[0].should.equal((serializer.dumps.return_value, ))
+
+    serializer.loads.return_value = (1, 'raw', [])
+    pool.next_result().should.equal((1, 'raw', []))
+    serializer.loads.assert_called_once_with(pool.results.get.return_value)
+
+
+def test_task_queue_is_bounded():
+    ("BaseWorkerPool keeps at most max_queued tasks waiting, "
+     "twice as many as workers by default")
+
+    FakeWorkerPool(3, output=StringIO()).tasks.maxsize.should.equal(6)
+    FakeWorkerPool(3, output=StringIO(), max_queued=10).tasks.maxsize.should.equal(10)
+    FakeWorkerPool(3, output=StringIO()).results.maxsize.should.equal(0)
+
+
+def test_submit_waits_for_room_in_the_queue():
+    ("BaseWorkerPool#submit supervises the workers while "
+     "the task queue is full")
+
+    pool = FakeWorkerPool(1, output=StringIO())
+    pool.supervise = Mock()
+    pool.tasks.put.side_effect = [Full(), Full(), None]
+    pool.results.get_nowait.side_effect = Empty()
+
+    pool.submit('function', url='foo').should.equal(1)
+
+    pool.supervise.call_count.should.equal(2)
+    pool.tasks.put.call_count.should.equal(3)
+    pool.pending.should.equal(set([1]))
+
+
+def test_submit_reads_results_while_waiting_for_room():
+    ("BaseWorkerPool#submit reads the results that come in while the task "
+     "queue is full, and next_result hands them out first")
+
+    pool = FakeWorkerPool(1, output=StringIO())
+    pool.supervise = Mock()
+    pool.tasks.put.side_effect = [Full(), None]
+    pool.results.get_nowait.side_effect = [(7, 'done', []), Empty()]
+
+    pool.submit('function', url='foo')
+    pool.pending.add(7)
+
+    pool.next_result().should.equal((7, 'done', []))
+    pool.results.get.called.should.be.false
+    pool.pending.should.equal(set([1]))
+
+
+def test_supervise_replaces_a_crashed_worker():
+    ("BaseWorkerPool#supervise forgets the task of a worker "
+     "that crashed and starts a new one in its place")
+
+    pool = FakeWorkerPool(2, output=StringIO())
+    pool.start_worker = Mock()
+
+    alive, crashed = Mock(), Mock(exitcode=-9)
+    alive.is_alive.return_value = True
+    crashed.is_alive.return_value = False
+    pool.workers = [alive, crashed]
+    pool.current[1] = 7
+    pool.pending = set([7, 8])
+
+    pool.supervise()
+
+    pool.pending.should.equal(set([8]))
+    pool.current.should.equal([0, 0])
+    pool.start_worker.assert_called_once_with(1)
+
+
+def test_supervise_lets_idle_workers_go():
+    ("BaseWorkerPool#supervise does not restart workers "
+     "once nothing is pending")
+
+    pool = FakeWorkerPool(1, output=StringIO())
+    pool.start_worker = Mock()
+
+    retired = Mock(exitcode=0)
+    retired.is_alive.return_value = False
+    pool.workers = [retired]
+
+    pool.supervise()
+
+    pool.workers.should.equal([None])
+    pool.start_worker.called.should.be.false
+
+
+def test_stop():
+    ("BaseWorkerPool#stop drops the queued tasks, asks the workers "
+     "still alive to exit and terminates the ones that don't")
+
+    pool = FakeWorkerPool(2, output=StringIO())
+    pool.tasks.get_nowait.side_effect = ['queued', Empty()]
+
+    done, stuck = Mock(), Mock()
+    done.is_alive.return_value = False
+    stuck.is_alive.return_value = True
+    pool.workers = [done, stuck]
+
+    pool.stop()
+
+    pool.tasks.get_nowait.call_count.should.equal(2)
+    pool.tasks.put_nowait.assert_called_once_with(None)
+    pool.tasks.put.called.should.be.false
+    done.terminate.called.should.be.false
+    stuck.terminate.assert_called_once_with()
+
+
+def test_wraps_the_browser_factory_in_a_browser_pool():
+    ("BaseWorkerPool hands its workers a BrowserPool around the "
+     "browser factory, unless it is one already")
+
+    pool = FakeWorkerPool(2, output=StringIO(), context={'browser_factory': 'factory'})
+    pool.context['browser_factory'].should.be.a(BrowserPool)
+    pool.context['browser_factory'].factory.should.equal('factory')
+
+    browsers = BrowserPool('factory', max_pages=10)
+    pool = FakeWorkerPool(2, output=StringIO(), context={'browser_factory': browsers})
+    pool.context['browser_factory'].should.be(browsers)
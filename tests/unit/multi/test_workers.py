@@ -1,128 +1,253 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import json
+import os
+import shutil
+import tempfile
+from Queue import Queue
 from mock import Mock, patch
-from cello.storage import Case
+from cello.storage import Case, FingerprintStore
 from cello.models import BadTuneReturnValue
 from cello.models import CelloJumpToNextStage
 from cello.models import CelloStopScraping
 from cello.models import InvalidURLMapping
 from cello.models import InvalidStateURLError
-from cello.multi.workers import persist_async
+from cello.multi.workers import persist_batches
 from cello.multi.workers import fetch_async
 from cello.multi.workers import handle_exception
+from cello.multi.workers import work
+from cello.multi.serializers import PickleSerializer
 
 
 class MockedCase(Case):
     save = Mock()
 
 
-def test_persist_async_with_data():
-    ("cello.multi.workers.persist_async should "
+def fetch_nothing(url):
+    return {'url': url}, []
+
+
+def fetch_unpicklable():
+    return {'lambda': lambda: None}, []
+
+
+class BatchCase(Case):
+    batches = []
+
+    def save_many(self, items):
+        self.batches.append(items)
+
+
+class FakeStage(object):
+    def __init__(self, browser_factory, url=None, frontier=None):
+        self.url = url
+
+
+class FingerprintedStage(FakeStage):
+    fingerprints = None
+
+    @property
+    def canonical_url(self):
+        return self.url
+
+
+def run_persist_batches(*items, **kw):
+    queue, errors = Queue(), Queue()
+    for item in items:
+        queue.put(item)
+    queue.put(None)
+
+    persist_batches(queue, errors, **kw)
+
+    reported = []
+    while not errors.empty():
+        reported.append(errors.get_nowait())
+
+    return reported
+
+
+def mock_stage_class():
+    # the pages of the mocked stages changed since the previous crawl
+    MockStage = Mock()
+    MockStage.return_value.unchanged = False
+    MockStage.return_value.not_modified = False
+    MockStage.return_value.indexed = None
+    return MockStage
+
+
+def item_for(case_name, data, url='foobar.com'):
+    return ('tests.unit.multi.test_workers', 'FakeStage',
+            'tests.unit.multi.test_workers', case_name, url, data)
+
+
+def test_persist_batches_with_data():
+    ("cello.multi.workers.persist_batches should "
      "persist the given data appropriately")
     MockedCase.save.reset_mock()
-
-    stage = Mock()
-    worker_queue = Mock()
-    results_queue = Mock()
+    MockedCase.save.side_effect = None
 
     data = {
         'name': 'Gabriel',
     }
-    persist_async(
-        stage=stage,
-        case_module_name='tests.unit.multi.test_workers',
-        case_name='MockedCase',
-        data=data,
-        worker_queue=worker_queue,
-        results_queue=results_queue,
-    )
+    errors = run_persist_batches(item_for('MockedCase', data))
 
     MockedCase.save.assert_called_once_with(data)
-    worker_queue.work_done.assert_called_once_with()
+    errors.should.be.empty
 
 
-def test_persist_async_without_data():
-    ("cello.multi.workers.persist_async should "
-     "raise when there is no data, but should also clear the queue")
-    MockedCase.save.reset_mock()
+def test_persist_batches_saves_in_batches():
+    ("cello.multi.workers.persist_batches hands batch_size "
+     "items at once to cases that implement save_many")
+    BatchCase.batches = []
 
-    class FakeStage(object):
-        url = 'foobar.com'
+    run_persist_batches(*[item_for('BatchCase', {'n': n}) for n in range(5)], batch_size=2)
 
-    worker_queue = Mock()
-    results_queue = Mock()
+    BatchCase.batches.should.equal([
+        [{'n': 0}, {'n': 1}],
+        [{'n': 2}, {'n': 3}],
+        [{'n': 4}],
+    ])
 
-    persist_async.when.called_with(
-        stage=FakeStage(),
-        case_module_name='tests.unit.multi.test_workers',
-        case_name='MockedCase',
-        data={},
-        worker_queue=worker_queue,
-        results_queue=results_queue,
-    ).should.throw(BadTuneReturnValue)
 
-    MockedCase.save.called.should.be.false
+def test_persist_batches_skips_unchanged_items():
+    ("cello.multi.workers.persist_batches doesn't save the items that are "
+     "the same as the ones saved by a previous crawl")
+    BatchCase.batches = []
+    directory = tempfile.mkdtemp()
+    FingerprintedStage.fingerprints = FingerprintStore(os.path.join(directory, 'items.db'))
+
+    def item(data):
+        return ('tests.unit.multi.test_workers', 'FingerprintedStage',
+                'tests.unit.multi.test_workers', 'BatchCase', 'foobar.com', data)
+
+    try:
+        run_persist_batches(item({'n': 1, 'datetime': 'yesterday'}))
+        run_persist_batches(item({'n': 1, 'datetime': 'today'}), item({'n': 2}))
+    finally:
+        shutil.rmtree(directory)
 
-    worker_queue.work_done.assert_called_once_with()
+    BatchCase.batches.should.equal([
+        [{'n': 1, 'datetime': 'yesterday'}],
+        [{'n': 2}],
+    ])
+    FingerprintedStage.fingerprints.report()['items.unchanged'].should.equal(1)
 
 
-def test_persist_async_upon_case_cello_exception():
-    ("cello.multi.workers.persist_async upon exception "
-     "should enqueue the exception data in the results "
-     "queue and close the worker queue")
+def test_persist_batches_without_data():
+    ("cello.multi.workers.persist_batches should "
+     "report a BadTuneReturnValue when there is no data")
     MockedCase.save.reset_mock()
 
-    MockedCase.save.side_effect = CelloStopScraping("c'mon dawg !!!")
+    errors = run_persist_batches(item_for('MockedCase', {}))
+
+    MockedCase.save.called.should.be.false
+    [(name, args)] = errors
+    name.should.equal(BadTuneReturnValue.__name__)
+    args[0].should.contain('foobar.com')
 
-    class FakeStage(object):
-        url = 'foobar.com'
 
-    worker_queue = Mock()
-    results_queue = Mock()
+def test_persist_batches_upon_case_cello_exception():
+    ("cello.multi.workers.persist_batches upon a cello exception "
+     "should report it and go on with the next items")
+    MockedCase.save.reset_mock()
 
-    persist_async(
-        stage=FakeStage(),
-        case_module_name='tests.unit.multi.test_workers',
-        case_name='MockedCase',
-        data={'some': 'data'},
-        worker_queue=worker_queue,
-        results_queue=results_queue,
-    )
+    MockedCase.save.side_effect = [CelloStopScraping("c'mon dawg !!!"), None]
 
-    worker_queue.work_done.assert_called_once_with()
-    worker_queue.close.assert_called_once_with()
-    results_queue.put.assert_called_once_with(json.dumps((
-        'CelloStopScraping', ("c'mon dawg !!!", )
-    )))
+    errors = run_persist_batches(
+        item_for('MockedCase', {'some': 'data'}),
+        item_for('MockedCase', {'more': 'data'}),
+        batch_size=1)
+    MockedCase.save.side_effect = None
+
+    MockedCase.save.call_count.should.equal(2)
+    errors.should.equal([('CelloStopScraping', ("c'mon dawg !!!", ))])
+
+
+@patch('cello.multi.workers.models.logger')
+def test_persist_batches_upon_other_exceptions(logger):
+    ("cello.multi.workers.persist_batches reports exceptions that "
+     "cello doesn't know about as CelloPersistenceError")
+    MockedCase.save.reset_mock()
+
+    MockedCase.save.side_effect = IOError('disk is full')
+
+    errors = run_persist_batches(item_for('MockedCase', {'some': 'data'}))
+    MockedCase.save.side_effect = None
+
+    errors.should.equal([('CelloPersistenceError', ('IOError: disk is full', ))])
 
 
 def test_fetch_async_persisting_afterwards():
     ("cello.multi.workers.fetch_async in a stage that has a "
-     "case will persist the data after running the scraping methods")
+     "case returns the tuned data along with the case and stage names")
 
-    browser_factory, queue, worker_queue = (Mock(), ) * 3
+    browser_factory = Mock()
 
-    MockStage = Mock()
+    MockStage = mock_stage_class()
     MockStage.__name__ = 'AMockedStage'
     stage = MockStage.return_value
     stage.case = MockedCase
+    stage.url = 'some-url'
+    stage.response.status_code = 200
     stage.tune.return_value = {'data': 0x010101}
-    fetch_async(MockStage, browser_factory, queue, worker_queue,
-                url="some-url", parent_response="parent response")
+    data, tasks = fetch_async(MockStage, browser_factory,
+                              url="some-url", parent_response="parent response")
 
     stage.fetch.assert_called_once_with()
-    worker_queue.work_done.assert_called_once_with()
     stage.play.assert_called_once_with()
 
-    queue.put.assert_called_once_with(json.dumps({
+    data.should.equal({
         'data': 0x010101,
         "case.module": "tests.unit.multi.test_workers",
         "case.name": "MockedCase",
         "stage.module": "mock",
         "stage.name": "AMockedStage",
-    }))
+        "stage.url": "some-url",
+        "stage.indexed": None,
+        "fetch.status": 200,
+    })
+    tasks.should.equal([])
+
+
+def test_fetch_async_marks_the_progress_of_the_page():
+    ("cello.multi.workers.fetch_async tells the frontier that a page "
+     "was tuned, or done with when its stage has no case")
+
+    frontier = Mock()
+
+    MockStage = mock_stage_class()
+    MockStage.__name__ = 'AMockedStage'
+    stage = MockStage.return_value
+    stage.already_visited.return_value = False
+    stage.frontier = frontier
+    stage.case = MockedCase
+    stage.tune.return_value = {'data': 1}
+    fetch_async(MockStage, Mock(), url="some-url", frontier=frontier)
+    frontier.mark.assert_called_once_with(stage, 'tuned')
+
+    frontier.mark.reset_mock()
+    stage.case = None
+    fetch_async(MockStage, Mock(), url="some-url", frontier=frontier)
+    frontier.mark.assert_called_once_with(stage, 'persisted')
+
+
+def test_fetch_async_returns_the_tasks_queued_by_the_stage():
+    ("cello.multi.workers.fetch_async hands its stage a list of "
+     "tasks and returns what the stage queued into it")
+
+    def play():
+        MockStage.call_args[1]['tasks'].append('next task')
+
+    MockStage = mock_stage_class()
+    stage = MockStage.return_value
+    stage.case = None
+    stage.response = None
+    stage.play.side_effect = play
+
+    data, tasks = fetch_async(MockStage, Mock(), url="some-url")
+
+    data.should.equal({'fetch.status': None})
+    tasks.should.equal(['next task'])
 
 
 def test_fetch_without_a_case():
@@ -130,20 +255,21 @@ def test_fetch_without_a_case():
      "case will simply run the scraping methods without taking action "
      "towards data persistence")
 
-    browser_factory, queue, worker_queue = (Mock(), ) * 3
+    browser_factory = Mock()
 
-    MockStage = Mock()
+    MockStage = mock_stage_class()
     stage = MockStage.return_value
     stage.case = None
+    stage.response.status_code = 503
     stage.tune.return_value = {'data': 0x010101}
-    fetch_async(MockStage, browser_factory, queue, worker_queue,
-                url="some-url", parent_response="parent response")
+    data, tasks = fetch_async(MockStage, browser_factory,
+                              url="some-url", parent_response="parent response")
 
     stage.fetch.assert_called_once_with()
-    worker_queue.work_done.assert_called_once_with()
     stage.play.assert_called_once_with()
+    stage.tune.called.should.be.false
 
-    queue.put.assert_called_once_with('{}')
+    data.should.equal({'fetch.status': 503})
 
 
 def test_fetch_upon_error_sends_exception_information_to_queue_stage_fetch():
@@ -151,16 +277,13 @@ def test_fetch_upon_error_sends_exception_information_to_queue_stage_fetch():
      "(the ones declared inside `cello.models`) happened inside "
      "`stage.fetch()`")
 
-    browser_factory, queue, worker_queue = (Mock(), ) * 3
-
-    MockStage = Mock()
+    MockStage = mock_stage_class()
     MockStage.return_value.fetch.side_effect = InvalidStateURLError('stop now!', 0x101010)
 
-    fetch_async(MockStage, browser_factory, queue, worker_queue,
-                url="some-url", parent_response="parent response")
+    error, tasks = fetch_async(MockStage, Mock(),
+                               url="some-url", parent_response="parent response")
 
-    worker_queue.work_done.assert_called_once_with()
-    queue.put.assert_called_once_with(json.dumps(['InvalidStateURLError', ['stop now!', 0x101010]]))
+    error.should.equal(('InvalidStateURLError', ('stop now!', 0x101010)))
 
 
 def test_fetch_upon_error_sends_exception_information_to_queue_stage_play():
@@ -168,18 +291,15 @@ def test_fetch_upon_error_sends_exception_information_to_queue_stage_play():
      "(the ones declared inside `cello.models`) happened inside "
      "`stage.play()`")
 
-    browser_factory, queue, worker_queue = (Mock(), ) * 3
-
-    MockStage = Mock()
+    MockStage = mock_stage_class()
     stage = MockStage.return_value
     stage.case = MockedCase
     stage.play.side_effect = CelloStopScraping('stop now!', 0x101010)
 
-    fetch_async(MockStage, browser_factory, queue, worker_queue,
-                url="some-url", parent_response="parent response")
+    error, tasks = fetch_async(MockStage, Mock(),
+                               url="some-url", parent_response="parent response")
 
-    worker_queue.work_done.assert_called_once_with()
-    queue.put.assert_called_once_with(json.dumps(['CelloStopScraping', ['stop now!', 0x101010]]))
+    error.should.equal(('CelloStopScraping', ('stop now!', 0x101010)))
 
 
 def test_fetch_upon_error_sends_exception_information_to_queue_stage_tune():
@@ -187,62 +307,203 @@ def test_fetch_upon_error_sends_exception_information_to_queue_stage_tune():
      "(the ones declared inside `cello.models`) happened inside "
      "`stage.tune()`")
 
-    browser_factory, queue, worker_queue = (Mock(), ) * 3
-
-    MockStage = Mock()
+    MockStage = mock_stage_class()
     stage = MockStage.return_value
     stage.tune.side_effect = InvalidURLMapping('stop now!', 0x101010)
 
-    fetch_async(MockStage, browser_factory, queue, worker_queue,
-                url="some-url", parent_response="parent response")
+    error, tasks = fetch_async(MockStage, Mock(),
+                               url="some-url", parent_response="parent response")
 
-    worker_queue.work_done.assert_called_once_with()
-    queue.put.assert_called_once_with(json.dumps(['InvalidURLMapping', ['stop now!', 0x101010]]))
+    error.should.equal(('InvalidURLMapping', ('stop now!', 0x101010)))
 
 
 def test_fetch_upon_system_exception_just_raises():
     ("cello.multi.workers.tune_async just raises in case the exception "
      "raised is not defined in `cello.models`")
 
-    browser_factory, queue, worker_queue = (Mock(), ) * 3
-
-    MockStage = Mock()
+    MockStage = mock_stage_class()
     stage = MockStage.return_value
     stage.tune.side_effect = TypeError('whatever')
 
     fetch_async.when.called_with(
-        MockStage, browser_factory, queue, worker_queue,
+        MockStage, Mock(),
         url="some-url", parent_response="parent response").should.throw(
             TypeError, "whatever")
 
-    worker_queue.work_done.assert_called_once_with()
 
+@patch('cello.multi.workers.models.logger')
+def test_handle_exception(logger):
+    ("cello.multi.workers.handle_exception when "
+     "called with CelloJumpToNextStage should do some logging")
 
-@patch('cello.multi.workers.json')
-def test_fetch_async_upon_unicode_decode_error_of_serialization(json):
-    ("cello.multi.workers.fetch_async captures an `UnicodeDecodeError` "
-     "and simply swallows it")
+    exc = CelloJumpToNextStage('whatever, just log me up bro...')
 
-    json.dumps.side_effect = [UnicodeDecodeError('hitchhiker', "", 42, 43, 'the universe and everything else'), 'fake json']
-    browser_factory, queue, worker_queue = (Mock(), ) * 3
+    handle_exception(exc).should.equal({})
 
-    MockStage = Mock()
+    logger.warning.assert_called_once_with("Jumping to next stage: %s", exc)
+
+
+def test_fetch_async_skips_urls_already_visited():
+    ("cello.multi.workers.fetch_async does not fetch urls "
+     "that the crawl frontier has already seen")
+
+    browser_factory = Mock()
+
+    MockStage = mock_stage_class()
     stage = MockStage.return_value
-    stage.case = None
+    stage.already_visited.return_value = True
+    frontier = Mock()
 
-    fetch_async(MockStage, browser_factory, queue, worker_queue,
-                url="some-url", parent_response="parent response")
+    data, tasks = fetch_async(MockStage, browser_factory,
+                              url="some-url", parent_response="parent response",
+                              frontier=frontier)
 
-    worker_queue.work_done.assert_called_once_with()
-    queue.put.called.should.be.false
+    MockStage.assert_called_once_with(
+        browser_factory,
+        url="some-url",
+        parent=None,
+        parent_response="parent response",
+        frontier=frontier,
+        tasks=[])
+    stage.fetch.called.should.be.false
+    data.should.equal({})
 
 
-def test_handle_exception():
-    ("cello.multi.workers.handle_exception when "
-     "called with CelloJumpToNextStage should do some logging")
+def test_work_runs_tasks_until_told_to_stop():
+    ("cello.multi.workers.work runs each task with the worker "
+     "context and reports its result until it gets a None")
 
-    # TODO add logging and make this test pass
+    def task(browser_factory, url):
+        return '{}:{}'.format(browser_factory, url), ['child of ' + url]
 
-    exc = CelloJumpToNextStage('whatever, just log me up bro...')
+    tasks, results = Queue(), Queue()
+    tasks.put((1, task, {'url': 'a'}))
+    tasks.put((2, task, {'url': 'b'}))
+    tasks.put(None)
+    current = [99]
+
+    work(tasks, results, current, 0, context={'browser_factory': 'browser'})
+
+    results.get_nowait().should.equal((1, 'browser:a', ['child of a']))
+    results.get_nowait().should.equal((2, 'browser:b', ['child of b']))
+    results.empty().should.be.true
+    current.should.equal([0])
+
+
+def test_work_exits_after_max_tasks():
+    ("cello.multi.workers.work returns after running "
+     "max_tasks tasks and leaves the rest in the queue")
+
+    task = Mock(return_value=(None, []))
+    tasks, results = Queue(), Queue()
+    for task_id in range(1, 4):
+        tasks.put((task_id, task, {}))
+
+    work(tasks, results, [0], 0, max_tasks=2)
+
+    task.call_count.should.equal(2)
+    results.qsize().should.equal(2)
+    tasks.qsize().should.equal(1)
+
+
+def test_work_closes_its_browser_before_exiting():
+    ("cello.multi.workers.work releases the browser of its thread "
+     "once it is done")
+
+    browsers = Mock()
+    tasks = Queue()
+    tasks.put(None)
+
+    work(tasks, Queue(), [0], 0, context={'browser_factory': browsers})
+
+    browsers.release.assert_called_once_with()
+
+
+@patch('cello.multi.workers.models.logger')
+def test_work_survives_a_failing_task(logger):
+    ("cello.multi.workers.work logs a failing task, reports an "
+     "empty result for it and moves on to the next one")
+
+    task = Mock(side_effect=[TypeError('boom'), ('raw', [])])
+    task.__name__ = 'task'
+    tasks, results = Queue(), Queue()
+    tasks.put((1, task, {'url': 'a'}))
+    tasks.put((2, task, {'url': 'b'}))
+    tasks.put(None)
+
+    work(tasks, results, [0], 0)
+
+    results.get_nowait().should.equal((1, None, []))
+    results.get_nowait().should.equal((2, 'raw', []))
+    logger.exception.assert_called_once_with(
+        "%s failed with %r", 'task', {'url': 'a'})
+
+
+def test_work_serializes_messages():
+    ("cello.multi.workers.work loads tasks and dumps results "
+     "with the given serializer")
+
+    serializer = PickleSerializer()
+    tasks, results = Queue(), Queue()
+    tasks.put(serializer.dumps((1, fetch_nothing, {'url': 'a'})))
+    tasks.put(None)
+
+    work(tasks, results, [0], 0, serializer=serializer)
+
+    serializer.loads(results.get_nowait()).should.equal((1, {'url': 'a'}, []))
+
+
+@patch('cello.multi.workers.models.logger')
+def test_work_reports_results_it_could_not_serialize(logger):
+    ("cello.multi.workers.work reports a result that can't be "
+     "serialized without its child tasks")
+
+    serializer = PickleSerializer()
+    tasks, results = Queue(), Queue()
+    tasks.put(serializer.dumps((1, fetch_unpicklable, {})))
+    tasks.put(None)
+
+    work(tasks, results, [0], 0, serializer=serializer)
+
+    serializer.loads(results.get_nowait()).should.equal((1, None, None))
+    logger.exception.assert_called_once_with(
+        "Could not send the result of %s back", 'fetch_unpicklable')
+
+
+def test_fetch_async_skips_unchanged_pages():
+    ("cello.multi.workers.fetch_async neither tunes nor persists pages "
+     "that didn't change since the previous crawl, and tells the frontier they are done")
+
+    frontier = Mock()
+
+    MockStage = mock_stage_class()
+    MockStage.__name__ = 'AMockedStage'
+    stage = MockStage.return_value
+    stage.already_visited.return_value = False
+    stage.frontier = frontier
+    stage.unchanged = True
+    stage.case = MockedCase
+    stage.response.status_code = 200
+
+    data, tasks = fetch_async(MockStage, Mock(), url="some-url", frontier=frontier)
+
+    stage.play.assert_called_once_with()
+    stage.tune.called.should.be.false
+    frontier.mark.assert_called_once_with(stage, 'persisted')
+    data.should.equal({'fetch.status': 200})
+
+
+def test_fetch_async_does_not_play_pages_that_were_not_modified():
+    ("cello.multi.workers.fetch_async doesn't play pages that "
+     "weren't downloaded because they were not modified")
+
+    MockStage = mock_stage_class()
+    stage = MockStage.return_value
+    stage.unchanged = stage.not_modified = True
+    stage.response = None
+
+    data, tasks = fetch_async(MockStage, Mock(), url="some-url")
 
-    handle_exception(exc)
+    stage.play.called.should.be.false
+    stage.tune.called.should.be.false
+    data.should.equal({'fetch.status': None})
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import threading
+from StringIO import StringIO
+from sure import expect
+from cello.multi.thread import WorkerPool
+from cello.multi.browsers import BrowserPool
+
+
+def double(number):
+    return number * 2, []
+
+
+def test_creates_queues_and_slots():
+    ("WorkerPool uses plain queues and a list of slots [threading implementation]")
+
+    pool = WorkerPool(10, output=StringIO())
+
+    pool.max_workers.should.equal(10)
+    expect(pool.tasks).to.be.a('Queue.Queue')
+    expect(pool.results).to.be.a('Queue.Queue')
+    pool.current.should.equal([0] * 10)
+    pool.tasks.maxsize.should.equal(20)
+    pool.results.maxsize.should.equal(0)
+
+
+def test_runs_tasks_on_threads():
+    ("WorkerPool runs the submitted tasks and hands back their "
+     "results [threading implementation]")
+
+    pool = WorkerPool(2, max_tasks_per_child=1, output=StringIO())
+    pool.start()
+    try:
+        for number in range(5):
+            pool.submit(double, number=number)
+
+        results = []
+        while pool.pending:
+            result = pool.next_result()
+            if result is not None:
+                results.append(result[1])
+    finally:
+        pool.stop()
+
+    sorted(results).should.equal([0, 2, 4, 6, 8])
+
+
+def test_stop_with_retired_workers_and_a_full_queue():
+    ("WorkerPool#stop returns even when a retired worker was not replaced "
+     "and the queue is full [threading implementation]")
+
+    pool = WorkerPool(1, max_tasks_per_child=1, max_queued=1, output=StringIO())
+    pool.start()
+    pool.submit(double, number=1)
+    pool.workers[0].join(5)
+    pool.submit(double, number=2)
+
+    stopping = threading.Thread(target=pool.stop)
+    stopping.daemon = True
+    stopping.start()
+    stopping.join(5)
+
+    stopping.is_alive().should.be.false
+
+
+def test_workers_get_thread_local_browsers():
+    ("WorkerPool hands its workers a pool of thread local browsers")
+
+    pool = WorkerPool(2, output=StringIO(), context={
+        'browser_factory': 'factory',
+        'frontier': 'frontier',
+    })
+
+    pool.context['browser_factory'].should.be.a(BrowserPool)
+    pool.context['browser_factory'].factory.should.equal('factory')
+    pool.context['frontier'].should.equal('frontier')
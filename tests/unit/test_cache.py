@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import threading
+import multiprocessing
+from mock import Mock, patch
+from cello.cache import ResponseCache, CachedResponse, ContentIndex
+
+
+class Response(object):
+    def __init__(self, content, status_code=200, headers=None):
+        self.content = content
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+def make_cache(**kw):
+    return ResponseCache(tempfile.mkdtemp(), **kw)
+
+
+def test_stores_and_reuses_responses():
+    ("ResponseCache#fetch only calls the fetcher for urls it doesn't have")
+
+    cache = make_cache()
+    get_response = Mock(return_value=Response('<p>cello</p>'))
+
+    first = cache.fetch('http://fab.com/1', get_response, None)
+    second = cache.fetch('http://fab.com/1', get_response, None)
+
+    get_response.assert_called_once_with('http://fab.com/1')
+    first.content.should.equal('<p>cello</p>')
+    second.should.be.a(CachedResponse)
+    second.content.should.equal('<p>cello</p>')
+    second.status_code.should.equal(200)
+    cache.report().should.equal({
+        'cache.hits': 1,
+        'cache.misses': 1,
+        'cache.revalidated': 0,
+        'cache.stored': 1,
+        'cache.evicted': 0,
+        'cache.hit_ratio': 0.5,
+    })
+
+    shutil.rmtree(cache.directory)
+
+
+def test_survives_restarts():
+    ("ResponseCache finds the responses stored by a previous crawl")
+
+    cache = make_cache()
+    cache.fetch('http://fab.com/1', Mock(return_value=Response('<p>cello</p>')), None)
+
+    again = ResponseCache(cache.directory)
+
+    len(again).should.equal(1)
+    again.get('http://fab.com/1').content.should.equal('<p>cello</p>')
+
+    shutil.rmtree(cache.directory)
+
+
+def test_only_stores_successful_responses():
+    ("ResponseCache doesn't keep errors around")
+
+    cache = make_cache()
+    get_response = Mock(return_value=Response('not found', status_code=404))
+
+    cache.fetch('http://fab.com/1', get_response, None)
+    cache.fetch('http://fab.com/1', get_response, None)
+
+    get_response.call_count.should.equal(2)
+    len(cache).should.equal(0)
+
+    shutil.rmtree(cache.directory)
+
+
+@patch('cello.cache.time')
+def test_revalidates_stale_responses(time):
+    ("ResponseCache#fetch revalidates stale responses that have validators")
+
+    time.time.return_value = 1000
+    cache = make_cache(ttl=60)
+    cache.fetch('http://fab.com/1', Mock(return_value=Response(
+        '<p>cello</p>', headers={'ETag': '"v1"', 'Last-Modified': 'Mon, 01 Jul 2013 00:00:00 GMT'})), None)
+
+    time.time.return_value = 1030
+    cache.fetch('http://fab.com/1', None, None).content.should.equal('<p>cello</p>')
+
+    time.time.return_value = 1100
+    get_conditional_response = Mock(return_value=Response('', status_code=304))
+    response = cache.fetch('http://fab.com/1', None, get_conditional_response)
+
+    get_conditional_response.assert_called_once_with('http://fab.com/1', {
+        'If-None-Match': '"v1"',
+        'If-Modified-Since': 'Mon, 01 Jul 2013 00:00:00 GMT',
+    })
+    response.content.should.equal('<p>cello</p>')
+    cache.get('http://fab.com/1').stored_at.should.equal(1100)
+    cache.report()['cache.revalidated'].should.equal(1)
+
+    shutil.rmtree(cache.directory)
+
+
+@patch('cello.cache.time')
+def test_refetches_stale_responses_without_validators(time):
+    ("ResponseCache#fetch fetches stale responses again when they can't be revalidated")
+
+    time.time.return_value = 1000
+    cache = make_cache(ttl=60)
+    cache.fetch('http://fab.com/1', Mock(return_value=Response('old')), None)
+
+    time.time.return_value = 1100
+    cache.fetch('http://fab.com/1', Mock(return_value=Response('new')), None).content.should.equal('new')
+    cache.get('http://fab.com/1').content.should.equal('new')
+
+    shutil.rmtree(cache.directory)
+
+
+def test_evicts_the_least_recently_used_responses():
+    ("ResponseCache evicts the least recently used responses above max_bytes")
+
+    cache = make_cache()
+    for n in range(3):
+        cache.fetch('http://fab.com/%d' % n, Mock(return_value=Response(os.urandom(1000))), None)
+
+    cache.max_bytes = cache.size + 10
+    cache.get('http://fab.com/0')
+    cache.fetch('http://fab.com/3', Mock(return_value=Response(os.urandom(1000))), None)
+
+    cache.get('http://fab.com/1').should.be.none
+    cache.get('http://fab.com/0').should_not.be.none
+    len(cache).should.equal(3)
+    cache.report()['cache.evicted'].should.equal(1)
+
+    shutil.rmtree(cache.directory)
+
+
+def test_threads_share_the_cache():
+    ("ResponseCache can be shared by threads that store and evict at once")
+
+    cache = make_cache(max_bytes=20000)
+    errors = []
+
+    def crawl(offset):
+        try:
+            for n in range(100):
+                url = 'http://fab.com/%d' % ((offset + n) % 30)
+                cache.fetch(url, lambda url: Response(os.urandom(1000)), None)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=crawl, args=(offset, )) for offset in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    on_disk = sum(os.path.getsize(os.path.join(cache.directory, name))
+                  for name in os.listdir(cache.directory) if not name.startswith('.'))
+
+    errors.should.be.empty
+    cache.size.should.equal(sum(cache.entries.values()))
+    cache.size.should.equal(on_disk)
+    cache.report()['cache.evicted'].should.be.greater_than(0)
+
+    shutil.rmtree(cache.directory)
+
+
+def test_responses_evicted_by_someone_else_are_misses():
+    ("ResponseCache#get takes a response whose file was removed as a miss")
+
+    cache = make_cache()
+    cache.fetch('http://fab.com/1', Mock(return_value=Response('<p>cello</p>')), None)
+    os.remove(cache.path(cache.key('http://fab.com/1')))
+
+    cache.get('http://fab.com/1').should.be.none
+    len(cache).should.equal(0)
+    cache.size.should.equal(0)
+
+    shutil.rmtree(cache.directory)
+
+
+def fetch_in_a_process(cache, url):
+    cache.fetch(url, lambda url: Response(url), None)
+
+
+def test_shared_counters():
+    ("ResponseCache counts what forked processes fetch when shared")
+
+    cache = make_cache(shared=True)
+    processes = [
+        multiprocessing.Process(target=fetch_in_a_process, args=(cache, 'http://fab.com/1'))
+        for n in range(2)]
+    for process in processes:
+        process.start()
+        process.join()
+
+    report = cache.report()
+    (report['cache.hits'] + report['cache.misses']).should.equal(2)
+
+    shutil.rmtree(cache.directory)
+
+
+def crawl_in_a_process(cache, offset):
+    for n in range(60):
+        url = 'http://fab.com/%d' % ((offset * 30 + n) % 120)
+        cache.fetch(url, lambda url: Response(os.urandom(1000)), None)
+
+
+def test_shared_caches_stay_under_max_bytes_across_processes():
+    ("ResponseCache keeps the responses stored by every forked process "
+     "under max_bytes when shared")
+
+    cache = make_cache(max_bytes=20000, shared=True)
+    processes = [
+        multiprocessing.Process(target=crawl_in_a_process, args=(cache, offset))
+        for offset in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    on_disk = sum(os.path.getsize(os.path.join(cache.directory, name))
+                  for name in os.listdir(cache.directory) if not name.startswith('.'))
+
+    on_disk.should.be.lower_than(20001)
+    cache.size.should.equal(on_disk)
+    len(cache).should.equal(len(os.listdir(cache.directory)))
+    cache.report()['cache.evicted'].should.be.greater_than(0)
+
+    shutil.rmtree(cache.directory)
+
+
+def make_index(**kw):
+    return ContentIndex(os.path.join(tempfile.mkdtemp(), 'index.db'), **kw)
+
+
+def test_index_tells_unchanged_pages():
+    ("ContentIndex#fetch tells whether a page has the same body as in the previous crawl")
+
+    index = make_index()
+    get_response = Mock(return_value=Response('<p>cello</p>'))
+
+    response, unchanged, entry = index.fetch('http://fab.com/1', get_response, None)
+    unchanged.should.be.false
+    index.remember('http://fab.com/1', entry)
+
+    again = ContentIndex(index.path)
+    response, unchanged, entry = again.fetch('http://fab.com/1', get_response, None)
+    get_response.return_value = Response('<p>viola</p>')
+    changed = again.fetch('http://fab.com/1', get_response, None)
+
+    response.content.should.equal('<p>cello</p>')
+    unchanged.should.be.true
+    entry.should.be.none
+    changed[1].should.be.false
+    changed[2][0].should_not.equal(index.digest(Response('<p>cello</p>')))
+    len(again).should.equal(1)
+    again.report().should.equal({
+        'incremental.not_modified': 0,
+        'incremental.unchanged': 1,
+        'incremental.changed': 1,
+        'incremental.new': 0,
+        'incremental.skipped': 1,
+    })
+
+    shutil.rmtree(os.path.dirname(index.path))
+
+
+def test_index_sends_conditional_requests():
+    ("ContentIndex#fetch requests pages with the validators of the previous "
+     "crawl, and doesn't download those that were not modified")
+
+    index = make_index()
+    entry = index.fetch('http://fab.com/1', Mock(return_value=Response(
+        '<p>cello</p>', headers={'ETag': '"v1"', 'Last-Modified': 'Mon, 01 Jul 2013 00:00:00 GMT'})), None)[2]
+    index.remember('http://fab.com/1', entry)
+
+    get_response = Mock()
+    get_conditional_response = Mock(return_value=Response('', status_code=304))
+    response, unchanged, entry = index.fetch('http://fab.com/1', get_response, get_conditional_response)
+
+    get_response.called.should.be.false
+    get_conditional_response.assert_called_once_with('http://fab.com/1', {
+        'If-None-Match': '"v1"',
+        'If-Modified-Since': 'Mon, 01 Jul 2013 00:00:00 GMT',
+    })
+    response.should.be.none
+    unchanged.should.be.true
+    entry.should.be.none
+    index.report()['incremental.not_modified'].should.equal(1)
+
+    shutil.rmtree(os.path.dirname(index.path))
+
+
+def test_index_ignores_failed_responses():
+    ("ContentIndex doesn't remember the body of responses other than 200")
+
+    index = make_index()
+    get_response = Mock(return_value=Response('oops', status_code=503))
+
+    index.fetch('http://fab.com/1', get_response, None).should.equal((get_response.return_value, False, None))
+
+    len(index).should.equal(0)
+    index.report()['incremental.skipped'].should.equal(0)
+
+    shutil.rmtree(os.path.dirname(index.path))
+
+
+def test_index_only_remembers_what_it_is_told():
+    ("ContentIndex#fetch doesn't remember pages by itself, so that a page whose "
+     "item failed to be saved isn't taken as unchanged by the next crawl")
+
+    index = make_index()
+    get_response = Mock(return_value=Response('<p>cello</p>'))
+
+    index.fetch('http://fab.com/1', get_response, None)
+    again = ContentIndex(index.path)
+
+    again.fetch('http://fab.com/1', get_response, None)[1].should.be.false
+    len(again).should.equal(0)
+    again.report()['incremental.new'].should.equal(1)
+
+    shutil.rmtree(os.path.dirname(index.path))
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from lxml import html as lhtml
+from lxml.cssselect import CSSSelector
+from mock import patch
+from sure import expect
+from cello.extraction import Field, Extractor, InvalidField
+
+PRODUCT_PAGE = '''<html><body>
+<div class="prodInfoBlock"><h1> Lamp </h1></div>
+<h1>Not the product name</h1>
+<span class="fabPrice">$10</span>
+<span class="retailPrice">$30 retail</span>
+<ul class="tblList">
+  <li class="half"><label>Color</label><span>Red</span></li>
+  <li class="half"><label>Size</label><span>XL</span></li>
+</ul>
+<img src="/lamp.png" data-zoom="yes" />
+<img src="/lamp.jpg" />
+<p class="first">one</p><p class="second">two</p>
+</body></html>'''
+
+
+def test_field_defaults_to_the_first_text():
+    "Field reads the text of the first element by default"
+
+    field = Field('h1')
+
+    expect(field.read).to.equal('text')
+    expect(field.many).to.be.false
+
+
+def test_field_with_attr_reads_attributes():
+    "Field(attr=...) reads that attribute"
+
+    expect(Field('img', attr='src').read).to.equal('attr')
+
+
+def test_field_with_invalid_reader():
+    "Field raises InvalidField when the reader is unknown"
+
+    expect(Field).when.called_with('h1', read='nope').to.throw(
+        InvalidField,
+        "cannot read 'nope' from 'h1', choose one of: text, html, attr")
+
+
+def test_field_reading_attr_requires_a_name():
+    "Field raises InvalidField when reading an attribute without a name"
+
+    expect(Field).when.called_with('img', read='attr').to.throw(
+        InvalidField,
+        "the field 'img' reads an attribute but has no attr name")
+
+
+def test_extract_fields_in_a_single_pass():
+    "Extractor.extract collects every field from the dom"
+
+    extractor = Extractor({
+        'name': '.prodInfoBlock h1',
+        'sale_price': Field('.fabPrice'),
+        'labels': Field('ul.tblList .half label', many=True),
+        'values': Field('ul.tblList > li > span', many=True),
+        'image': Field('img[src*=png][data-zoom]', attr='src'),
+        'after_first': Field('p.first + p'),
+        'siblings': Field('h1 ~ span', many=True),
+        'missing': Field('.nothing-here'),
+    })
+
+    data = extractor.extract(lhtml.fromstring(PRODUCT_PAGE))
+
+    expect(data).to.equal({
+        'name': 'Lamp',
+        'sale_price': '$10',
+        'labels': ['Color', 'Size'],
+        'values': ['Red', 'XL'],
+        'image': '/lamp.png',
+        'after_first': 'two',
+        'siblings': ['$10', '$30 retail'],
+        'missing': '',
+    })
+
+
+def test_extract_matches_lxml_cssselect():
+    "Extractor.extract finds the same elements as lxml's cssselect"
+
+    dom = lhtml.fromstring(PRODUCT_PAGE)
+    selectors = [
+        'li span',
+        'ul > li.half',
+        'body h1, span.fabPrice',
+        'label + span',
+        'div h1',
+        '*[data-zoom]',
+    ]
+
+    for selector in selectors:
+        extractor = Extractor({'found': Field(selector, read='html', many=True)})
+        expected = [lhtml.tostring(e) for e in dom.cssselect(selector)]
+        expect(extractor.extract(dom)['found']).to.equal(expected)
+
+
+def test_extract_matches_lxml_cssselect_across_selectors():
+    "Extractor.extract finds the same elements as CSSSelector for every kind of selector, page after page"
+
+    pages = [lhtml.fromstring(PRODUCT_PAGE), lhtml.fromstring(PRODUCT_PAGE.replace('XL', 'Retail size'))]
+    selectors = [
+        'span',
+        '.half',
+        'li span',
+        'ul > li > label',
+        'label + span',
+        'h1 ~ span',
+        'img[src]',
+        'img[src$=jpg]',
+        'img[src^="/lamp"]',
+        'li[class~=half]',
+        'p:not(.first)',
+        'span:contains("retail")',
+        'li:contains("xl") span',
+        'p:contains("two"), h1',
+        'li:nth-child(2) span',
+        'p:first-child',
+        'li:last-child label',
+        'span:empty',
+    ]
+
+    for selector in selectors:
+        extractor = Extractor({'found': Field(selector, read='html', many=True)})
+        # compiled selectors are reused across pages
+        for dom in pages:
+            expected = [lhtml.tostring(e) for e in CSSSelector(selector, translator='html')(dom)]
+            expect(extractor.extract(dom)['found']).to.equal(expected)
+
+
+@patch('cello.extraction.selector_cache')
+def test_positional_selectors_are_evaluated_on_their_own(selector_cache):
+    "Extractor falls back to the compiled css selector for positional pseudo-classes"
+
+    dom = lhtml.fromstring(PRODUCT_PAGE)
+    selector_cache.css.return_value.return_value = dom.cssselect('li:first-child label')
+
+    extractor = Extractor({
+        'first_label': 'li:first-child label',
+        'name': '.prodInfoBlock h1',
+    })
+
+    expect(extractor.standalone).to.equal(['first_label'])
+    expect(extractor.extract(dom)).to.equal({
+        'first_label': 'Color',
+        'name': 'Lamp',
+    })
+    selector_cache.css.assert_called_once_with('li:first-child label')
+    selector_cache.css.return_value.assert_called_once_with(dom)
+
+
+def test_extractor_without_fields_is_falsy():
+    "An Extractor without fields is falsy"
+
+    expect(bool(Extractor(None))).to.be.false
+    expect(bool(Extractor({'name': 'h1'}))).to.be.true
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+from multiprocessing import Process, Queue
+from mock import Mock
+from sure import expect
+from cello.models import ParentContext
+from cello.frontier import Frontier, SharedFrontier, BloomFilter, BloomFrontier, SQLiteFrontier
+from cello.frontier import FETCHED, TUNED, PERSISTED
+
+
+def test_frontier_add_tells_whether_the_url_is_new():
+    "Frontier.add returns True only the first time an url is added"
+
+    frontier = Frontier()
+
+    expect(frontier.add('http://fab.com/product/1')).to.be.true
+    expect(frontier.add('http://fab.com/product/1')).to.be.false
+    expect(frontier.add('http://fab.com/product/2')).to.be.true
+
+    expect('http://fab.com/product/1' in frontier).to.be.true
+    expect(len(frontier)).to.equal(2)
+    expect(frontier.report()).to.equal({
+        'frontier.urls': 2,
+        'frontier.duplicates': 1,
+        'frontier.collapsed': 0,
+    })
+
+
+def test_frontier_collapse_counts_rewritten_urls():
+    "Frontier.collapse counts the urls a canonicalizer rewrote before they were added"
+
+    frontier = Frontier()
+    frontier.collapse(2)
+    frontier.collapse()
+
+    expect(frontier.collapsed).to.equal(3)
+    expect(len(frontier)).to.equal(0)
+
+
+def test_bloom_filter_never_forgets():
+    "BloomFilter contains every key that was added"
+
+    bloom = BloomFilter(capacity=1000, error_rate=0.01)
+    urls = ['http://fab.com/product/{}'.format(i) for i in range(1000)]
+
+    for url in urls:
+        bloom.add(url)
+
+    expect(all(url in bloom for url in urls)).to.be.true
+    expect(bloom.hashes).to.equal(7)
+    expect(len(bloom.bits)).to.equal(1199)
+
+
+def test_bloom_filter_false_positives_stay_close_to_the_error_rate():
+    "BloomFilter false positive rate is close to the given error rate"
+
+    bloom = BloomFilter(capacity=1000, error_rate=0.01)
+    for i in range(1000):
+        bloom.add(u'http://fab.com/product/{}'.format(i))
+
+    false_positives = sum(
+        'http://fab.com/sale/{}'.format(i) in bloom for i in range(10000))
+
+    expect(false_positives).to.be.lower_than(200)
+
+
+def test_bloom_frontier():
+    "BloomFrontier deduplicates urls"
+
+    frontier = BloomFrontier(capacity=100)
+
+    expect(frontier.add('http://fab.com')).to.be.true
+    expect(frontier.add('http://fab.com')).to.be.false
+    expect(len(frontier)).to.equal(1)
+
+
+def add_urls(frontier, urls, results):
+    results.put([url for url in urls if frontier.add(url)])
+
+
+def assert_shared_between_processes(frontier):
+    urls = ['http://fab.com/product/{}'.format(i) for i in range(50)]
+    results = Queue()
+    workers = [Process(target=add_urls, args=(frontier, urls, results)) for i in range(4)]
+    for worker in workers:
+        worker.start()
+
+    added = sum([results.get() for worker in workers], [])
+    for worker in workers:
+        worker.join()
+
+    expect(sorted(added)).to.equal(sorted(urls))
+    expect(len(frontier)).to.equal(50)
+    expect(frontier.duplicates).to.equal(150)
+
+
+def test_shared_frontier_across_processes():
+    "SharedFrontier hands each url to a single process"
+
+    assert_shared_between_processes(SharedFrontier())
+
+
+def test_shared_bloom_frontier_across_processes():
+    "BloomFrontier(shared=True) hands each url to a single process"
+
+    assert_shared_between_processes(BloomFrontier(capacity=1000, shared=True))
+
+
+class Product(object):
+    pass
+
+
+def with_database(test):
+    def run():
+        directory = tempfile.mkdtemp()
+        try:
+            test(os.path.join(directory, 'crawl.db'))
+        finally:
+            shutil.rmtree(directory)
+
+    run.__name__ = test.__name__
+    run.__doc__ = test.__doc__
+    return run
+
+
+def stage_at(url):
+    return Mock(canonical_url=url)
+
+
+@with_database
+def test_sqlite_frontier_add(path):
+    "SQLiteFrontier.add returns True only the first time an url is added during a crawl"
+
+    frontier = SQLiteFrontier(path)
+
+    expect(frontier.add('http://fab.com/product/1')).to.be.true
+    expect(frontier.add('http://fab.com/product/1', collapsed=True)).to.be.false
+    expect(frontier.add('http://fab.com/product/2')).to.be.true
+
+    expect('http://fab.com/product/1' in frontier).to.be.true
+    expect('http://fab.com/product/3' in frontier).to.be.false
+    expect(frontier.report()).to.equal({
+        'frontier.urls': 2,
+        'frontier.duplicates': 1,
+        'frontier.collapsed': 1,
+    })
+
+
+@with_database
+def test_sqlite_frontier_records_the_state_of_links(path):
+    "SQLiteFrontier records the links found along with their stage, parent and state"
+
+    frontier = SQLiteFrontier(path)
+    parent = ParentContext('http://fab.com/sale', 'http://fab.com', 'tests.Sale', {'brand': 'Fab'})
+
+    frontier.discover('http://fab.com/product/1', Product, parent)
+    frontier.discover('http://fab.com/product/2', Product, parent)
+    frontier.discover('http://fab.com/product/3', Product, parent)
+    frontier.add('http://fab.com/product/1')
+    frontier.mark(stage_at('http://fab.com/product/1'), FETCHED)
+    frontier.mark(stage_at('http://fab.com/product/2'), TUNED)
+    frontier.mark(stage_at('http://fab.com/product/3'), PERSISTED)
+
+    expect(frontier.states()).to.equal({'fetched': 1, 'tuned': 1, 'persisted': 1})
+    expect(sorted(frontier.unfinished())).to.equal([
+        ('http://fab.com/product/1', Product, parent),
+        ('http://fab.com/product/2', Product, parent),
+    ])
+
+
+@with_database
+def test_sqlite_frontier_resumes_a_dead_crawl(path):
+    "SQLiteFrontier hands the links that a dead crawl didn't persist to the next one"
+
+    dead = SQLiteFrontier(path)
+    for number in range(3):
+        dead.add('http://fab.com/product/{}'.format(number))
+
+    dead.mark(stage_at('http://fab.com/product/0'), PERSISTED)
+    dead.mark(stage_at('http://fab.com/product/1'), TUNED)
+
+    frontier = SQLiteFrontier(path)
+
+    expect('http://fab.com/product/0' in frontier).to.be.true
+    expect(frontier.add('http://fab.com/product/0')).to.be.false
+    expect(frontier.add('http://fab.com/product/1')).to.be.true
+    expect(frontier.add('http://fab.com/product/1')).to.be.false
+    expect(frontier.add('http://fab.com/product/2')).to.be.true
+    expect(len(frontier)).to.equal(2)
+
+
+@with_database
+def test_shared_sqlite_frontier_across_processes(path):
+    "SQLiteFrontier(shared=True) hands each url to a single process"
+
+    assert_shared_between_processes(SQLiteFrontier(path, shared=True))
@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from mock import Mock, patch
+from cello.scheduler import TokenBucket, Scheduler, AdaptiveConcurrency
+
+
+@patch('cello.scheduler.time')
+def test_token_bucket(time):
+    ("TokenBucket allows `burst` requests at once, then `rate` requests per second")
+
+    time.time.return_value = 100.0
+    bucket = TokenBucket(rate=2, burst=2)
+
+    bucket.take().should.be.true
+    bucket.take().should.be.true
+    bucket.take().should.be.false
+    bucket.delay().should.equal(0.5)
+
+    time.time.return_value = 100.5
+    bucket.take().should.be.true
+    bucket.take().should.be.false
+
+
+def test_host():
+    ("Scheduler#host is the lowercased host of a url, "
+     "relative ones are resolved against a base url")
+
+    scheduler = Scheduler()
+
+    scheduler.host('http://Fab.com/sale/1').should.equal('fab.com')
+    scheduler.host('/sale/1', 'http://fab.com').should.equal('fab.com')
+    scheduler.host('http://static.fab.com/1.png', 'http://fab.com').should.equal('static.fab.com')
+
+
+def test_unlimited_by_default():
+    ("Scheduler lets every fetch through when it has no limits")
+
+    scheduler = Scheduler()
+
+    for attempt in range(100):
+        scheduler.acquire('fab.com').should.be.true
+
+    scheduler.delay('fab.com').should.equal(0)
+    scheduler.report().should.equal({'scheduler.hosts': 1, 'scheduler.throttled': 0})
+
+
+def test_concurrency_per_host():
+    ("Scheduler caps the fetches in flight per host")
+
+    scheduler = Scheduler(concurrency=2, hosts={'Static.fab.com': {'concurrency': 1}})
+
+    scheduler.acquire('fab.com').should.be.true
+    scheduler.acquire('fab.com').should.be.true
+    scheduler.acquire('fab.com').should.be.false
+    scheduler.acquire('static.fab.com').should.be.true
+    scheduler.acquire('static.fab.com').should.be.false
+
+    scheduler.release('fab.com')
+    scheduler.acquire('fab.com').should.be.true
+
+
+@patch('cello.scheduler.time')
+def test_rate_per_host(time):
+    ("Scheduler takes a token from the bucket of the host for every fetch")
+
+    time.time.return_value = 100.0
+    scheduler = Scheduler(rate=1, hosts={'cdn.fab.com': {'rate': 10, 'burst': 3}})
+
+    scheduler.acquire('fab.com').should.be.true
+    scheduler.release('fab.com')
+    scheduler.acquire('fab.com').should.be.false
+    scheduler.delay('fab.com').should.equal(1)
+
+    [scheduler.acquire('cdn.fab.com') for attempt in range(4)].should.equal([True, True, True, False])
+
+    time.time.return_value = 101.0
+    scheduler.acquire('fab.com').should.be.true
+
+
+def test_slot_waits_for_the_host():
+    ("Scheduler#slot waits until the host can be fetched again")
+
+    sleep = Mock()
+    scheduler = Scheduler(concurrency=1, sleep=sleep)
+    scheduler.acquire('fab.com')
+    sleep.side_effect = lambda seconds: scheduler.release('fab.com')
+
+    with scheduler.slot('http://fab.com/sale/1') as host:
+        host.should.equal('fab.com')
+        scheduler.running['fab.com'].should.equal(1)
+
+    sleep.assert_called_once_with(Scheduler.poll_interval)
+    scheduler.running.should.be.empty
+    scheduler.report()['scheduler.throttled'].should.equal(1)
+
+
+def test_pop_hands_out_other_hosts_while_one_is_throttled():
+    ("Scheduler#pop skips hosts that are throttled and takes turns "
+     "between the others")
+
+    scheduler = Scheduler(concurrency=1)
+    for host, task in [('a.com', 'a1'), ('a.com', 'a2'), ('b.com', 'b1'), ('b.com', 'b2'), ('c.com', 'c1')]:
+        scheduler.push(host, task)
+
+    scheduler.pop().should.equal(('a.com', 'a1'))
+    scheduler.pop().should.equal(('b.com', 'b1'))
+    scheduler.pop().should.equal(('c.com', 'c1'))
+    scheduler.pop().should.be.none
+    scheduler.pop().should.be.none
+    len(scheduler).should.equal(2)
+
+    scheduler.release('b.com')
+    scheduler.pop().should.equal(('b.com', 'b2'))
+    scheduler.release('a.com')
+    scheduler.pop().should.equal(('a.com', 'a2'))
+    len(scheduler).should.equal(0)
+
+    # a.com and b.com both had a link waiting, once
+    scheduler.report()['scheduler.throttled'].should.equal(2)
+
+
+@patch('cello.scheduler.time')
+def test_next_ready(time):
+    ("Scheduler#next_ready is how long until a queued host can be fetched")
+
+    time.time.return_value = 100.0
+    scheduler = Scheduler(rate=4)
+    scheduler.next_ready().should.equal(0)
+
+    scheduler.push('fab.com', 'first')
+    scheduler.push('fab.com', 'second')
+    scheduler.pop()
+
+    scheduler.next_ready().should.equal(0.25)
+
+
+@patch('cello.scheduler.time')
+def test_adaptive_concurrency_grows_while_latency_is_flat(time):
+    ("AdaptiveConcurrency raises a limit in use by about one per round "
+     "trip while the latency stays flat")
+
+    time.time.return_value = 100.0
+    adaptive = AdaptiveConcurrency(initial=2, maximum=3)
+
+    # 2 + 1/2 + 1/2.5 + 1/2.9
+    adaptive.record('fab.com', 0.1, in_flight=2).should.equal(2)
+    adaptive.record('fab.com', 0.1, in_flight=2).should.equal(2)
+    adaptive.record('fab.com', 0.1, in_flight=2).should.equal(3)
+    adaptive.record('fab.com', 0.1, in_flight=3).should.equal(3)
+    adaptive.get('fab.com')[0].should.equal(3)
+
+
+def test_adaptive_concurrency_only_grows_limits_in_use():
+    ("AdaptiveConcurrency doesn't raise a limit that isn't reached")
+
+    adaptive = AdaptiveConcurrency(initial=4)
+
+    for attempt in range(10):
+        adaptive.record('fab.com', 0.1, in_flight=1)
+
+    adaptive.limit('fab.com').should.equal(4)
+    adaptive.report()['concurrency.increases'].should.equal(0)
+
+
+@patch('cello.scheduler.time')
+def test_adaptive_concurrency_backs_off_on_failures(time):
+    ("AdaptiveConcurrency cuts a limit on failures, once per round trip")
+
+    time.time.return_value = 100.0
+    adaptive = AdaptiveConcurrency(initial=8, minimum=2)
+
+    adaptive.record('fab.com', 1.0, failed=True).should.equal(4)
+    adaptive.record('fab.com', 1.0, failed=True).should.equal(4)
+
+    time.time.return_value = 101.0
+    adaptive.record('fab.com', 1.0, failed=True).should.equal(2)
+
+    time.time.return_value = 102.0
+    adaptive.record('fab.com', 1.0, failed=True).should.equal(2)
+    adaptive.report().should.equal({
+        'concurrency.limit': 8,
+        'concurrency.increases': 0,
+        'concurrency.decreases': 3,
+    })
+
+
+@patch('cello.scheduler.time')
+def test_adaptive_concurrency_backs_off_when_latency_grows(time):
+    ("AdaptiveConcurrency cuts a limit when its smoothed latency goes "
+     "beyond `tolerance` times the lowest one")
+
+    time.time.return_value = 100.0
+    adaptive = AdaptiveConcurrency(initial=8, tolerance=2.0)
+    adaptive.record('fab.com', 0.1, in_flight=8)
+
+    for attempt in range(10):
+        adaptive.record('fab.com', 1.0, in_flight=8)
+
+    adaptive.limit('fab.com').should.equal(4)
+
+
+def test_adaptive_scheduler_keeps_fetches_within_the_limits():
+    ("Scheduler with an adaptive controller caps the fetches in flight "
+     "per host and across the crawl")
+
+    adaptive = AdaptiveConcurrency(initial=2)
+    adaptive.get(None)[0] = 3
+    scheduler = Scheduler(adaptive=adaptive, hosts={'b.com': {'concurrency': 1}})
+
+    scheduler.acquire('a.com').should.be.true
+    scheduler.acquire('a.com').should.be.true
+    scheduler.acquire('a.com').should.be.false
+    scheduler.acquire('b.com').should.be.true
+    scheduler.acquire('b.com').should.be.false
+    scheduler.release('a.com')
+    scheduler.acquire('c.com').should.be.true
+    scheduler.acquire('c.com').should.be.false
+    scheduler.in_flight.should.equal(3)
+
+
+def test_request_reports_to_the_adaptive_controller():
+    ("Scheduler#request times the fetch and reports failures and server "
+     "errors to the adaptive controller of the host and the crawl")
+
+    adaptive = Mock()
+    adaptive.limit.return_value = 10
+    scheduler = Scheduler(adaptive=adaptive)
+
+    get_response = Mock(return_value=Mock(status_code=503))
+    scheduler.request(get_response, 'http://fab.com/1', {'If-None-Match': 'x'}).should.equal(
+        get_response.return_value)
+    get_response.assert_called_once_with('http://fab.com/1', {'If-None-Match': 'x'})
+
+    [call[0][0] for call in adaptive.record.call_args_list].should.equal(['fab.com', None])
+    [call[0][2] for call in adaptive.record.call_args_list].should.equal([True, True])
+
+    adaptive.record.reset_mock()
+    get_response.side_effect = IOError('timed out')
+    scheduler.request.when.called_with(get_response, 'http://fab.com/2').should.throw(IOError)
+    [call[0][2] for call in adaptive.record.call_args_list].should.equal([True, True])
+    scheduler.in_flight.should.equal(0)
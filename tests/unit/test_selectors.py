@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from lxml import html as lhtml
+from sure import expect
+from cello.selectors import SelectorCache
+
+
+def test_css_selector_is_compiled_once():
+    "SelectorCache.css compiles a selector once and counts hits and misses"
+
+    cache = SelectorCache()
+    compiled = cache.css('li a')
+
+    expect(cache.css('li a')).to.equal(compiled)
+    expect(cache.info()).to.equal({
+        'hits': 1,
+        'misses': 1,
+        'size': 1,
+        'maxsize': 512,
+    })
+
+
+def test_compiled_selectors_query_the_dom():
+    "SelectorCache compiled css and xpath selectors can be called with a dom"
+
+    dom = lhtml.fromstring('<ul><li><a href="/one">1</a></li><li><a href="/two">2</a></li></ul>')
+    cache = SelectorCache()
+
+    expect([a.get('href') for a in cache.css('li a')(dom)]).to.equal(['/one', '/two'])
+    expect(cache.xpath('//a/@href')(dom)).to.equal(['/one', '/two'])
+
+
+def test_compiled_contains_selectors_are_reused_across_pages():
+    "SelectorCache compiled :contains selectors keep working page after page"
+
+    cache = SelectorCache()
+    pages = ['<p>One Cello</p><p>viola</p>', u'<p>violin</p><p>CELLO \xc9</p>', '<p>cello</p>']
+
+    for html in pages:
+        dom = lhtml.fromstring(html)
+        expect([p.text for p in cache.css('p:contains("Cello")')(dom)]).to.equal(
+            [p.text for p in dom.xpath('//p') if 'cello' in p.text.lower()])
+
+
+def test_css_and_xpath_do_not_clash():
+    "SelectorCache keeps css and xpath selectors with the same string apart"
+
+    cache = SelectorCache()
+
+    expect(cache.css('a')).to_not.equal(cache.xpath('a'))
+    expect(len(cache)).to.equal(2)
+
+
+def test_least_recently_used_selectors_are_evicted():
+    "SelectorCache never holds more than maxsize selectors"
+
+    cache = SelectorCache(maxsize=2)
+    first = cache.css('a')
+    cache.css('b')
+    cache.css('a')
+    cache.css('c')
+
+    expect(len(cache)).to.equal(2)
+    expect(cache.css('a')).to.equal(first)
+    expect(cache.misses).to.equal(3)
+
+    cache.css('b')
+    expect(cache.misses).to.equal(4)
+
+
+def test_clear():
+    "SelectorCache.clear forgets selectors and counters"
+
+    cache = SelectorCache()
+    cache.css('a')
+    cache.css('a')
+    cache.clear()
+
+    expect(cache.info()).to.equal({
+        'hits': 0,
+        'misses': 0,
+        'size': 0,
+        'maxsize': 512,
+    })
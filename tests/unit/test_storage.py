@@ -1,11 +1,33 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
+import shutil
+import tempfile
+import threading
+from mock import Mock, patch
 from cello.models import Stage
-from cello.storage import Case, DummyCase
+from cello.storage import Case, DummyCase, PersistBuffer, PersistWriter, FingerprintStore
 from sure import expect
 
 
+class EachCase(Case):
+    saved = []
+
+    def save(self, data):
+        self.saved.append((self.stage, data))
+
+
+class BatchCase(Case):
+    batches = []
+
+    def save(self, data):
+        raise AssertionError('should have saved in batches')
+
+    def save_many(self, items):
+        self.batches.append((self.stage, items))
+
+
 def test_case_save_has_access_to_stage():
     "Case.save has access to stage"
 
@@ -42,3 +64,231 @@ def test_dummy_case_doesnt_do_anything():
     case = DummyCase(stage)
 
     expect(case.save('foo')).to.be.none
+
+
+def test_save_many_saves_each_item_by_default():
+    "Case.save_many falls back to saving items one by one"
+
+    EachCase.saved = []
+    EachCase('stage').save_many(['foo', 'bar'])
+
+    expect(EachCase.saved).to.equal([('stage', 'foo'), ('stage', 'bar')])
+    expect(EachCase.saves_in_batches()).to.be.false
+    expect(BatchCase.saves_in_batches()).to.be.true
+
+
+def test_buffer_flushes_a_full_group():
+    "PersistBuffer saves a group of items once it reaches its size"
+
+    BatchCase.batches = []
+    buffer = PersistBuffer(size=2)
+
+    buffer.add(BatchCase, 'stage 1', {'n': 1})
+    buffer.add(EachCase, 'stage 2', {'n': 2})
+    expect(BatchCase.batches).to.be.empty
+    expect(len(buffer)).to.equal(2)
+
+    buffer.add(BatchCase, 'stage 3', {'n': 3})
+
+    expect(BatchCase.batches).to.equal([('stage 3', [{'n': 1}, {'n': 3}])])
+    expect(buffer.report()).to.equal({
+        'persist.buffered': 1,
+        'persist.batches': 1,
+        'persist.items': 2,
+    })
+
+
+def test_buffer_marks_saved_items_as_persisted():
+    "PersistBuffer tells the frontier of each saved stage that it was persisted"
+
+    EachCase.saved = []
+    stages = [Mock(), Mock()]
+    buffer = PersistBuffer(size=10)
+
+    buffer.add(EachCase, stages[0], {'n': 1})
+    buffer.add(EachCase, stages[1], {'n': 2})
+    expect(stages[0].frontier.mark.called).to.be.false
+
+    buffer.flush()
+
+    for stage in stages:
+        stage.frontier.mark.assert_called_once_with(stage, 'persisted')
+
+
+@patch('cello.storage.time')
+def test_buffer_flushes_a_group_after_its_interval(time):
+    "PersistBuffer saves a group when its interval went by"
+
+    BatchCase.batches = []
+    buffer = PersistBuffer(size=100, interval=5)
+
+    time.time.return_value = 100
+    buffer.add(BatchCase, 'stage 1', {'n': 1})
+    time.time.return_value = 104
+    buffer.add(BatchCase, 'stage 2', {'n': 2})
+    expect(BatchCase.batches).to.be.empty
+
+    time.time.return_value = 105
+    buffer.add(BatchCase, 'stage 3', {'n': 3})
+
+    expect(BatchCase.batches).to.equal([('stage 3', [{'n': 1}, {'n': 2}, {'n': 3}])])
+
+
+def test_buffer_flush_saves_each_item_of_cases_without_batches():
+    "PersistBuffer#flush saves every item with its own stage when the case has no save_many"
+
+    EachCase.saved = []
+    buffer = PersistBuffer()
+
+    buffer.add(EachCase, 'stage 1', {'n': 1})
+    buffer.add(EachCase, 'stage 2', {'n': 2})
+    buffer.flush()
+
+    expect(EachCase.saved).to.equal([('stage 1', {'n': 1}), ('stage 2', {'n': 2})])
+    expect(len(buffer)).to.equal(0)
+    expect(buffer.report()['persist.batches']).to.equal(1)
+
+
+def test_writer_saves_items_in_the_background():
+    "PersistWriter saves each item from its thread and flush() waits for them"
+
+    EachCase.saved = []
+    writer = PersistWriter()
+
+    writer.add(EachCase, 'stage 1', {'n': 1})
+    writer.add(EachCase, 'stage 2', {'n': 2})
+    writer.flush()
+
+    expect(EachCase.saved).to.equal([('stage 1', {'n': 1}), ('stage 2', {'n': 2})])
+    expect(writer.report()).to.equal({
+        'writer.queued': 0,
+        'writer.peak': writer.peak,
+        'writer.waits': 0,
+        'writer.saved': 2,
+    })
+
+
+def test_writer_saves_through_a_buffer():
+    "PersistWriter hands its items to a PersistBuffer and flushes it"
+
+    BatchCase.batches = []
+    writer = PersistWriter(buffer=PersistBuffer(size=100))
+
+    writer.add(BatchCase, 'stage 1', {'n': 1})
+    writer.add(BatchCase, 'stage 2', {'n': 2})
+    expect(BatchCase.batches).to.be.empty
+
+    writer.flush()
+
+    expect(BatchCase.batches).to.equal([('stage 2', [{'n': 1}, {'n': 2}])])
+
+
+def test_writer_applies_backpressure():
+    "PersistWriter blocks the crawl while its queue is full"
+
+    saving, release = threading.Event(), threading.Event()
+
+    class SlowCase(Case):
+        def save(self, data):
+            saving.set()
+            release.wait()
+
+    writer = PersistWriter(maxsize=1)
+    writer.add(SlowCase, 'stage', 1)
+    saving.wait()
+    writer.add(SlowCase, 'stage', 2)
+
+    blocked = threading.Thread(target=writer.add, args=(SlowCase, 'stage', 3))
+    blocked.start()
+    blocked.join(0.05)
+    expect(blocked.is_alive()).to.be.true
+    expect(writer.depth).to.equal(1)
+
+    release.set()
+    blocked.join()
+    writer.flush()
+
+    expect(writer.waits).to.equal(1)
+    expect(writer.saved).to.equal(3)
+
+
+@patch('cello.storage.logger')
+def test_writer_raises_its_errors(logger):
+    "PersistWriter raises the error of a failed save on flush and on the next add"
+
+    class BrokenCase(Case):
+        def save(self, data):
+            raise ValueError('disk is full')
+
+    writer = PersistWriter()
+    writer.add(BrokenCase, 'stage', 1)
+
+    expect(writer.flush).when.called.to.throw(ValueError, 'disk is full')
+    expect(writer.add).when.called_with(BrokenCase, 'stage', 2).to.throw(
+        ValueError, 'disk is full')
+
+
+def test_fingerprints_tell_unchanged_items():
+    "FingerprintStore tells the items that are the same as the last saved ones, volatile keys aside"
+
+    directory = tempfile.mkdtemp()
+    try:
+        store = FingerprintStore(os.path.join(directory, 'items.db'), volatile=('datetime', 'views'))
+        fingerprint = store.changed('http://fab.com/1', {'name': 'cello', 'price': 10, 'datetime': 'today'})
+        store.remember('http://fab.com/1', fingerprint)
+
+        again = FingerprintStore(store.path, volatile=('datetime', 'views'))
+        unchanged = again.changed('http://fab.com/1', {'price': 10, 'name': u'cello', 'views': 3})
+        changed = again.changed('http://fab.com/1', {'name': 'cello', 'price': 12})
+    finally:
+        shutil.rmtree(directory)
+
+    expect(unchanged).to.be.none
+    expect(changed).to_not.be.none
+    expect(changed).to_not.equal(fingerprint)
+    expect(again.report()).to.equal({'items.changed': 1, 'items.unchanged': 1})
+
+
+def test_fingerprints_of_items_with_any_bytes():
+    "FingerprintStore fingerprints items holding byte strings that aren't utf-8"
+
+    directory = tempfile.mkdtemp()
+    try:
+        store = FingerprintStore(os.path.join(directory, 'items.db'))
+        fingerprint = store.changed('http://fab.com/1', {'name': b'caf\xe9', 'tags': [b'\xff']})
+        store.remember('http://fab.com/1', fingerprint)
+
+        unchanged = store.changed('http://fab.com/1', {'tags': [b'\xff'], 'name': b'caf\xe9'})
+        changed = store.changed('http://fab.com/1', {'name': b'caf\xe8', 'tags': [b'\xff']})
+    finally:
+        shutil.rmtree(directory)
+
+    expect(fingerprint).to_not.be.none
+    expect(unchanged).to.be.none
+    expect(changed).to_not.be.none
+    # utf-8 items keep the fingerprints they had
+    expect(store.fingerprint({'name': b'caf\xc3\xa9'})).to.equal(store.fingerprint({'name': u'caf\xe9'}))
+
+
+def test_buffer_remembers_fingerprints_once_saved():
+    "PersistBuffer remembers the fingerprints of the items it saved, and only once they are saved"
+
+    directory = tempfile.mkdtemp()
+
+    class Product(Stage):
+        case = EachCase
+        fingerprints = FingerprintStore(os.path.join(directory, 'items.db'))
+
+    try:
+        EachCase.saved = []
+        buffer = PersistBuffer(size=10)
+        Product(Mock(), url='http://fab.com/1', buffer=buffer).persist({'name': 'cello'})
+        Product(Mock(), url='http://fab.com/1', buffer=buffer).persist({'name': 'cello'})
+        buffer.flush()
+        Product(Mock(), url='http://fab.com/1', buffer=buffer).persist({'name': 'cello'})
+        buffer.flush()
+    finally:
+        shutil.rmtree(directory)
+
+    expect(len(EachCase.saved)).to.equal(2)
+    expect(len(Product.fingerprints)).to.equal(1)